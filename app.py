@@ -1,5 +1,6 @@
 import numpy as np
 import uuid
+import secrets
 import dash
 from dash import dcc, html, no_update
 import dash_bootstrap_components as dbc
@@ -197,6 +198,8 @@ def setup_user_id(pathname):
     
     # Store the session marker key with TTL in Redis
     r.set(f"{unique_folder}", "", ex=SESSION_TTL)
+    # Secret for the session's download links, refreshed with the other session keys
+    r.set(f"{unique_folder}:download-token", secrets.token_urlsafe(24), ex=SESSION_TTL)
 
     # Initialize the session log handler dynamically with the generated session ID
     session_log_handler = SessionLogHandler(session_id=unique_folder, app=app)
@@ -0,0 +1,86 @@
+# Compare the exact, subsampled and grouped NB GLM fits used by HiCzin and normCC.
+# Reports fit time and how far each approximate fit's coefficients are from the exact fit.
+#
+# Usage: python -m benchmarks.bench_glm --pairs 2000000
+#        python -m benchmarks.bench_glm --example
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.sparse import load_npz
+from stages.glm_fitting import fit_nb_glm, nb_glm_params, compare_with_exact
+
+def standardize(array):
+    std = np.std(array)
+    return np.zeros_like(array) if std == 0 else (array - np.mean(array)) / std
+
+def hiczin_table(contig_info, contact_matrix, epsilon=1):
+    # Same covariates as the HiCzin branch of run_normalization
+    contact_matrix = contact_matrix.tocoo()
+    keep = contact_matrix.row < contact_matrix.col
+    row, col, data = contact_matrix.row[keep], contact_matrix.col[keep], contact_matrix.data[keep]
+    sites = contig_info['The number of restriction sites'].values.astype(float)
+    length = contig_info['Contig length'].values.astype(float)
+    coverage = contig_info['Contig coverage'].replace(0, epsilon).values.astype(float)
+    exog = np.column_stack([
+        np.ones(len(data)),
+        standardize(np.log(sites[row] * sites[col])),
+        standardize(np.log(length[row] * length[col])),
+        standardize(np.log(coverage[row] * coverage[col]))
+    ])
+    return exog, data
+
+def synthetic_table(n_pairs, n_contigs, seed=0):
+    # Per-contig log covariates, pair features as sums, NB(alpha=1) contacts
+    rng = np.random.default_rng(seed)
+    log_len = rng.normal(9, 1.2, n_contigs)
+    log_site = log_len - 6 + rng.normal(0, 0.3, n_contigs)
+    log_cov = rng.normal(2, 1, n_contigs)
+    row = rng.integers(0, n_contigs, n_pairs)
+    col = rng.integers(0, n_contigs, n_pairs)
+    exog = np.column_stack([
+        np.ones(n_pairs),
+        standardize(log_site[row] + log_site[col]),
+        standardize(log_len[row] + log_len[col]),
+        standardize(log_cov[row] + log_cov[col])
+    ])
+    mu = np.exp(exog @ np.array([0.5, 0.3, 0.2, 0.4]))
+    endog = rng.negative_binomial(1, 1 / (1 + mu)).astype(float)
+    keep = endog > 0  # Only nonzero contacts are stored in the matrix
+    return exog[keep], endog[keep]
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact vs subsampled vs grouped NB GLM fits.")
+    parser.add_argument('--pairs', type=int, default=1000000)
+    parser.add_argument('--contigs', type=int, default=50000)
+    parser.add_argument('--sample-size', type=int, default=100000)
+    parser.add_argument('--grid-bins', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--example', action='store_true', help="Use the HiCzin table of assets/examples instead.")
+    args = parser.parse_args()
+
+    if args.example:
+        contig_info = pd.read_csv('assets/examples/output/contig_info_final.csv')
+        contact_matrix = load_npz('assets/examples/output/unnormalized_contig_matrix.npz')
+        exog, endog = hiczin_table(contig_info, contact_matrix)
+    else:
+        exog, endog = synthetic_table(args.pairs, args.contigs)
+    print(f"Regression table: {len(endog)} rows, {exog.shape[1]} columns")
+
+    start = time.perf_counter()
+    exact_params = nb_glm_params(exog, endog)
+    exact_seconds = time.perf_counter() - start
+    print(f"\n{'mode':<16} {'seconds':>8} {'max |dβ|':>10} {'max rel dβ':>11} {'RMS dlogμ':>10}")
+    print(f"{'exact':<16} {exact_seconds:>8.2f} {0:>10.4f} {0:>11.4f} {0:>10.4f}")
+
+    runs = [('subsample', {'fit_mode': 'subsample', 'sample_size': args.sample_size})]
+    runs += [(f'grouped/{bins}', {'fit_mode': 'grouped', 'grid_bins': bins}) for bins in args.grid_bins]
+    for label, kwargs in runs:
+        start = time.perf_counter()
+        params = fit_nb_glm(exog, endog, **kwargs)
+        seconds = time.perf_counter() - start
+        report = compare_with_exact(exog, endog, params, exact_params)
+        print(f"{label:<16} {seconds:>8.2f} {report['max_abs_difference']:>10.4f} "
+              f"{report['max_relative_difference']:>11.4f} {report['rms_log_expectation_difference']:>10.4f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+# Normalization benchmark suite: every method plus bin aggregation on synthetic datasets of
+# increasing size. Each case runs in a fresh process so its peak RSS is its own; results are
+# written as JSON and can be compared with a previous run.
+#
+# Usage: python -m benchmarks.bench_normalization --sizes 10000 100000 --output results.json
+#        python -m benchmarks.bench_normalization --sizes 10000 100000 --compare baseline.json
+#        python -m benchmarks.bench_normalization --sizes 1000000 --methods bin3C --data-dir synthetic
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import load_npz
+from benchmarks.synthetic import generate
+
+METHODS = ['Raw', 'normCC', 'HiCzin', 'bin3C', 'MetaTOR']
+# Fields that identify a case when comparing two result files
+CASE_KEY = ('contigs', 'case')
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def prepared_inputs(folder):
+    # contig_info_final equivalent of prepare_data_method_1 for the generated files
+    contig_info = pd.read_csv(os.path.join(folder, 'contig_information.csv'))
+    contact_matrix = load_npz(os.path.join(folder, 'raw_contact_matrix.npz')).tocoo()
+    binning = pd.read_csv(os.path.join(folder, 'binning_information.csv'))
+    taxonomy = pd.read_csv(os.path.join(folder, 'taxonomy_information.csv')).replace("Unclassified", None)
+
+    contig_info['Within-contig Hi-C contacts'] = contact_matrix.diagonal()
+    contig_info = contig_info.merge(binning, on='Contig index', how='left')
+    contig_info['Bin index'] = contig_info['Bin index'].fillna(contig_info['Contig index'])
+    contig_info = contig_info.merge(taxonomy, on='Bin index', how='left')
+    contig_info['Category'] = contig_info['Category'].fillna('chromosome')
+    return contig_info, contact_matrix
+
+def dataset(data_dir, contigs, bins_per_contig, contacts_per_contig, seed):
+    # Generated once per parameter set and reused by later runs
+    n_bins = max(1, int(contigs * bins_per_contig))
+    folder = os.path.join(data_dir, f'{contigs}_{n_bins}_{contacts_per_contig:g}_{seed}')
+    if not os.path.exists(os.path.join(folder, 'taxonomy_information.csv')):
+        generate(folder, contigs, n_bins, contacts_per_contig, seed=seed)
+    return folder
+
+def _run_case(folder, case, params):
+    # Runs in its own process
+    from stages.b_normalization import run_normalization, generating_bin_information
+
+    contig_info, contact_matrix = prepared_inputs(folder)
+    result = {'case': case, 'nnz_in': int(contact_matrix.nnz), 'rss_inputs_mb': round(peak_rss_mb(), 1)}
+
+    if case == 'bin aggregation':
+        normalized_matrix = run_normalization('Raw', contig_info, contact_matrix, use_cache=False,
+                                              threshold=params['threshold'])
+        result['nnz_in'] = int(normalized_matrix.nnz)
+        start = time.perf_counter()
+        bin_info, bin_matrix = generating_bin_information(contig_info, normalized_matrix, True, True)
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        result['nnz_out'] = int(bin_matrix.nnz)
+        result['bins'] = int(len(bin_info))
+    else:
+        start = time.perf_counter()
+        normalized_matrix, model = run_normalization(case, contig_info, contact_matrix, use_cache=False,
+                                                     return_model=True, **params)
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        result['nnz_out'] = None if normalized_matrix is None else int(normalized_matrix.nnz)
+        result['iterations'] = (model or {}).get('iterations')
+
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+def run_suite(sizes, methods, data_dir, bins_per_contig, contacts_per_contig, params, seed=0, aggregation=True):
+    results = []
+    cases = list(methods) + (['bin aggregation'] if aggregation else [])
+    for contigs in sizes:
+        folder = dataset(data_dir, contigs, bins_per_contig, contacts_per_contig, seed)
+        for case in cases:
+            # Spawned so every case starts from an empty heap
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                try:
+                    result = executor.submit(_run_case, folder, case, params).result()
+                except Exception as e:
+                    result = {'case': case, 'error': str(e)}
+            result['contigs'] = contigs
+            results.append(result)
+            print(format_row(result), flush=True)
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+HEADER = f"{'contigs':>9} {'case':<16} {'seconds':>9} {'peak MB':>9} {'nnz in':>11} {'nnz out':>11} {'iter':>5}"
+
+def format_row(result):
+    if 'error' in result:
+        return f"{result['contigs']:>9} {result['case']:<16} failed: {result['error']}"
+    iterations = result.get('iterations')
+    return (f"{result['contigs']:>9} {result['case']:<16} {result['seconds']:>9.3f} {result['peak_rss_mb']:>9.1f} "
+            f"{result['nnz_in']:>11} {result['nnz_out'] if result['nnz_out'] is not None else '-':>11} "
+            f"{iterations if iterations is not None else '-':>5}")
+
+def compare(results, baseline):
+    # Time and peak memory ratios against a previous run (> 1 means slower or larger now)
+    previous = {tuple(r[k] for k in CASE_KEY): r for r in baseline['results'] if 'error' not in r}
+    print(f"\nCompared with {baseline['environment'].get('commit')} ({baseline['environment'].get('timestamp')})")
+    print(f"{'contigs':>9} {'case':<16} {'time x':>7} {'memory x':>9} {'nnz out':>8}")
+    for result in results:
+        before = previous.get(tuple(result.get(k) for k in CASE_KEY))
+        if before is None or 'error' in result:
+            continue
+        same_output = 'same' if before.get('nnz_out') == result.get('nnz_out') else 'changed'
+        print(f"{result['contigs']:>9} {result['case']:<16} {result['seconds'] / max(before['seconds'], 1e-9):>7.2f} "
+              f"{result['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-9):>9.2f} {same_output:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Normalization and bin aggregation benchmark suite.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Contig counts.")
+    parser.add_argument('--methods', nargs='+', default=METHODS, choices=METHODS)
+    parser.add_argument('--no-aggregation', action='store_true', help="Skip the bin aggregation case.")
+    parser.add_argument('--bins-per-contig', type=float, default=0.05)
+    parser.add_argument('--contacts-per-contig', type=float, default=20.0)
+    parser.add_argument('--threshold', type=float, default=5)
+    parser.add_argument('--max-iter', type=int, default=1000)
+    parser.add_argument('--tolerance', type=float, default=1e-6)
+    parser.add_argument('--glm-mode', default='exact', choices=['exact', 'subsample', 'grouped'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'hic_benchmarks'), help="Where datasets are generated and kept.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare with.")
+    args = parser.parse_args()
+
+    params = {'threshold': args.threshold, 'max_iter': args.max_iter, 'tolerance': args.tolerance, 'fit_mode': args.glm_mode}
+    print(HEADER)
+    results = run_suite(args.sizes, args.methods, args.data_dir, args.bins_per_contig, args.contacts_per_contig,
+                        params, seed=args.seed, aggregation=not args.no_aggregation)
+
+    report = {
+        'environment': environment(),
+        'parameters': dict(params, sizes=args.sizes, bins_per_contig=args.bins_per_contig,
+                           contacts_per_contig=args.contacts_per_contig, seed=args.seed),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(results, json.load(handle))
+
+if __name__ == '__main__':
+    main()
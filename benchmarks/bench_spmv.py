@@ -0,0 +1,71 @@
+# Scaling benchmark for the row-partitioned SpMV kernel used by bin3C balancing.
+#
+# Usage: python -m benchmarks.bench_spmv --contigs 500000 --nnz 5000000 --threads 1 2 4 8
+import os
+import time
+import argparse
+import numpy as np
+from scipy.sparse import coo_matrix
+from stages.balancing import ParallelSpMV, KnightRuizBalancer, numba
+
+def random_contact_matrix(n, nnz, seed=0):
+    # Symmetric matrix with heavy-tailed counts, similar in shape to a contig contact map
+    rng = np.random.default_rng(seed)
+    half = nnz // 2
+    row = rng.integers(0, n, half)
+    col = rng.integers(0, n, half)
+    data = np.floor(rng.pareto(1.5, half) + 1)
+    m = coo_matrix((np.concatenate([data, data]), (np.concatenate([row, col]), np.concatenate([col, row]))), shape=(n, n))
+    return m.tocsr()
+
+def time_spmv(m, n_threads, backend, repeats):
+    kernel = ParallelSpMV(m, n_threads=n_threads, backend=backend)
+    x = np.random.default_rng(1).random(m.shape[1])
+    out = np.empty(m.shape[0])
+    kernel(x, out)  # Warm up (and JIT compile for numba)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        kernel(x, out)
+    elapsed = (time.perf_counter() - start) / repeats
+    kernel.close()
+    return elapsed
+
+def time_balance(m, n_threads, backend):
+    balancer = KnightRuizBalancer(n_threads=n_threads, backend=backend)
+    start = time.perf_counter()
+    balancer.balance(m)
+    return time.perf_counter() - start, balancer.n_iter
+
+def main():
+    parser = argparse.ArgumentParser(description="SpMV scaling benchmark for bin3C balancing.")
+    parser.add_argument('--contigs', type=int, default=500000)
+    parser.add_argument('--nnz', type=int, default=2000000)
+    parser.add_argument('--threads', type=int, nargs='+', default=None)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--balance', action='store_true', help="Also time a full Knight-Ruiz run per thread count.")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    threads = args.threads or sorted({1, 2, 4, 8, 16, cores} & set(range(1, cores + 1)))
+    backends = ['threads'] + (['numba'] if numba is not None else [])
+
+    m = random_contact_matrix(args.contigs, args.nnz)
+    print(f"Matrix: {m.shape[0]} x {m.shape[1]}, {m.nnz} nonzeros, {cores} cores available")
+
+    for backend in backends:
+        baseline = None
+        print(f"\nBackend: {backend}")
+        print(f"{'threads':>8} {'ms/SpMV':>10} {'speedup':>8} {'GB/s':>8}" + (f" {'balance s':>10} {'iters':>6}" if args.balance else ""))
+        for n_threads in threads:
+            elapsed = time_spmv(m, n_threads, backend, args.repeats)
+            baseline = baseline or elapsed
+            # data + indices + x gather + indptr streamed per product
+            bytes_moved = m.nnz * (m.data.itemsize + m.indices.itemsize + 8) + m.indptr.nbytes
+            line = f"{n_threads:>8} {elapsed * 1e3:>10.2f} {baseline / elapsed:>8.2f} {bytes_moved / elapsed / 1e9:>8.2f}"
+            if args.balance:
+                seconds, n_iter = time_balance(m, n_threads, backend)
+                line += f" {seconds:>10.2f} {n_iter:>6}"
+            print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# Synthetic metagenomic Hi-C datasets in the four input files of Method 1:
+# contig_information.csv, raw_contact_matrix.npz, binning_information.csv and taxonomy_information.csv.
+#
+# Contigs are grouped into bins with heavy-tailed sizes. Bins are chromosome, virus or plasmid, and every
+# virus/plasmid bin has a host chromosome bin. Restriction sites follow contig length, coverage follows
+# bin abundance, and both drive how many contacts a contig has and how large they are, which is the bias
+# the normalization methods remove. Counts are overdispersed negative binomial on top of a lognormal
+# pair effect, so they are heavy-tailed. Contacts are mostly within bins, then between viruses/plasmids
+# and their hosts, then background.
+#
+# Memory stays bounded by the per-contig vectors plus one chunk of contacts: pairs are generated in
+# fixed blocks of contigs, spilled to row-range buckets on disk, merged per bucket and streamed into
+# the .npz. The same arguments always produce the same files.
+#
+# Usage: python -m benchmarks.synthetic --contigs 100000 --bins 5000 --output synthetic/100k
+#        python -m benchmarks.synthetic --contigs 1000000 --bins 40000 --contacts-per-contig 30 --output synthetic/1m
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from stages.out_of_core import save_spilled_npz
+
+TAXONOMY_LEVELS = ['Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+CATEGORIES = ['chromosome', 'virus', 'plasmid']
+BIN_PREFIX = {'chromosome': 'MAG', 'virus': 'vMAG', 'plasmid': 'pMAG'}
+# Contigs per generation block; fixed so the output does not depend on the memory setting
+BLOCK_CONTIGS = 65536
+PAIR_DTYPE = np.dtype([('row', np.int32), ('col', np.int32), ('data', np.float64)])
+
+def bin_layout(n_contigs, n_bins, binned_fraction, mix, rng):
+    # Bin sizes, categories and host bins. Binned contigs come first and are contiguous per bin.
+    n_binned = min(n_contigs, max(n_bins, int(round(n_contigs * binned_fraction))))
+    sizes = np.ones(n_bins, dtype=np.int64)
+    weights = rng.lognormal(0, 1.0, n_bins)
+    sizes += rng.multinomial(n_binned - n_bins, weights / weights.sum())
+
+    mix = np.asarray(mix, dtype=float)
+    category = rng.choice(len(CATEGORIES), n_bins, p=mix / mix.sum())
+    category[0] = 0  # At least one host
+    chromosome_bins = np.flatnonzero(category == 0)
+    # Viruses and plasmids are a few contigs each, the rest go to chromosome bins
+    small = category > 0
+    moved = sizes[small] - np.minimum(sizes[small], rng.integers(1, 4, small.sum()))
+    sizes[small] -= moved
+    np.add.at(sizes, chromosome_bins[rng.integers(0, len(chromosome_bins), small.sum())], moved)
+
+    host = np.where(category == 0, -1, chromosome_bins[rng.integers(0, len(chromosome_bins), n_bins)])
+    start = np.concatenate(([0], np.cumsum(sizes)))
+    return sizes, start, category, host
+
+def contig_table(n_contigs, sizes, start, category, rng):
+    # Per-contig features in internal (bin-contiguous) order
+    n_binned = int(start[-1])
+    bin_of = np.full(n_contigs, -1, dtype=np.int64)
+    bin_of[:n_binned] = np.repeat(np.arange(len(sizes)), sizes)
+    contig_category = np.where(bin_of >= 0, category[np.maximum(bin_of, 0)], 0)
+
+    length = np.where(contig_category == 0, rng.lognormal(11.2, 1.1, n_contigs), rng.lognormal(10.2, 0.8, n_contigs))
+    length = np.maximum(1000, length).astype(np.int64)
+    sites = np.maximum(1, np.round(length / (120 * rng.lognormal(0, 0.25, n_contigs)))).astype(np.int64)
+
+    # Coverage follows bin abundance; viruses and plasmids are usually more abundant than their hosts
+    abundance = rng.lognormal(2, 1.2, len(sizes)) * np.where(category == 0, 1.0, 3.0)
+    coverage = np.where(bin_of >= 0, abundance[np.maximum(bin_of, 0)], rng.lognormal(1.5, 1.2, n_contigs))
+    coverage = np.round(coverage * rng.lognormal(0, 0.2, n_contigs), 4)
+    return bin_of, length, sites, coverage
+
+def taxonomy_table(category, depth, unclassified_fraction, rng):
+    # One lineage per bin; deeper ranks split further and are more often unclassified
+    n_bins = len(category)
+    levels = TAXONOMY_LEVELS[:depth]
+    columns = {}
+    code = np.zeros(n_bins, dtype=np.int64)
+    unclassified = np.zeros(n_bins, dtype=bool)
+    for k, level in enumerate(levels):
+        branching = max(2, int(round(n_bins ** (1 / (depth + 1)))))
+        code = code * branching + rng.integers(0, branching, n_bins)
+        unclassified |= rng.random(n_bins) < 0.6 * (k / max(1, depth - 1)) ** 4
+        prefix = np.where(category == 0, level, np.where(category == 1, f'Viral{level}', f'Plasmid{level}'))
+        names = pd.Series(prefix).str.cat(pd.Series(code).astype(str), sep='_')
+        columns[level] = names.where(~unclassified, 'Unclassified').values
+    table = pd.DataFrame(columns)
+    # Some bins have no taxonomy row at all
+    listed = rng.random(n_bins) >= unclassified_fraction
+    return table, listed
+
+def block_pairs(lo, hi, rng, degree, bin_of, start, host, cumulative_weight, intra_fraction, host_fraction,
+                sites, coverage, mean_contact):
+    # Contacts emitted by contigs lo..hi-1; every pair is counted once by one of its contigs
+    n = len(bin_of)
+    emitted = rng.poisson(degree[lo:hi] / 2)
+    source = np.repeat(np.arange(lo, hi, dtype=np.int64), emitted)
+    target = np.empty(len(source), dtype=np.int64)
+    kind = rng.random(len(source))
+
+    source_bin = bin_of[source]
+    in_bin = source_bin >= 0
+    intra = in_bin & (kind < intra_fraction)
+    bins = source_bin[intra]
+    target[intra] = start[bins] + (rng.random(len(bins)) * (start[bins + 1] - start[bins])).astype(np.int64)
+
+    host_bin = np.where(in_bin, host[np.maximum(source_bin, 0)], -1)
+    to_host = ~intra & (host_bin >= 0) & (kind < intra_fraction + host_fraction)
+    bins = host_bin[to_host]
+    target[to_host] = start[bins] + (rng.random(len(bins)) * (start[bins + 1] - start[bins])).astype(np.int64)
+
+    background = ~intra & ~to_host
+    target[background] = np.searchsorted(cumulative_weight, rng.random(background.sum()) * cumulative_weight[-1], side='right')
+    np.minimum(target, n - 1, out=target)
+
+    keep = source != target
+    source, target, intra = source[keep], target[keep], intra[keep]
+
+    # Heavy-tailed counts scaled by the site and coverage biases of both contigs
+    mu = mean_contact * np.sqrt(sites[source] * sites[target] * coverage[source] * coverage[target])
+    mu *= rng.lognormal(0, 1.0, len(mu)) * np.where(intra, 6.0, 1.0)
+    dispersion = 0.7
+    counts = 1 + rng.negative_binomial(dispersion, dispersion / (dispersion + mu))
+    return np.minimum(source, target), np.maximum(source, target), counts.astype(np.float64)
+
+def generate(output, n_contigs=10000, n_bins=500, contacts_per_contig=20.0, mix=(0.8, 0.12, 0.08),
+             taxonomy_depth=6, binned_fraction=0.9, intra_fraction=0.6, host_fraction=0.15,
+             unclassified_fraction=0.1, chunk_entries=2000000, seed=0):
+    # Write the four Method 1 inputs to `output`; returns a summary of the dataset
+    os.makedirs(output, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_bins = max(1, min(n_bins, n_contigs))
+    sizes, start, category, host = bin_layout(n_contigs, n_bins, binned_fraction, mix, rng)
+    bin_of, length, sites, coverage = contig_table(n_contigs, sizes, start, category, rng)
+
+    # Contact propensity from the biases, scaled to the requested mean number of contacts
+    propensity = np.sqrt(sites / sites.mean()) * np.sqrt(coverage / coverage.mean())
+    degree = propensity * (contacts_per_contig / propensity.mean())
+    cumulative_weight = np.cumsum(propensity)
+    mean_contact = 2.0 / np.sqrt(sites.mean() ** 2 * coverage.mean() ** 2)
+    within = rng.poisson(length / 2000 * coverage + 1) + 1.0
+
+    # Output order is a random permutation of the internal one
+    position = rng.permutation(n_contigs).astype(np.int32)
+
+    # Row-range buckets small enough to merge one at a time
+    expected = np.cumsum(degree / 2)
+    n_buckets = max(1, int(np.ceil(expected[-1] / chunk_entries)))
+    bounds = np.searchsorted(expected, expected[-1] * np.arange(1, n_buckets) / n_buckets)
+    bounds = np.concatenate(([0], bounds, [n_contigs]))
+
+    scratch = tempfile.mkdtemp(prefix='synthetic_', dir=output)
+    try:
+        bucket_paths = [os.path.join(scratch, f'bucket_{k}.bin') for k in range(n_buckets)]
+        for block, lo in enumerate(range(0, n_contigs, BLOCK_CONTIGS)):
+            hi = min(lo + BLOCK_CONTIGS, n_contigs)
+            block_rng = np.random.default_rng([seed, 1, block])
+            low, high, counts = block_pairs(lo, hi, block_rng, degree, bin_of, start, host, cumulative_weight,
+                                            intra_fraction, host_fraction, sites, coverage, mean_contact)
+            bucket = np.searchsorted(bounds, low, side='right') - 1
+            order = np.argsort(bucket, kind='stable')
+            split = np.searchsorted(bucket[order], np.arange(1, n_buckets))
+            for k, part in enumerate(np.split(order, split)):
+                if len(part):
+                    pairs = np.empty(len(part), dtype=PAIR_DTYPE)
+                    pairs['row'], pairs['col'], pairs['data'] = low[part], high[part], counts[part]
+                    with open(bucket_paths[k], 'ab') as handle:
+                        pairs.tofile(handle)
+
+        # Merge repeated pairs per bucket, add the within-contig contacts and both triangles
+        out_paths = {name: os.path.join(scratch, f'matrix_{name}.bin') for name in ['row', 'col', 'data']}
+        handles = {name: open(path, 'wb') for name, path in out_paths.items()}
+        nnz = 0
+        try:
+            for k in range(n_buckets):
+                pairs = np.fromfile(bucket_paths[k], dtype=PAIR_DTYPE) if os.path.exists(bucket_paths[k]) \
+                    else np.empty(0, dtype=PAIR_DTYPE)
+                key = pairs['row'].astype(np.int64) * n_contigs + pairs['col']
+                unique, inverse = np.unique(key, return_inverse=True)
+                data = np.bincount(inverse, weights=pairs['data'], minlength=len(unique))
+                row, col = unique // n_contigs, unique % n_contigs
+                del pairs, key, inverse
+
+                diagonal = np.arange(bounds[k], bounds[k + 1])
+                rows = np.concatenate([position[row], position[col], position[diagonal]])
+                cols = np.concatenate([position[col], position[row], position[diagonal]])
+                values = np.concatenate([data, data, within[diagonal]])
+                rows.astype(np.int32).tofile(handles['row'])
+                cols.astype(np.int32).tofile(handles['col'])
+                values.astype(np.float64).tofile(handles['data'])
+                nnz += len(values)
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+        matrix = SimpleNamespace(shape=(n_contigs, n_contigs),
+                                 row=np.memmap(out_paths['row'], dtype=np.int32, mode='r', shape=(nnz,)),
+                                 col=np.memmap(out_paths['col'], dtype=np.int32, mode='r', shape=(nnz,)),
+                                 data=np.memmap(out_paths['data'], dtype=np.float64, mode='r', shape=(nnz,)))
+        save_spilled_npz(matrix, os.path.join(output, 'raw_contact_matrix.npz'))
+        del matrix
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    # Tables in output order
+    order = np.argsort(position)
+    contig_names = pd.Series(np.arange(n_contigs)).map('contig_{}'.format)
+    bin_names = pd.Series(category).map(lambda c: BIN_PREFIX[CATEGORIES[c]]).str.cat(
+        pd.Series(np.arange(1, n_bins + 1)).astype(str), sep='_')
+    pd.DataFrame({
+        'Contig index': contig_names,
+        'The number of restriction sites': sites[order],
+        'Contig length': length[order],
+        'Contig coverage': coverage[order]
+    }).to_csv(os.path.join(output, 'contig_information.csv'), index=False)
+
+    binned = np.flatnonzero(bin_of[order] >= 0)
+    pd.DataFrame({
+        'Bin index': bin_names.values[bin_of[order][binned]],
+        'Contig index': contig_names.values[binned]
+    }).to_csv(os.path.join(output, 'binning_information.csv'), index=False)
+
+    taxonomy, listed = taxonomy_table(category, taxonomy_depth, unclassified_fraction, rng)
+    taxonomy.insert(0, 'Category', np.array(CATEGORIES)[category])
+    taxonomy.insert(0, 'Bin index', bin_names.values)
+    taxonomy[listed].to_csv(os.path.join(output, 'taxonomy_information.csv'), index=False)
+
+    return {'contigs': n_contigs, 'bins': n_bins, 'binned_contigs': int(start[-1]), 'nnz': int(nnz),
+            'categories': {name: int((category == k).sum()) for k, name in enumerate(CATEGORIES)},
+            'taxonomy_levels': TAXONOMY_LEVELS[:taxonomy_depth]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic metagenomic Hi-C dataset.")
+    parser.add_argument('--output', required=True, help="Folder for the four input files.")
+    parser.add_argument('--contigs', type=int, default=10000)
+    parser.add_argument('--bins', type=int, default=500)
+    parser.add_argument('--contacts-per-contig', type=float, default=20.0,
+                        help="Mean number of off-diagonal nonzeros per contig (sparsity).")
+    parser.add_argument('--mix', type=float, nargs=3, default=[0.8, 0.12, 0.08], metavar=('CHROMOSOME', 'VIRUS', 'PLASMID'),
+                        help="Share of chromosome, virus and plasmid bins.")
+    parser.add_argument('--taxonomy-depth', type=int, default=6, choices=range(1, len(TAXONOMY_LEVELS) + 1))
+    parser.add_argument('--binned-fraction', type=float, default=0.9)
+    parser.add_argument('--intra-fraction', type=float, default=0.6, help="Share of contacts within a bin.")
+    parser.add_argument('--host-fraction', type=float, default=0.15, help="Share of virus/plasmid contacts with the host bin.")
+    parser.add_argument('--chunk-entries', type=int, default=2000000, help="Contacts held in memory at once.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    summary = generate(args.output, args.contigs, args.bins, args.contacts_per_contig, args.mix, args.taxonomy_depth,
+                       args.binned_fraction, args.intra_fraction, args.host_fraction,
+                       chunk_entries=args.chunk_entries, seed=args.seed)
+    print(f"{summary['contigs']} contigs ({summary['binned_contigs']} binned) in {summary['bins']} bins "
+          f"{summary['categories']}, {summary['nnz']} nonzeros, written to {args.output} "
+          f"in {time.perf_counter() - started:.1f}s")
+
+if __name__ == '__main__':
+    main()
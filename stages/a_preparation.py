@@ -13,7 +13,8 @@ from scipy.sparse import save_npz, load_npz, coo_matrix, csr_matrix, csc_matrix
 import logging
 from stages.helper import (
     save_file_to_user_folder,
-    save_to_redis)
+    save_to_redis,
+    start_annotation_precompute)
 
 # Initialize logger
 logger = logging.getLogger("app_logger")
@@ -748,6 +749,9 @@ def register_preparation_callbacks(app):
             save_to_redis(taxonomy_levels_key, taxonomy_levels)
             
             logger.info("Data loaded and saved to Redis successfully.")
+
+            # Taxonomy level contact matrices for the visualization stage, built in the background
+            start_annotation_precompute(user_folder, bin_information, bin_dense_matrix, taxonomy_levels)
             return True  # Validation and extraction succeeded
 
         except Exception as e:
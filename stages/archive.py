@@ -0,0 +1,104 @@
+import os
+import io
+import hashlib
+import logging
+import threading
+import py7zr
+from scipy.sparse import save_npz
+from stages.factorized import load_normalized_matrix, FACTORS_FILE, NORMALIZED_FILE, RAW_FILE
+
+logger = logging.getLogger("app_logger")
+
+# Built archives live next to the session files, so they expire with the session folder
+ARCHIVE_DIR = '.archives'
+NORMALIZED_ARCHIVE = 'normalized_information.7z'
+# Files of the archive users re-upload to go straight to the visualization stage
+NORMALIZED_MEMBERS = [
+    'bin_info_final.csv',
+    'normalized_bin_matrix.npz',
+    'bin_membership.npz',
+    'contig_info_final.csv',
+    NORMALIZED_FILE,
+    RAW_FILE
+]
+
+# Builds of the same archive path are serialized by one of a fixed set of locks
+_build_locks = [threading.Lock() for _ in range(64)]
+
+def _lock_for(path):
+    return _build_locks[hash(path) % len(_build_locks)]
+
+def session_files(folder):
+    # Relative paths of the session's own files, without built archives
+    files = []
+    for root, directories, names in os.walk(folder):
+        directories[:] = [d for d in directories if d != ARCHIVE_DIR]
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), folder))
+    return sorted(files)
+
+def artifact_version(folder, files):
+    # Changes whenever one of the files is rewritten, added or removed
+    digest = hashlib.blake2b(digest_size=12)
+    for name in files:
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+def _write_normalized_matrix(archive, folder):
+    # Factorized results are exported with their normalized matrix applied
+    if os.path.exists(os.path.join(folder, FACTORS_FILE)) and not os.path.exists(os.path.join(folder, NORMALIZED_FILE)):
+        buffer = io.BytesIO()
+        save_npz(buffer, load_normalized_matrix(folder))
+        buffer.seek(0)
+        archive.writef(buffer, NORMALIZED_FILE)
+
+def _build_normalized(folder, path):
+    with py7zr.SevenZipFile(path, 'w') as archive:
+        for name in NORMALIZED_MEMBERS:
+            if os.path.exists(os.path.join(folder, name)):
+                archive.write(os.path.join(folder, name), name)
+        _write_normalized_matrix(archive, folder)
+
+def _build_session(folder, path):
+    # The re-uploadable normalized archive, once normalization has run
+    normalized = os.path.exists(os.path.join(folder, 'normalized_bin_matrix.npz'))
+    with py7zr.SevenZipFile(path, 'w') as archive:
+        for name in session_files(folder):
+            if not (normalized and name == NORMALIZED_ARCHIVE):
+                archive.write(os.path.join(folder, name), name)
+        _write_normalized_matrix(archive, folder)
+        if normalized:
+            archive.write(get_archive(folder, 'normalized'), NORMALIZED_ARCHIVE)
+
+ARCHIVES = {
+    'normalized': (lambda folder: NORMALIZED_MEMBERS + [FACTORS_FILE], _build_normalized),
+    'session': (session_files, _build_session)
+}
+
+def get_archive(folder, kind='session'):
+    # Path of the archive for the current files of `folder`, built only when those files
+    # changed since the last build; older builds of the same kind are removed
+    list_files, build = ARCHIVES[kind]
+    version = artifact_version(folder, list_files(folder))
+    archive_dir = os.path.join(folder, ARCHIVE_DIR)
+    path = os.path.join(archive_dir, f'{kind}-{version}.7z')
+
+    with _lock_for(path):
+        if os.path.exists(path):
+            return path
+        os.makedirs(archive_dir, exist_ok=True)
+        logger.info(f"Building the {kind} archive.")
+        partial = f'{path}.partial'
+        build(folder, partial)
+        os.replace(partial, path)
+
+    for name in os.listdir(archive_dir):
+        if name.startswith(f'{kind}-') and os.path.join(archive_dir, name) != path and not name.endswith('.partial'):
+            try:
+                os.remove(os.path.join(archive_dir, name))
+            except OSError:
+                pass
+    return path
@@ -1,25 +1,44 @@
 from dash import dcc, html, dash_table
 from dash.exceptions import PreventUpdate
 from dash.dependencies import Input, Output, State
-from scipy.sparse import coo_matrix, spdiags, isspmatrix_csr
-import statsmodels.api as sm
-from itertools import combinations, product
-from joblib import Parallel, delayed
+from scipy.sparse import coo_matrix
 import logging
 import os
 import pandas as pd
-import py7zr
+import plotly.express as px
 import numpy as np
 from scipy.sparse import save_npz, load_npz
 from stages.helper import (
     save_to_redis,
-    get_indexes,
-    calculate_submatrix_sum
+    load_from_redis,
+    start_annotation_precompute,
+    AnnotationIndex,
+    aggregate_contacts
+)
+from stages.balancing import KnightRuizBalancer
+from stages.glm_fitting import fit_nb_glm, clamp_grid_bins, MAX_GRID_BINS
+from stages.batch import BATCH_METHODS, run_normalization_batch
+from stages.scheduler import SchedulerBusy
+from stages.preview import ThresholdPreview
+from stages.factorized import FactorizedMatrix, FACTORS_FILE
+from stages.archive import artifact_version
+from stages.out_of_core import needs_out_of_core, run_out_of_core_normalization, iter_npz_entries, chunk_entries
+from stages.cache import LRUCache, cache_budget, digest_arrays, digest_matrix, digest_frame, make_key
+from stages.kernels import (
+    BIAS_COLUMNS, contig_log_vectors, pair_features, standardize_columns,
+    select_percentile, chunked_percentile, compact_in_place
 )
 
 # Set up logging
 logger = logging.getLogger("app_logger")
 
+# Fitted normalization models (pre-denoise matrices), size set by NORMALIZATION_CACHE_MB
+NORMALIZATION_CACHE = LRUCache(cache_budget("NORMALIZATION_CACHE_MB", 1024), name='normalization cache')
+# Threshold preview indexes per user folder and fitted model, size set by THRESHOLD_PREVIEW_CACHE_MB
+THRESHOLD_PREVIEWS = LRUCache(cache_budget("THRESHOLD_PREVIEW_CACHE_MB", 512), name='threshold preview cache')
+# Files a normalization model is fitted on; rewriting one makes the session's previews stale
+PREVIEW_INPUTS = ['contig_info_final.csv', 'unnormalized_contig_matrix.npz']
+
 def preprocess_normalization(user_folder, assets_folder='output'):
     try:
         logger.info("Starting data preprocessing...")
@@ -40,285 +59,231 @@ def preprocess_normalization(user_folder, assets_folder='output'):
         logger.error(f"Error during data preprocessing: {e}")
         return None, None
 
-def run_normalization(method, contig_df, contact_matrix, epsilon=1, threshold=5, max_iter=1000, tolerance=0.000001):
-    # Ensure contact_matrix is in coo format for consistency across methods
+def denoise(matrix, threshold, in_place=False, streaming=None, chunk_size=5000000, return_cut=False):
+    # Keep the values above the threshold percentile, scaled by the smallest kept value.
+    # The percentile is found by selection (O(nnz)) instead of a full sort; memory-mapped
+    # or explicitly streamed data goes through the chunked quantile sketch instead.
+    # With in_place=True the row/col/data arrays of the given matrix are reused, so only
+    # pass it for matrices whose index arrays are not shared with the input matrix.
+    # With return_cut=True the threshold value and divisor are returned as well.
+    matrix = matrix.tocoo()
+    data, rows, cols = matrix.data, matrix.row, matrix.col
+
+    if streaming is None:
+        streaming = isinstance(data, np.memmap)
+    if streaming:
+        threshold_value = chunked_percentile(data, threshold, chunk_size=chunk_size)
+    else:
+        threshold_value = select_percentile(data, threshold)
+    mask = data > threshold_value
+
+    # Apply denoise: keeping values above threshold
+    if in_place and not streaming:
+        data, rows, cols = compact_in_place(mask, data, rows, cols)
+    else:
+        data, rows, cols = data[mask], rows[mask], cols[mask]
+
+    # Normalize by dividing by the smallest non-zero value, then ceil and convert to integers
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float64)
+    min_non_zero = np.min(data, where=data > 0, initial=np.inf)
+    np.divide(data, min_non_zero, out=data)
+    np.ceil(data, out=data)
+
+    denoised = coo_matrix((data.astype(int), (rows, cols)), shape=matrix.shape)
+    return (denoised, threshold_value, min_non_zero) if return_cut else denoised
+
+def normalization_inputs_digest(contig_df, contact_matrix):
+    # Content hash of the contact matrix and the contig features a model is fitted on
+    return make_key(digest_matrix(contact_matrix), digest_frame(contig_df, BIAS_COLUMNS.values()))
+
+def model_cache_key(method, inputs, epsilon=1, max_iter=1000, tolerance=0.000001, warm_start=None,
+                    fit_mode='exact', sample_size=200000, grid_bins=64):
+    # Inputs digest plus only the parameters the method's model actually depends on
+    if method in ['normCC', 'HiCzin']:
+        params = [epsilon, fit_mode]
+        if fit_mode == 'subsample':
+            params.append(sample_size)
+        elif fit_mode == 'grouped':
+            params.append(grid_bins)
+    elif method == 'bin3C':
+        params = [epsilon, max_iter, tolerance, None if warm_start is None else digest_arrays(warm_start)]
+    else:
+        params = [epsilon]
+    return make_key(method, inputs, *params)
+
+def normalization_cache_key(method, contig_df, contact_matrix, epsilon=1, max_iter=1000, tolerance=0.000001,
+                            warm_start=None, fit_mode='exact', sample_size=200000, grid_bins=64):
+    return model_cache_key(method, normalization_inputs_digest(contig_df, contact_matrix), epsilon, max_iter,
+                           tolerance, warm_start, fit_mode, sample_size, grid_bins)
+
+def threshold_preview_key(user_folder, method, inputs, max_iter, tolerance, fit_mode, sample_size, grid_bins):
+    # Previews are indexes of one fitted model, so they share the model cache key
+    return make_key(user_folder, model_cache_key(method, inputs, max_iter=max_iter, tolerance=tolerance,
+                                                 fit_mode=fit_mode, sample_size=sample_size, grid_bins=grid_bins))
+
+def fit_normalization_model(method, contig_df, contact_matrix, epsilon=1, max_iter=1000, tolerance=0.000001,
+                            warm_start=None, fit_mode='exact', sample_size=200000, grid_bins=64):
+    # Model stage of the normalization: everything before denoising.
+    # Returns the pre-denoise normalized matrix with the fitted model (GLM coefficients or
+    # balancing scale vector); 'owned' tells whether the matrix arrays may be reused in place.
+    # A shallow COO over the input arrays, so setdiag below never touches the caller's matrix
     contact_matrix = contact_matrix.tocoo()
+    contact_matrix = coo_matrix((contact_matrix.data, (contact_matrix.row, contact_matrix.col)), shape=contact_matrix.shape)
     
-    def safe_square(array):
-        array = np.clip(array, -1e10, 1e10)  # Clip large values for safety
-        return array ** 2
-    
-    def safe_divide(array, divisor):
-        divisor = np.where(divisor == 0, epsilon, divisor)  # Add epsilon to avoid zero division
-        return array / divisor
+    if method == 'Raw':
+        logger.info("Running Raw normalization.")
+        factorized = FactorizedMatrix(contact_matrix, 'Raw')
+        return {'matrix': contact_matrix, 'factorized': factorized, 'owned': False}
+
+    elif method == 'normCC':
+        logger.info("Running normCC normalization.")
+        signal = contact_matrix.max(axis=1).toarray().ravel()
+        coverage = contig_df['Contig coverage'].values
+
+        df = contig_df.copy()
+        df['Contig coverage'] = coverage
+        df['signal'] = signal
+
+        logger.info("Performing log transformations for normCC.")
+        df['log_site'] = np.log(df['The number of restriction sites'] + epsilon)
+        df['log_len'] = np.log(df['Contig length'])
+        df['log_coverage'] = np.log(df['Contig coverage'] + epsilon)
+
+        exog = np.column_stack([np.ones(len(df)), df[['log_site', 'log_len', 'log_coverage']].values])
+        endog = df['signal'].values
+        params = fit_nb_glm(exog, endog, fit_mode=fit_mode, sample_size=sample_size, grid_bins=grid_bins)
+
+        expected_signal = np.exp(exog @ params)
+        scal = np.max(expected_signal)
+
+        # scal * raw / sqrt(e_i * e_j) off the diagonal, zeros on the diagonal
+        factorized = FactorizedMatrix(contact_matrix, 'normCC', {'expected': expected_signal}, scalar=scal, zero_diagonal=True)
+        return {'matrix': factorized.normalized(), 'factorized': factorized, 'params': params, 'owned': True}
+
+    elif method == 'HiCzin':
+        logger.info("Running HiCzin normalization.")
+        contact_matrix.setdiag(0)
+
+        map_x = contact_matrix.row
+        map_y = contact_matrix.col
+        map_data = contact_matrix.data
+        index = map_x < map_y
+        map_x, map_y, map_data = map_x[index], map_y[index], map_data[index]
+
+        # Per-pair log products as log_a[row] + log_a[col], written straight into the design matrix
+        log_vectors = contig_log_vectors(contig_df, epsilon=epsilon)
+        exog = np.empty((len(map_data), 1 + len(log_vectors)), order='F')
+        exog[:, 0] = 1
+        pair_features(map_x, map_y, log_vectors, out=exog[:, 1:])
+        standardize_columns(exog, skip=1)
+
+        params = fit_nb_glm(exog, map_data, fit_mode=fit_mode, sample_size=sample_size, grid_bins=grid_bins)
+
+        # Apply the fitted model to every pair in one vectorized pass
+        expected_signal = np.exp(exog @ params)
+        normalized_data = map_data / expected_signal
+
+        normalized_contact_matrix = coo_matrix(
+            (normalized_data, (map_x, map_y)), shape=contact_matrix.shape
+        )
+        normalized_contact_matrix += normalized_contact_matrix.transpose()
 
-    def standardize(array):
-        std = np.std(array)
-        return np.zeros_like(array) if std == 0 else (array - np.mean(array)) / std
+        return {'matrix': normalized_contact_matrix, 'params': params, 'owned': True}
 
-    def denoise(matrix, threshold):
-        matrix = matrix.tocoo()
-        
-        # Mask values based on the threshold
-        threshold_value = np.percentile(matrix.data, threshold)
-        mask = matrix.data > threshold_value
-        
-        # Apply denoise: keeping values above threshold
-        filtered_data = matrix.data[mask]
-        filtered_rows = matrix.row[mask]
-        filtered_cols = matrix.col[mask]
-        
-        # Normalize by dividing by the smallest non-zero value
-        min_non_zero = np.min(filtered_data[filtered_data > 0])
-        normalized_data = filtered_data / min_non_zero
-        
-        # Apply ceiling function and convert to integers
-        normalized_data = np.ceil(normalized_data).astype(int)
-        
-        # Return the new sparse matrix with the normalized values
-        return coo_matrix((normalized_data, (filtered_rows, filtered_cols)), shape=matrix.shape)
+    elif method == 'bin3C':
+        logger.info("Running bin3C normalization.")
+        num_sites = contig_df['The number of restriction sites'].values + epsilon
+        normalized_data = contact_matrix.data / (num_sites[contact_matrix.row] * num_sites[contact_matrix.col])
 
-    def _bisto_seq(m, max_iter, tol):
-        # Make a copy of the original matrix 'm' for later use
-        _orig = m.copy()
-    
-        # Replace zero diagonals with ones to prevent potential scale explosion
-        m = m.tolil()  # Convert matrix to LIL format for efficient indexing
-        is_zero_diag = m.diagonal() == 0  # Check if there are zeros on the diagonal
-        if np.any(is_zero_diag):
-            # Set the diagonal elements that are zero to one
-            ix = np.where(is_zero_diag)
-            m[ix, ix] = 1
-    
-        # Ensure the matrix is in CSR format for efficient matrix operations
-        if not isspmatrix_csr(m):
-            m = m.tocsr()
-    
-        # Initialize variables
-        n = m.shape[0]  # Number of rows (and columns, assuming square matrix)
-        e = np.ones(n)  # A vector of ones
-        x = e.copy()    # Initialize x as a copy of e
-        delta = 0.1     # Lower bound for y
-        Delta = 3       # Upper bound for y
-        g = 0.9         # Step size factor
-        etamax = 0.1    # Maximum eta value
-        eta = etamax    # Initial eta
-        stop_tol = tol * 0.5  # Stopping tolerance
-        rt = tol ** 2        # Residual tolerance (squared)
-        v = x * m.dot(x)     # Initial value for v (Ax)
-        rk = 1 - v           # Residual (1 - Ax)
-        rho_km1 = rk.T.dot(rk)  # Initial rho (dot product of rk and rk)
-        rho_km2 = rho_km1       # Initialize rho_km2 with the same value as rho_km1
-        rout = rho_km1        # Set rout as the initial rho
-        rold = rout           # Previous value of rout
-        n_iter = 0            # Initialize iteration counter
-        i = 0                 # Inner loop iteration counter
-        y = np.empty_like(e)  # Vector y for updating
-    
-        # Main loop for the iterative process
-        while rout > rt and n_iter < max_iter:
-            i += 1
-            k = 0  # Inner loop counter
-            y[:] = e  # Reset y to vector of ones
-            inner_tol = max(rout * eta ** 2, rt)  # Set tolerance for inner loop
-            
-            # Inner loop for balancing the matrix
-            while rho_km1 > inner_tol:
-                k += 1
-                if k == 1:
-                    Z = rk / v  # Precompute Z
-                    p = Z  # Set p to Z in the first iteration
-                    rho_km1 = rk.T.dot(Z)  # Update rho
-                else:
-                    # Compute beta and update p in subsequent iterations
-                    beta = rho_km1 / rho_km2
-                    p = Z + beta * p
-                
-                # Compute w and alpha for the line search
-                w = x * m.dot(x * p) + v * p
-                alpha = rho_km1 / p.T.dot(w)  # Compute step size alpha
-                ap = alpha * p  # Compute the step size applied to p
-                ynew = y + ap  # Update y with the new value
-                
-                # Check for bound violations (either below delta or above Delta)
-                if np.amin(ynew) <= delta:
-                    if delta == 0:
-                        break
-                    ind = np.where(ap < 0)[0]
-                    gamma = np.amin((delta - y[ind]) / ap[ind])
-                    y += gamma * ap  # Adjust y to stay within bounds
-                    break
-                if np.amax(ynew) >= Delta:
-                    ind = np.where(ynew > Delta)[0]
-                    gamma = np.amin((Delta - y[ind]) / ap[ind])
-                    y += gamma * ap  # Adjust y to stay within bounds
-                    break
-    
-                y = ynew  # Update y if no bounds are violated
-                rk = rk - alpha * w  # Update the residual
-                rho_km2 = rho_km1  # Store the old value of rho
-                Z = rk / v  # Update Z
-                rho_km1 = np.dot(rk.T, Z)  # Update rho
-    
-                # Check for NaN values in x
-                if np.any(np.isnan(x)):
-                    raise RuntimeError('Scale vector has developed invalid values (NaNs)!')
-            
-            # Update x with the new y values
-            x *= y
-            v = x * m.dot(x)  # Update v
-            rk = 1 - v  # Recalculate the residual
-            rho_km1 = np.dot(rk.T, rk)  # Update rho
-            rout = rho_km1  # Update the residual norm
-            n_iter += k + 1  # Update the iteration count
-            rat = rout / rold  # Compute the relative change in residual
-            rold = rout  # Update old residual value
-            res_norm = np.sqrt(rout)  # Compute the residual norm
-            eta = g * rat  # Update eta
-            eta = max(min(eta, etamax), stop_tol / res_norm)  # Enforce eta bounds
-    
-        # Check if the algorithm converged
-        if n_iter >= max_iter:
-            logger.error(f'Maximum number of iterations ({max_iter}) reached without convergence')
-        
-        # Return the balanced matrix and the scale vector 'x'
-        X = spdiags(x, 0, n, n, 'csr')  # Create a diagonal matrix with x
-        matrix = X.T.dot(_orig.dot(X))
-        return matrix 
+        normalized_contact_matrix = coo_matrix(
+            (normalized_data, (contact_matrix.row, contact_matrix.col)), shape=contact_matrix.shape
+        )
 
+        balancer = KnightRuizBalancer(max_iter=max_iter, tol=tolerance)
+        scale = balancer.scale_vector(normalized_contact_matrix, x0=warm_start)
+        logger.info(f"Knight-Ruiz balancing finished after {balancer.n_iter} iterations "
+                    f"(residual {balancer.history[-1]['residual'] if balancer.history else 0:.2e}, "
+                    f"{balancer.elapsed:.2f}s).")
+
+        # The balanced matrix x_i * raw / (n_i * n_j) * x_j is rebuilt from the raw counts
+        factorized = FactorizedMatrix(contact_matrix, 'bin3C', {'sites': num_sites, 'scale': scale})
+        return {'matrix': factorized.normalized(), 'factorized': factorized, 'scale': scale,
+                'iterations': balancer.n_iter, 'owned': False}
+
+    elif method == 'MetaTOR':
+        logger.info("Running MetaTOR normalization.")
+        signal = contact_matrix.diagonal() + epsilon
+        factorized = FactorizedMatrix(contact_matrix, 'MetaTOR', {'signal': signal})
+        return {'matrix': factorized.normalized(), 'factorized': factorized, 'owned': False}
+
+    raise ValueError(f"Unsupported normalization method: {method}")
+
+def run_normalization(method, contig_df, contact_matrix, epsilon=1, threshold=5, max_iter=1000, tolerance=0.000001,
+                      warm_start=None, fit_mode='exact', sample_size=200000, grid_bins=64, use_cache=True,
+                      return_model=False):
+    # Fitted models are cached by input hash, method and model parameters, so changing only
+    # the threshold (or the bin-level options) skips straight to the finishing stage.
+    # With return_model=True the pre-denoise model is returned alongside the matrix.
+    model_params = {
+        'epsilon': epsilon,
+        'max_iter': max_iter,
+        'tolerance': tolerance,
+        'warm_start': warm_start,
+        'fit_mode': fit_mode,
+        'sample_size': sample_size,
+        'grid_bins': grid_bins
+    }
     try:
-        if method == 'Raw':
-            logger.info("Running Raw normalization.")
-            return denoise(contact_matrix, threshold)
-
-        elif method == 'normCC':
-            logger.info("Running normCC normalization.")
-            signal = contact_matrix.max(axis=1).toarray().ravel()
-            coverage = contig_df['Contig coverage'].values
-            contact_matrix.setdiag(0)
-
-            df = contig_df.copy()
-            df['Contig coverage'] = coverage
-            df['signal'] = signal
-
-            logger.info("Performing log transformations for normCC.")
-            df['log_site'] = np.log(df['The number of restriction sites'] + epsilon)
-            df['log_len'] = np.log(df['Contig length'])
-            df['log_coverage'] = np.log(df['Contig coverage'] + epsilon)
-
-            exog = df[['log_site', 'log_len', 'log_coverage']]
-            exog = sm.add_constant(exog)
-            endog = df['signal']
-            glm_nb = sm.GLM(endog, exog, family=sm.families.NegativeBinomial(alpha=1))
-            res = glm_nb.fit()
-
-            expected_signal = np.exp(np.dot(exog, res.params))
-            scal = np.max(expected_signal)
-
-            normalized_data = [scal * v / np.sqrt(expected_signal[i] * expected_signal[j])
-                               for i, j, v in zip(contact_matrix.row, contact_matrix.col, contact_matrix.data)]
-
-            normalized_matrix = coo_matrix((normalized_data, (contact_matrix.row, contact_matrix.col)),
-                                           shape=contact_matrix.shape)
-            return denoise(normalized_matrix, threshold)
-
-        elif method == 'HiCzin':
-            logger.info("Running HiCzin normalization.")
-            contact_matrix.setdiag(0)
-            coverage = contig_df['Contig coverage'].replace(0, epsilon).values
-
-            map_x = contact_matrix.row
-            map_y = contact_matrix.col
-            map_data = contact_matrix.data
-            index = map_x < map_y
-            map_x, map_y, map_data = map_x[index], map_y[index], map_data[index]
-
-            sample_site = standardize(np.log(contig_df['The number of restriction sites'].iloc[map_x].values * contig_df['The number of restriction sites'].iloc[map_y].values))
-            sample_len = standardize(np.log(contig_df['Contig length'].iloc[map_x].values * contig_df['Contig length'].iloc[map_y].values))
-            sample_cov = standardize(np.log(coverage[map_x] * coverage[map_y]))
-
-            data_hiczin = pd.DataFrame({
-                'sample_site': sample_site,
-                'sample_len': sample_len,
-                'sample_cov': sample_cov,
-                'sampleCon': map_data
-            })
-
-            exog = data_hiczin[['sample_site', 'sample_len', 'sample_cov']]
-            exog = sm.add_constant(exog)
-            endog = data_hiczin['sampleCon']
-
-            glm_nb = sm.GLM(endog, exog, family=sm.families.NegativeBinomial(alpha=1))
-            res = glm_nb.fit()
-
-            expected_signal = np.exp(np.dot(exog, res.params))
-            normalized_data = map_data / expected_signal
-
-            normalized_contact_matrix = coo_matrix(
-                (normalized_data, (map_x, map_y)), shape=contact_matrix.shape
-            )
-            normalized_contact_matrix += normalized_contact_matrix.transpose()
-
-            return denoise(normalized_contact_matrix, threshold)
-
-        elif method == 'bin3C':
-            logger.info("Running bin3C normalization.")
-            num_sites = contig_df['The number of restriction sites'].values + epsilon
-            normalized_data = [v / (num_sites[i] * num_sites[j])
-                               for i, j, v in zip(contact_matrix.row, contact_matrix.col, contact_matrix.data)]
-
-            normalized_contact_matrix = coo_matrix(
-                (normalized_data, (contact_matrix.row, contact_matrix.col)), shape=contact_matrix.shape
-            )
-
-            bistochastic_matrix = _bisto_seq(normalized_contact_matrix, max_iter, tolerance)
-            return denoise(bistochastic_matrix, threshold)
-
-        elif method == 'MetaTOR':
-            logger.info("Running MetaTOR normalization.")
-            signal = contact_matrix.diagonal() + epsilon
-            normalized_data = [v / np.sqrt(signal[i] * signal[j])
-                               for i, j, v in zip(contact_matrix.row, contact_matrix.col, contact_matrix.data)]
-
-            normalized_contact_matrix = coo_matrix(
-                (normalized_data, (contact_matrix.row, contact_matrix.col)), shape=contact_matrix.shape
-            )
-
-            return denoise(normalized_contact_matrix, threshold)
+        use_cache = use_cache and method != 'Raw'
+        key = normalization_cache_key(method, contig_df, contact_matrix, **model_params) if use_cache else None
+        model = NORMALIZATION_CACHE.get(key) if use_cache else None
+
+        if model is None:
+            model = fit_normalization_model(method, contig_df, contact_matrix, **model_params)
+            cached = use_cache and NORMALIZATION_CACHE.put(key, model)
+        else:
+            logger.info(f"Reusing cached {method} normalization model.")
+            cached = True
+
+        # Finishing stage; cached or returned matrices must stay intact for the next threshold
+        normalized_matrix, threshold_value, divisor = denoise(
+            model['matrix'], threshold, in_place=model['owned'] and not cached and not return_model, return_cut=True
+        )
+        if not return_model:
+            return normalized_matrix
+        if model.get('factorized') is not None:
+            model = dict(model, factorized=model['factorized'].with_cut(threshold_value, divisor))
+        return normalized_matrix, model
 
     except Exception as e:
         logger.error(f"Error during {method} normalization: {e}")
-        return None
-
-def generating_bin_information(contig_info, contact_matrix, remove_unclassified_contigs=False, remove_host_host=False):
-    dense_matrix = contact_matrix.toarray()
-
-    # Handle unclassified contigs
-    if remove_unclassified_contigs:
-        unclassified_contigs = contig_info[contig_info['Category'] == "unclassified"].index.tolist()
-        contig_info = contig_info.drop(unclassified_contigs).reset_index(drop=True)
-        
-        # Mask for rows/columns to keep
-        keep_mask = np.ones(dense_matrix.shape[0], dtype=bool)
-        keep_mask[unclassified_contigs] = False
-        dense_matrix = dense_matrix[keep_mask, :][:, keep_mask]
+        return (None, None) if return_model else None
 
-    # Identify columns for aggregation
+def bin_table(contig_info):
+    # Bin-level information table, sorted by category (virus, plasmid, chromosome)
+    # Identify columns for aggregation; contig membership is kept as offset arrays (AnnotationIndex)
     known_agg = {
-        'Contig index': lambda x: ', '.join(x),
         'The number of restriction sites': 'sum',
         'Contig length': 'sum',
-        'Contig coverage': lambda x: (x * contig_info.loc[x.index, 'Contig length']).sum() / 
-                                     contig_info.loc[x.index, 'The number of restriction sites'].sum()
+        'Contig coverage': 'first'
     }
-    unknown_columns = [col for col in contig_info.columns if col not in known_agg]
+    unknown_columns = [col for col in contig_info.columns if col not in known_agg and col != 'Contig index']
     
     # Apply 'first' aggregation for unknown columns
     for col in unknown_columns:
         known_agg[col] = 'first'
 
     # Aggregate bin data
-    bin_info = contig_info.groupby('Bin index', as_index=False).agg(known_agg)
+    grouped = contig_info.groupby('Bin index', as_index=False)
+    bin_info = grouped.agg(known_agg)
+
+    # Length-weighted coverage over the bin's restriction sites, as per-group sums
+    codes = grouped.ngroup().values
+    weighted = np.bincount(codes, weights=contig_info['Contig coverage'].values * contig_info['Contig length'].values,
+                           minlength=len(bin_info))
+    sites = np.bincount(codes, weights=contig_info['The number of restriction sites'].values, minlength=len(bin_info))
+    bin_info['Contig coverage'] = weighted / sites
     bin_info['Contig coverage'] = bin_info['Contig coverage'].astype(float).map("{:.2f}".format)
 
     # Create a mapping for temporary renaming
@@ -332,57 +297,91 @@ def generating_bin_information(contig_info, contact_matrix, remove_unclassified_
     bin_info['Category'] = bin_info['Category'].replace(rename_map)
     bin_info = bin_info.sort_values(by='Category', ascending=True)
     bin_info['Category'] = bin_info['Category'].replace(reverse_map)
+    return bin_info
 
-    unique_bins = bin_info['Bin index']
-    bin_indexes_dict = get_indexes(unique_bins, contig_info, 'Bin index')
-    host_bin = bin_info[bin_info['Category'] == 'chromosome']['Bin index'].tolist()
-    non_host_bin = bin_info[~bin_info['Category'].isin(['chromosome'])]['Bin index'].tolist()
-    
-    # Combine pairs of all necessary interactions
+def listed_direction(bin_info, rows, cols, remove_host_host=False):
+    # Each unordered pair keeps the sum taken in the direction it was listed: host bin first
+    # for host/non-host pairs, otherwise the bin that comes first in the sorted table
+    host_bin = (bin_info['Category'] == 'chromosome').values
     if remove_host_host:
-        bin_non_host_pairs = list(combinations(non_host_bin, 2))
-        bin_host_non_host_pairs = list(product(host_bin, non_host_bin))
-        bin_all_pairs = bin_non_host_pairs + bin_host_non_host_pairs
-    else:
-        bin_all_pairs = list(combinations(unique_bins, 2))
-
-    results = Parallel(n_jobs=-1)( 
-        delayed(calculate_submatrix_sum)(pair, bin_indexes_dict, dense_matrix) for pair in bin_all_pairs
-    )
-
-    # Initialize lists to store row indices, column indices, and values
-    rows = []
-    cols = []
-    data = []
-    
-    for annotation_i, annotation_j, value in results:
-        if annotation_i == annotation_j:
-            value = 0  # Set value to 0 for diagonal elements (self-connections)
-        
-        # Add entries to COO format lists
-        rows.append(annotation_i)
-        cols.append(annotation_j)
-        data.append(value)
-        
-        rows.append(annotation_j)
-        cols.append(annotation_i)
-        data.append(value)
-    
-    # Map annotations to numerical indices if necessary
-    bin_index_to_position = {bin_index: idx for idx, bin_index in enumerate(unique_bins)}
-    row_indices = [bin_index_to_position[annotation] for annotation in rows]
-    col_indices = [bin_index_to_position[annotation] for annotation in cols]
-    
-    # Create the COO sparse matrix
-    bin_contact_matrix = coo_matrix((data, (row_indices, col_indices)), shape=(len(unique_bins), len(unique_bins)))
+        return np.where(host_bin[rows] != host_bin[cols], host_bin[rows], (rows < cols) & ~host_bin[rows])
+    return rows < cols
+
+def bin_contacts(bin_info, bin_sums, remove_host_host=False):
+    # Symmetric bin contact matrix from the bin-level sums P^T A P (in bin_info order),
+    # with the connected bin counts added to bin_info
+    # The sums are not used afterwards, so the COO view shares their index and value arrays
+    bin_sums = bin_sums.tocoo(copy=False)
+    rows, cols, data = bin_sums.row, bin_sums.col, bin_sums.data
+    # Zero sums are dropped here rather than from the symmetric matrix, which would copy it
+    first = listed_direction(bin_info, rows, cols, remove_host_host) & (data != 0)
+    rows, cols, data = rows[first], cols[first], data[first]
+
+    # Every kept pair is off the diagonal and listed once, so each bin's connections are counted on both sides
+    n_bins = len(bin_info)
+    connected_bins = np.bincount(rows, minlength=n_bins) + np.bincount(cols, minlength=n_bins)
+
+    # Create the symmetric COO sparse matrix
+    bin_contact_matrix = coo_matrix((np.concatenate([data, data]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                                    shape=(n_bins, n_bins))
     
     bin_info=bin_info.reset_index(drop=True)
     
-    bin_info['Connected bins'] = np.count_nonzero(bin_contact_matrix.toarray(), axis=1)
+    bin_info['Connected bins'] = connected_bins
     bin_info['Visibility'] = 1
 
     return bin_info, bin_contact_matrix
 
+def generating_bin_information(contig_info, contact_matrix, remove_unclassified_contigs=False, remove_host_host=False):
+    contact_matrix = contact_matrix.tocsr()
+
+    # Handle unclassified contigs
+    if remove_unclassified_contigs:
+        unclassified_contigs = contig_info[contig_info['Category'] == "unclassified"].index.tolist()
+        contig_info = contig_info.drop(unclassified_contigs).reset_index(drop=True)
+        
+        # Mask for rows/columns to keep
+        keep_mask = np.ones(contact_matrix.shape[0], dtype=bool)
+        keep_mask[unclassified_contigs] = False
+        contact_matrix = contact_matrix[keep_mask, :][:, keep_mask]
+
+    bin_info = bin_table(contig_info)
+
+    # Bin-level sums of every bin pair as one sparse product P^T A P
+    bin_sums = aggregate_contacts(contact_matrix, AnnotationIndex(contig_info['Bin index'], bin_info['Bin index']).indicator())
+    return bin_contacts(bin_info, bin_sums, remove_host_host)
+
+def generating_bin_information_out_of_core(contig_info, matrix_path, remove_unclassified_contigs=False,
+                                           remove_host_host=False, budget=None):
+    # generating_bin_information for a contig matrix stored in `matrix_path`, which is never loaded:
+    # P^T A P is accumulated chunk by chunk (chunks sized from the out-of-core budget), so memory
+    # grows with the bin matrix and the contig table instead of the contig matrix
+    keep_mask = np.ones(len(contig_info), dtype=bool)
+    if remove_unclassified_contigs:
+        keep_mask = (contig_info['Category'] != "unclassified").values
+        contig_info = contig_info[keep_mask].reset_index(drop=True)
+
+    bin_info = bin_table(contig_info)
+    n_bins = len(bin_info)
+
+    # Bin position of every contig of the stored matrix, -1 for removed contigs
+    bin_codes = np.full(len(keep_mask), -1, dtype=np.int32)
+    bin_codes[keep_mask] = AnnotationIndex(contig_info['Bin index'], bin_info['Bin index']).codes
+
+    # Half of the budget goes to the chunks, the other half to the running bin sums and their merge
+    chunk_size = max(1024, chunk_entries(len(keep_mask), budget) // 2)
+    bin_sums = None
+    for row, col, data in iter_npz_entries(matrix_path, chunk_size):
+        bin_row, bin_col = bin_codes[row], bin_codes[col]
+        kept = (bin_row >= 0) & (bin_col >= 0)
+        # Only the direction bin_contacts keeps is summed, which halves the running sums
+        kept[kept] = listed_direction(bin_info, bin_row[kept], bin_col[kept], remove_host_host)
+        chunk = coo_matrix((data[kept], (bin_row[kept], bin_col[kept])), shape=(n_bins, n_bins)).tocsr()
+        bin_sums = chunk if bin_sums is None else bin_sums + chunk
+    if bin_sums is None:
+        bin_sums = coo_matrix((n_bins, n_bins))
+    return bin_contacts(bin_info, bin_sums, remove_host_host)
+
 def create_normalization_layout():
     methods = [
         {
@@ -447,7 +446,9 @@ def create_normalization_layout():
                     value=5,
                     placeholder="Threshold percentage (0-100)",
                     style={'width': '100%'}
-                )
+                ),
+                # Live preview of what the threshold keeps, available once the method has run
+                html.Div(id='thres-preview', className="mt-2")
             ], id='thres-container', className="my-3"),
 
             # Max iterations input
@@ -472,7 +473,50 @@ def create_normalization_layout():
                     placeholder="Tolerance for convergence",
                     style={'width': '100%'}
                 )
-            ], id='tol-container', className="my-3")
+            ], id='tol-container', className="my-3"),
+
+            # GLM fitting mode
+            html.Div([
+                html.Label("GLM Fitting Mode (default: Exact): Fit the bias model on all contig pairs, or on a stratified subsample for large datasets."),
+                dcc.Dropdown(
+                    id='glm-mode',
+                    options=[
+                        {'label': 'Exact - fit on all contig pairs', 'value': 'exact'},
+                        {'label': 'Subsample - fit on a stratified subsample, checked against a second subsample', 'value': 'subsample'},
+                        {'label': 'Grouped - fit per-cell sufficient statistics of quantized covariates', 'value': 'grouped'}
+                    ],
+                    value='exact',
+                    clearable=False,
+                    style={'width': '100%'}
+                )
+            ], id='glm-mode-container', className="my-3"),
+
+            # Subsample size input
+            html.Div([
+                html.Label("Subsample Size (default: 200000): Number of contig pairs in each subsample when fitting in Subsample mode."),
+                dcc.Input(
+                    id='sample-size-input',
+                    type='number',
+                    value=200000,
+                    placeholder="Number of contig pairs per subsample",
+                    style={'width': '100%'}
+                )
+            ], id='sample-size-container', className="my-3"),
+
+            # Grid resolution input
+            html.Div([
+                html.Label("Grid Bins (default: 64): Number of quantization bins per covariate when fitting in Grouped mode. More bins move the fit closer to the exact one."),
+                dcc.Input(
+                    id='grid-bins-input',
+                    type='number',
+                    value=64,
+                    min=2,
+                    max=MAX_GRID_BINS,
+                    step=1,
+                    placeholder="Quantization bins per covariate",
+                    style={'width': '100%'}
+                )
+            ], id='grid-bins-container', className="my-3")
 
         ], id='normalization-parameters', className="my-3"),
         
@@ -503,6 +547,40 @@ def create_normalization_layout():
             ], style={'font-size': 'small', 'line-height': '1.5'}),
         ], style={'font-style': 'italic', 'marginTop': '20px'}),
 
+        html.Hr(),
+        html.H2("Compare Normalization Methods", className="mt-4"),
+        html.P("Run the selected methods side by side with the parameters above and compare the absolute Pearson "
+               "correlations between the normalized contacts and the product of each explicit bias factor. "
+               "Lower correlations mean the bias has been removed more thoroughly.", className="mt-3"),
+        html.Div([
+            dcc.Checklist(
+                id='batch-methods',
+                options=[{'label': f'  {method}', 'value': method} for method in BATCH_METHODS],
+                value=BATCH_METHODS,
+                inline=True,
+                inputStyle={'margin-left': '15px'}
+            ),
+            html.Button("Compare Methods", id="batch-button", className="btn btn-secondary", style={'marginTop': '10px'})
+        ], className="my-3"),
+        dcc.Loading(
+            type="default",
+            children=dash_table.DataTable(
+                id='batch-comparison-table',
+                columns=[
+                    {"name": "Method", "id": "Method"},
+                    {"name": "Site", "id": "Site"},
+                    {"name": "Length", "id": "Length"},
+                    {"name": "Coverage", "id": "Coverage"},
+                    {"name": "Retained Contacts", "id": "Contacts"},
+                    {"name": "Seconds", "id": "Seconds"}
+                ],
+                data=[],
+                style_table={'overflowY': 'auto'},
+                style_header={'backgroundColor': 'rgb(210, 210, 210)', 'fontWeight': 'bold'},
+                style_cell={'textAlign': 'left', 'padding': '10px', 'fontFamily': 'Arial'},
+            )
+        ),
+
         html.Hr(),
         html.H2("Additional Options", className="mt-4", style={'marginTop': '40px'}),
         
@@ -545,17 +623,24 @@ def register_normalization_callbacks(app):
     @app.callback(
         [Output('thres-container', 'style'),
          Output('max-iter-container', 'style'),
-         Output('tol-container', 'style')],
-        Input('normalization-method', 'value')
+         Output('tol-container', 'style'),
+         Output('glm-mode-container', 'style'),
+         Output('sample-size-container', 'style'),
+         Output('grid-bins-container', 'style')],
+        [Input('normalization-method', 'value'),
+         Input('glm-mode', 'value')]
     )
 
-    def update_parameters(normalization_method):
+    def update_parameters(normalization_method, glm_mode):
         # Determine styles based on the selected normalization method
         thres_style = {'display': 'block'} if normalization_method in ['Raw', 'normCC', 'HiCzin', 'bin3C', 'MetaTOR'] else {'display': 'none'}
         max_iter_style = {'display': 'block'} if normalization_method == 'bin3C' else {'display': 'none'}
         tol_style = {'display': 'block'} if normalization_method == 'bin3C' else {'display': 'none'}
+        glm_mode_style = {'display': 'block'} if normalization_method in ['normCC', 'HiCzin'] else {'display': 'none'}
+        sample_size_style = {'display': 'block'} if normalization_method in ['normCC', 'HiCzin'] and glm_mode == 'subsample' else {'display': 'none'}
+        grid_bins_style = {'display': 'block'} if normalization_method in ['normCC', 'HiCzin'] and glm_mode == 'grouped' else {'display': 'none'}
         
-        return thres_style, max_iter_style, tol_style
+        return thres_style, max_iter_style, tol_style, glm_mode_style, sample_size_style, grid_bins_style
 
     @app.callback(
         [Output('normalization-status', 'data'),
@@ -565,6 +650,9 @@ def register_normalization_callbacks(app):
          State('thres-input', 'value'),
          State('max-iter-input', 'value'),
          State('tol-input', 'value'),
+         State('glm-mode', 'value'),
+         State('sample-size-input', 'value'),
+         State('grid-bins-input', 'value'),
          State('remove-unclassified-contigs', 'value'),
          State('remove-host-host', 'value'),
          State('user-folder', 'data'),
@@ -573,7 +661,7 @@ def register_normalization_callbacks(app):
         prevent_initial_call=True
     )
 
-    def execute_normalization(n_clicks, normalization_method, threshold, max_iter, tolerance,
+    def execute_normalization(n_clicks, normalization_method, threshold, max_iter, tolerance, glm_mode, sample_size, grid_bins,
                               remove_unclassified_contigs, remove_host_host, user_folder, selected_method, current_stage):
         # Only trigger if in the 'Normalization' stage for the selected methods
         if not n_clicks or selected_method not in ['method1', 'method2'] or current_stage != 'Normalization':
@@ -585,71 +673,122 @@ def register_normalization_callbacks(app):
         threshold = threshold if threshold is not None else 5
         max_iter = max_iter if max_iter is not None else 1000
         tolerance = tolerance if tolerance is not None else 1e-6
+        glm_mode = glm_mode if glm_mode is not None else 'exact'
+        sample_size = sample_size if sample_size is not None else 200000
+        grid_bins = clamp_grid_bins(grid_bins if grid_bins is not None else 64)
     
         # Convert checkbox values to booleans
         remove_unclassified_contigs = 'remove_unclassified' in remove_unclassified_contigs
         remove_host_host = 'remove_host' in remove_host_host
+
+        # Read before any file is written; without it only the background precompute is skipped
+        try:
+            taxonomy_levels = load_from_redis(f'{user_folder}:taxonomy-levels')
+        except KeyError:
+            logger.warning("No taxonomy levels stored for this session, skipping the contact matrix precompute.")
+            taxonomy_levels = None
         
-        contig_info, contact_matrix = preprocess_normalization(user_folder)
-        
-        if contig_info is None or contact_matrix is None:
-            logger.error("Error reading files from folder. Please check the uploaded data.")
-            return False, ""
-    
-        # Define normalization parameters based on the selected method
-        normalization_params = {
-            "method": normalization_method,
-            "contig_df": contig_info,
-            "contact_matrix": contact_matrix,
+        # Define the output paths
+        user_output_path = f'output/{user_folder}'
+        os.makedirs(user_output_path, exist_ok=True)
+
+        bin_info_final_path = os.path.join(user_output_path, 'bin_info_final.csv')
+        bin_contact_matrix_path = os.path.join(user_output_path, 'normalized_bin_matrix.npz')
+        bin_membership_path = os.path.join(user_output_path, 'bin_membership.npz')
+        contig_info_path = os.path.join(user_output_path, 'contig_info_final.csv')
+        normalized_matrix_path = os.path.join(user_output_path, 'normalized_contig_matrix.npz')
+        unnormalized_matrix_path = os.path.join(user_output_path, 'unnormalized_contig_matrix.npz')
+
+        model_params = {
             "epsilon": 1,
             "threshold": threshold,
             "max_iter": max_iter,
-            "tolerance": tolerance
+            "tolerance": tolerance,
+            "fit_mode": glm_mode,
+            "sample_size": sample_size,
+            "grid_bins": grid_bins
         }
-    
-        # Run normalization
-        normalized_matrix = run_normalization(**normalization_params)
-        if normalized_matrix is None or normalized_matrix.nnz == 0:
-            logger.error("Normalization failed or produced an empty matrix.")
-            return False, ""
+
+        if os.path.exists(unnormalized_matrix_path) and needs_out_of_core(unnormalized_matrix_path):
+            # Too large for the in-memory methods: stream the matrix from disk in chunks and
+            # write the denoised result straight to its output file
+            contig_info = pd.read_csv(contig_info_path)
+            try:
+                kept = run_out_of_core_normalization(normalization_method, contig_info, unnormalized_matrix_path,
+                                                     normalized_matrix_path, **model_params)
+            except Exception as e:
+                logger.error(f"Error during out-of-core {normalization_method} normalization: {e}")
+                return False, ""
+            # The normalized matrix stays on disk, the bin aggregation streams it as well. It is kept
+            # as a matrix rather than factors, and no preview index is built: both need the whole matrix.
+            normalized_matrix = None
+            contact_matrix = None
+            inputs = None
+            if kept == 0:
+                logger.error("Normalization failed or produced an empty matrix.")
+                return False, ""
+        else:
+            contig_info, contact_matrix = preprocess_normalization(user_folder)
+
+            if contig_info is None or contact_matrix is None:
+                logger.error("Error reading files from folder. Please check the uploaded data.")
+                return False, ""
+
+            # Run normalization
+            normalized_matrix, model = run_normalization(normalization_method, contig_info, contact_matrix,
+                                                         **model_params, return_model=True)
+            if normalized_matrix is None or normalized_matrix.nnz == 0:
+                logger.error("Normalization failed or produced an empty matrix.")
+                return False, ""
+
+            # Index the pre-denoise values so other thresholds can be previewed instantly. The index
+            # belongs to this model: it is keyed like the model cache, by inputs digest and parameters.
+            inputs = normalization_inputs_digest(contig_info, contact_matrix)
+            THRESHOLD_PREVIEWS.put(threshold_preview_key(user_folder, normalization_method, inputs, max_iter, tolerance,
+                                                         glm_mode, sample_size, grid_bins),
+                                   ThresholdPreview(model['matrix'], contig_info['Bin index'].values))
     
         logger.info(f"Normalization for {normalization_method} completed successfully.")
     
         # Perform bin information generation after normalization
         logger.info("Generating bin level information table and contact matrix...")
-        bin_info, bin_contact_matrix = generating_bin_information(
-            contig_info,
-            normalized_matrix,
-            remove_unclassified_contigs,
-            remove_host_host
-        )
+        if normalized_matrix is None:
+            bin_info, bin_contact_matrix = generating_bin_information_out_of_core(
+                contig_info,
+                normalized_matrix_path,
+                remove_unclassified_contigs,
+                remove_host_host
+            )
+        else:
+            bin_info, bin_contact_matrix = generating_bin_information(
+                contig_info,
+                normalized_matrix,
+                remove_unclassified_contigs,
+                remove_host_host
+            )
         logger.info("Bin information generation completed successfully.")
         
-        # Define the output path and save the files individually
-        user_output_path = f'output/{user_folder}'
-        os.makedirs(user_output_path, exist_ok=True)
-    
-        bin_info_final_path = os.path.join(user_output_path, 'bin_info_final.csv')
-        bin_contact_matrix_path = os.path.join(user_output_path, 'normalized_bin_matrix.npz')
-        contig_info_path = os.path.join(user_output_path, 'contig_info_final.csv')
-        normalized_matrix_path = os.path.join(user_output_path, 'normalized_contig_matrix.npz')
-        unnormalized_matrix_path = os.path.join(user_output_path, 'unnormalized_contig_matrix.npz')
-    
-        # Save each file
+        # Save each file (the out-of-core path has already written the normalized matrix)
         bin_info.to_csv(bin_info_final_path, index=False)
         save_npz(bin_contact_matrix_path, bin_contact_matrix)
+        # Rows of contig_info_final.csv in each bin: contigs[offsets[k]:offsets[k + 1]] for bins[k]
+        membership = AnnotationIndex(contig_info['Bin index'], bin_info['Bin index'])
+        np.savez(bin_membership_path, bins=bin_info['Bin index'].values.astype(str), offsets=membership.offsets,
+                 contigs=membership.positions)
         contig_info.to_csv(contig_info_path, index=False)
-        save_npz(normalized_matrix_path, normalized_matrix)
-        save_npz(unnormalized_matrix_path, contact_matrix)
-
-        # Compress saved files into normalized_information.7z
-        normalized_archive_path = os.path.join(user_output_path, 'normalized_information.7z')
-        with py7zr.SevenZipFile(normalized_archive_path, 'w') as archive:
-            archive.write(bin_info_final_path, 'bin_info_final.csv')
-            archive.write(bin_contact_matrix_path, 'normalized_bin_matrix.npz')
-            archive.write(contig_info_path, 'contig_info_final.csv')
-            archive.write(normalized_matrix_path, 'normalized_contig_matrix.npz')
-            archive.write(unnormalized_matrix_path, 'unnormalized_contig_matrix.npz')
+        factors_path = os.path.join(user_output_path, FACTORS_FILE)
+        stale_path = factors_path
+        if contact_matrix is not None:
+            save_npz(unnormalized_matrix_path, contact_matrix)
+            if model.get('factorized') is not None:
+                # Only the per-contig factors are stored; the normalized matrix is rebuilt from the raw one
+                model['factorized'].save(factors_path)
+                stale_path = normalized_matrix_path
+            else:
+                save_npz(normalized_matrix_path, normalized_matrix)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+        # normalized_information.7z is built on the first download (stages.archive)
     
         logger.info("File saving completed successfully.")
     
@@ -659,7 +798,122 @@ def register_normalization_callbacks(app):
         
         save_to_redis(bin_info_key, bin_info)       
         save_to_redis(bin_matrix_key, bin_contact_matrix)
+        # Lets the threshold preview find this run's index, as long as the input files are unchanged
+        save_to_redis(f'{user_folder}:normalization-inputs',
+                      {'digest': inputs, 'version': artifact_version(user_output_path, PREVIEW_INPUTS)})
         
         logger.info("Data loaded and saved to Redis successfully.")
+
+        # Taxonomy level contact matrices for the visualization stage, built in the background
+        if taxonomy_levels:
+            start_annotation_precompute(user_folder, bin_info, bin_contact_matrix, taxonomy_levels)
         
-        return True, ""
\ No newline at end of file
+        return True, ""
+
+    @app.callback(
+        Output('batch-comparison-table', 'data'),
+        [Input('batch-button', 'n_clicks')],
+        [State('batch-methods', 'value'),
+         State('thres-input', 'value'),
+         State('max-iter-input', 'value'),
+         State('tol-input', 'value'),
+         State('glm-mode', 'value'),
+         State('sample-size-input', 'value'),
+         State('grid-bins-input', 'value'),
+         State('user-folder', 'data'),
+         State('current-method', 'data'),
+         State('current-stage', 'data')],
+        prevent_initial_call=True
+    )
+
+    def compare_normalization_methods(n_clicks, methods, threshold, max_iter, tolerance, glm_mode, sample_size, grid_bins,
+                                      user_folder, selected_method, current_stage):
+        if not n_clicks or not methods or selected_method not in ['method1', 'method2'] or current_stage != 'Normalization':
+            raise PreventUpdate
+
+        # Files are read once; the matrix and contig features are shared with every worker
+        contig_info, contact_matrix = preprocess_normalization(user_folder)
+        if contig_info is None or contact_matrix is None:
+            logger.error("Error reading files from folder. Please check the uploaded data.")
+            return []
+
+        try:
+            comparison = run_normalization_batch(
+                methods,
+                contig_info,
+                contact_matrix,
+                session=user_folder,
+                epsilon=1,
+                threshold=threshold if threshold is not None else 5,
+                max_iter=max_iter if max_iter is not None else 1000,
+                tolerance=tolerance if tolerance is not None else 1e-6,
+                fit_mode=glm_mode if glm_mode is not None else 'exact',
+                sample_size=sample_size if sample_size is not None else 200000,
+                grid_bins=clamp_grid_bins(grid_bins if grid_bins is not None else 64)
+            )
+        except SchedulerBusy as e:
+            logger.error(str(e))
+            return []
+        logger.info("Batch normalization comparison completed.")
+
+        return comparison.to_dict('records')
+
+    @app.callback(
+        Output('thres-preview', 'children'),
+        [Input('thres-input', 'value'),
+         Input('normalization-method', 'value'),
+         Input('max-iter-input', 'value'),
+         Input('tol-input', 'value'),
+         Input('glm-mode', 'value'),
+         Input('sample-size-input', 'value'),
+         Input('grid-bins-input', 'value'),
+         Input('normalization-status', 'data')],
+        [State('user-folder', 'data')]
+    )
+
+    def preview_threshold(threshold, normalization_method, max_iter, tolerance, glm_mode, sample_size, grid_bins,
+                          normalization_status, user_folder):
+        if not user_folder or not normalization_method:
+            raise PreventUpdate
+
+        # Only a model fitted with the current parameters on the current inputs can be previewed
+        try:
+            stored = load_from_redis(f'{user_folder}:normalization-inputs')
+        except KeyError:
+            stored = None
+        current = stored is not None and stored['version'] == artifact_version(f'output/{user_folder}', PREVIEW_INPUTS)
+        if current and stored['digest'] is None:
+            return html.Small("Threshold previews are not available for matrices normalized out of core.",
+                              style={'color': '#777'})
+        inputs = stored['digest'] if current else None
+        preview = None if inputs is None else THRESHOLD_PREVIEWS.get(threshold_preview_key(
+            user_folder, normalization_method, inputs,
+            max_iter if max_iter is not None else 1000,
+            tolerance if tolerance is not None else 1e-6,
+            glm_mode if glm_mode is not None else 'exact',
+            sample_size if sample_size is not None else 200000,
+            clamp_grid_bins(grid_bins if grid_bins is not None else 64)
+        ))
+        if preview is None:
+            return html.Small(f"Run {normalization_method} with these settings to preview how many contacts each threshold keeps.",
+                              style={'color': '#777'})
+
+        threshold = threshold if threshold is not None else 5
+        if not 0 <= threshold <= 100:
+            return html.Small("The threshold must be between 0 and 100.", style={'color': '#c00'})
+
+        summary = preview.summary(threshold)
+        text = (f"Preview from the last {normalization_method} run: contacts above {summary['threshold_value']:.4g} are kept, "
+                f"retaining {summary['retained_nnz']:,} of {preview.n:,} nonzero entries "
+                f"({summary['connected_contigs']:,} connected contigs")
+        if 'mean_edges_per_bin' in summary:
+            text += f", {summary['mean_edges_per_bin']:.1f} retained edges per bin on average, median {summary['median_edges_per_bin']:.1f}"
+        text += ")."
+
+        figure = px.bar(summary['degree_distribution'], x='Degree', y='Contigs', height=180)
+        figure.update_layout(margin=dict(l=10, r=10, t=10, b=10), xaxis_title="Retained contacts per contig", yaxis_title="Contigs")
+
+        return html.Div([
+            html.Small(text),
+            dcc.Graph(figure=figure, config={'displayModeBar': False}, style={'height': '180px'})
+        ])
@@ -0,0 +1,333 @@
+import os
+import time
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import spdiags, isspmatrix_csr, csr_matrix
+from stages.scheduler import COMPUTE_WORKERS
+
+try:
+    from scipy.sparse._sparsetools import csr_matvec
+except ImportError:  # Private scipy API, fall back to m.dot when unavailable
+    csr_matvec = None
+
+try:
+    import numba
+except ImportError:  # Optional JIT backend
+    numba = None
+
+logger = logging.getLogger("app_logger")
+
+# Number of threads used by the bin3C SpMV kernel, override with SPMV_THREADS. Balancing runs
+# inside a compute scheduler worker, so by default each worker gets its share of the cores.
+SPMV_THREADS = int(os.getenv("SPMV_THREADS", max(1, (os.cpu_count() or 1) // COMPUTE_WORKERS)))
+# Row blocks smaller than this many nonzeros are not worth a thread hand-off
+MIN_BLOCK_NNZ = 200000
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _numba_csr_matvec(indptr, indices, data, x, out):
+        for i in numba.prange(out.shape[0]):
+            acc = 0.0
+            for jj in range(indptr[i], indptr[i + 1]):
+                acc += data[jj] * x[indices[jj]]
+            out[i] = acc
+        return out
+
+def partition_rows(indptr, n_blocks):
+    # Split the rows into contiguous blocks holding roughly the same number of nonzeros
+    nnz = indptr[-1]
+    targets = np.linspace(0, nnz, n_blocks + 1)[1:-1]
+    cuts = np.searchsorted(indptr, targets, side='left')
+    bounds = np.unique(np.concatenate(([0], cuts, [len(indptr) - 1])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+class ParallelSpMV:
+    # Row-partitioned sparse matrix-vector product for CSR matrices.
+    # Each thread runs scipy's csr_matvec kernel (which releases the GIL) on its own
+    # block of rows, writing straight into its slice of the output vector. The numba
+    # backend is used instead when it is installed and requested.
+    def __init__(self, m, n_threads=None, backend='auto'):
+        if not isspmatrix_csr(m):
+            m = m.tocsr()
+        self.m = m
+        self.shape = m.shape
+        n_threads = SPMV_THREADS if n_threads is None else max(1, int(n_threads))
+
+        if backend == 'auto':
+            backend = 'numba' if numba is not None and n_threads > 1 else 'threads'
+        if backend == 'numba' and numba is None:
+            logger.warning("numba is not installed, falling back to threaded SpMV.")
+            backend = 'threads'
+        self.backend = backend
+
+        n_blocks = min(n_threads, max(1, m.nnz // MIN_BLOCK_NNZ))
+        if csr_matvec is None:
+            n_blocks = 1
+        self.blocks = partition_rows(m.indptr, n_blocks)
+        self.n_threads = len(self.blocks) if backend == 'threads' else min(n_threads, numba.config.NUMBA_NUM_THREADS)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.blocks)) if backend == 'threads' and len(self.blocks) > 1 else None
+
+    def _block_matvec(self, r0, r1, x, out):
+        m = self.m
+        block_out = out[r0:r1]
+        block_out.fill(0)
+        # indptr keeps absolute offsets, so indices and data are passed without slicing
+        csr_matvec(r1 - r0, m.shape[1], m.indptr[r0:r1 + 1], m.indices, m.data, x, block_out)
+
+    def __call__(self, x, out=None):
+        if out is None:
+            out = np.empty(self.shape[0])
+        m = self.m
+        if self.backend == 'numba':
+            # numba's thread count is process wide, so it is only changed for this product
+            previous = numba.get_num_threads()
+            numba.set_num_threads(self.n_threads)
+            try:
+                return _numba_csr_matvec(m.indptr, m.indices, m.data, x, out)
+            finally:
+                numba.set_num_threads(previous)
+        if csr_matvec is None:
+            out[:] = m.dot(x)
+            return out
+        if self._executor is None:
+            for r0, r1 in self.blocks:
+                self._block_matvec(r0, r1, x, out)
+            return out
+        futures = [self._executor.submit(self._block_matvec, r0, r1, x, out) for r0, r1 in self.blocks]
+        for future in futures:
+            future.result()
+        return out
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+class BlockedSpMV:
+    # SpMV over a CSR matrix whose indices and data are memory-mapped files. Rows are
+    # processed in contiguous blocks of about `block_nnz` nonzeros, so only one block has
+    # to be paged in at a time and peak memory does not grow with the matrix.
+    def __init__(self, indptr, indices, data, shape, block_nnz=5000000):
+        self.indptr = np.asarray(indptr)
+        self.indices = indices
+        self.data = data
+        self.shape = tuple(shape)
+        n_blocks = max(1, int(np.ceil(self.indptr[-1] / max(block_nnz, 1))))
+        self.blocks = partition_rows(self.indptr, n_blocks)
+
+    def __call__(self, x, out=None):
+        if out is None:
+            out = np.empty(self.shape[0])
+        indptr = self.indptr
+        for r0, r1 in self.blocks:
+            start, stop = indptr[r0], indptr[r1]
+            block_indptr = indptr[r0:r1 + 1] - start
+            indices = np.asarray(self.indices[start:stop])
+            data = np.asarray(self.data[start:stop])
+            block_out = out[r0:r1]
+            if csr_matvec is None:
+                block_out[:] = csr_matrix((data, indices, block_indptr), shape=(r1 - r0, self.shape[1])).dot(x)
+                continue
+            block_out.fill(0)
+            csr_matvec(r1 - r0, self.shape[1], block_indptr, indices, data, x, block_out)
+        return out
+
+    def close(self):
+        pass
+
+def patch_zero_diagonal(m):
+    # Replace zero diagonals with ones to prevent potential scale explosion.
+    # Adding a sparse diagonal keeps the matrix in CSR instead of round-tripping through LIL.
+    m = m.tocsr()
+    n = m.shape[0]
+    is_zero_diag = m.diagonal() == 0
+    if np.any(is_zero_diag):
+        m = m + spdiags(is_zero_diag.astype(m.dtype), 0, n, n, 'csr')
+    return m
+
+class KnightRuizBalancer:
+    # Knight-Ruiz matrix balancing (bin3C bistochastic normalization).
+    # The engine keeps its n-length work buffers between runs, accepts a warm-start
+    # scale vector and records the residual and timing of every outer iteration.
+    def __init__(self, max_iter=1000, tol=1e-6, delta=0.1, Delta=3, g=0.9, etamax=0.1,
+                 n_threads=None, backend='auto'):
+        self.max_iter = max_iter
+        self.tol = tol
+        self.n_threads = n_threads
+        self.backend = backend
+        self.delta = delta      # Lower bound for y
+        self.Delta = Delta      # Upper bound for y
+        self.g = g              # Step size factor
+        self.etamax = etamax    # Maximum eta value
+        self.history = []
+        self.n_iter = 0
+        self.converged = False
+        self.elapsed = 0.0
+        self._n = None
+        self._kernel = None
+
+    def _allocate(self, n):
+        # Work buffers are only reallocated when the matrix size changes
+        if self._n == n:
+            return
+        self._n = n
+        self._x = np.empty(n)
+        self._v = np.empty(n)
+        self._rk = np.empty(n)
+        self._y = np.empty(n)
+        self._ynew = np.empty(n)
+        self._Z = np.empty(n)
+        self._p = np.empty(n)
+        self._w = np.empty(n)
+        self._ap = np.empty(n)
+        self._tmp = np.empty(n)
+        self._Ax = np.empty(n)
+
+    def _spmv(self, x, out):
+        # out = m @ x without allocating a new output vector
+        return self._kernel(x, out)
+
+    def balance(self, m, x0=None):
+        # Returns the balanced matrix and the scale vector 'x'
+        _orig = m.tocsr()
+        scale = self.scale_vector(_orig, x0)
+        n = _orig.shape[0]
+        X = spdiags(scale, 0, n, n, 'csr')
+        matrix = X.T.dot(_orig.dot(X))
+        return matrix, scale
+
+    def scale_vector(self, m, x0=None):
+        # Only the scale vector 'x'; the balanced matrix is x[i] * m[i, j] * x[j]
+        m = patch_zero_diagonal(m.tocsr())
+        if not isspmatrix_csr(m):
+            m = m.tocsr()
+        if m.dtype != np.float64:
+            m = m.astype(np.float64)
+        return self.balance_operator(ParallelSpMV(m, n_threads=self.n_threads, backend=self.backend), m.shape[0], x0)
+
+    def balance_operator(self, kernel, n, x0=None):
+        # Balance a matrix only reachable through its SpMV kernel (kernel(x, out) = m @ x),
+        # e.g. a BlockedSpMV over memory-mapped CSR blocks. The zero diagonals must already
+        # be patched. Returns the scale vector.
+        self._kernel = kernel
+        try:
+            self._solve(n, x0)
+        finally:
+            self._kernel.close()
+            self._kernel = None
+
+        if self.n_iter >= self.max_iter:
+            logger.error(f'Maximum number of iterations ({self.max_iter}) reached without convergence')
+        return self._x.copy()
+
+    def _solve(self, n, x0=None):
+        self._allocate(n)
+        x, v, rk, y, ynew = self._x, self._v, self._rk, self._y, self._ynew
+        Z, p, w, ap, tmp, Ax = self._Z, self._p, self._w, self._ap, self._tmp, self._Ax
+
+        # Initialize x from the warm-start vector when one is supplied
+        if x0 is not None:
+            x0 = np.asarray(x0, dtype=np.float64)
+            if x0.shape != (n,) or not np.all(np.isfinite(x0)) or np.any(x0 <= 0):
+                logger.warning("Ignoring invalid warm-start vector for Knight-Ruiz balancing.")
+                x.fill(1)
+            else:
+                x[:] = x0
+        else:
+            x.fill(1)
+
+        delta, Delta, g, etamax = self.delta, self.Delta, self.g, self.etamax
+        tol = self.tol
+        eta = etamax            # Initial eta
+        stop_tol = tol * 0.5    # Stopping tolerance
+        rt = tol ** 2           # Residual tolerance (squared)
+
+        np.multiply(x, self._spmv(x, Ax), out=v)   # Initial value for v (Ax)
+        np.subtract(1, v, out=rk)                     # Residual (1 - Ax)
+        rho_km1 = np.dot(rk, rk)
+        rho_km2 = rho_km1
+        rout = rho_km1
+        rold = rout
+        n_iter = 0
+        self.history = []
+        start = time.perf_counter()
+
+        # Main loop for the iterative process
+        while rout > rt and n_iter < self.max_iter:
+            iter_start = time.perf_counter()
+            k = 0
+            y.fill(1)
+            inner_tol = max(rout * eta ** 2, rt)
+
+            # Inner loop for balancing the matrix
+            while rho_km1 > inner_tol:
+                k += 1
+                if k == 1:
+                    np.divide(rk, v, out=Z)
+                    p[:] = Z
+                    rho_km1 = np.dot(rk, Z)
+                else:
+                    beta = rho_km1 / rho_km2
+                    np.multiply(p, beta, out=p)
+                    p += Z
+
+                # Compute w and alpha for the line search
+                np.multiply(x, p, out=tmp)
+                self._spmv(tmp, w)
+                w *= x
+                np.multiply(v, p, out=tmp)
+                w += tmp
+                alpha = rho_km1 / np.dot(p, w)
+                np.multiply(p, alpha, out=ap)
+                np.add(y, ap, out=ynew)
+
+                # Check for bound violations (either below delta or above Delta)
+                if np.amin(ynew) <= delta:
+                    if delta == 0:
+                        break
+                    ind = ap < 0
+                    gamma = np.amin((delta - y[ind]) / ap[ind])
+                    y += gamma * ap
+                    break
+                if np.amax(ynew) >= Delta:
+                    ind = ynew > Delta
+                    gamma = np.amin((Delta - y[ind]) / ap[ind])
+                    y += gamma * ap
+                    break
+
+                y, ynew = ynew, y
+                np.multiply(w, alpha, out=tmp)
+                rk -= tmp
+                rho_km2 = rho_km1
+                np.divide(rk, v, out=Z)
+                rho_km1 = np.dot(rk, Z)
+
+            # Update x with the new y values
+            x *= y
+            if np.any(np.isnan(x)):
+                raise RuntimeError('Scale vector has developed invalid values (NaNs)!')
+            np.multiply(x, self._spmv(x, Ax), out=v)
+            np.subtract(1, v, out=rk)
+            rho_km1 = np.dot(rk, rk)
+            rout = rho_km1
+            n_iter += k + 1
+            rat = rout / rold
+            rold = rout
+            res_norm = np.sqrt(rout)
+            eta = g * rat
+            eta = max(min(eta, etamax), stop_tol / res_norm)
+
+            self.history.append({
+                'iteration': len(self.history) + 1,
+                'inner_steps': k,
+                'residual': float(res_norm),
+                'seconds': time.perf_counter() - iter_start,
+            })
+
+        # Keep the buffer references stable after the y/ynew swaps
+        self._y, self._ynew = y, ynew
+        self.n_iter = n_iter
+        self.converged = rout <= rt
+        self.elapsed = time.perf_counter() - start
+        return x
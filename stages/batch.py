@@ -0,0 +1,69 @@
+import time
+import logging
+import pandas as pd
+from scipy.sparse import coo_matrix
+from stages.kernels import BIAS_COLUMNS, contig_vectors, pair_correlations
+from stages.scheduler import SCHEDULER
+
+logger = logging.getLogger("app_logger")
+
+# Methods offered by the batch comparison, in display order
+BATCH_METHODS = ['Raw', 'normCC', 'HiCzin', 'bin3C', 'MetaTOR']
+
+def _run_method(method, params, shape, row, col, data, **vectors):
+    # Imported here so the worker does not depend on the import order of the stages
+    from stages.b_normalization import run_normalization
+
+    contact_matrix = coo_matrix((data, (row, col)), shape=shape)
+    # Contig table built on top of the shared feature vectors
+    contig_df = pd.DataFrame({BIAS_COLUMNS[factor]: vectors[factor] for factor in BIAS_COLUMNS}, copy=False)
+    start = time.perf_counter()
+    # Pool workers serve every session, so the model is not kept in their caches
+    normalized_matrix = run_normalization(method, contig_df, contact_matrix, use_cache=False, **params)
+    seconds = time.perf_counter() - start
+
+    if normalized_matrix is None or normalized_matrix.nnz == 0:
+        return {'Method': method, 'Site': None, 'Length': None, 'Coverage': None,
+                'Contacts': 0, 'Seconds': round(seconds, 2)}
+
+    normalized_matrix = normalized_matrix.tocoo()
+    correlations = pair_correlations(normalized_matrix.row, normalized_matrix.col, normalized_matrix.data,
+                                     contig_vectors(contig_df))
+    return {
+        'Method': method,
+        'Site': abs(correlations['site']),
+        'Length': abs(correlations['length']),
+        'Coverage': abs(correlations['coverage']),
+        'Contacts': int(normalized_matrix.nnz),
+        'Seconds': round(seconds, 2)
+    }
+
+def run_normalization_batch(methods, contig_df, contact_matrix, session='default', **params):
+    # Run several normalization methods side by side on the server's worker pool.
+    # The contact matrix and per-contig bias features are loaded and placed in shared
+    # memory once; every worker maps them read-only and reports the absolute Pearson
+    # correlations between its normalized contacts and the products of the bias factors.
+    # Raises SchedulerBusy when the server cannot take the work.
+    methods = [method for method in BATCH_METHODS if method in methods]
+    if not methods:
+        return pd.DataFrame(columns=['Method', 'Site', 'Length', 'Coverage', 'Contacts', 'Seconds'])
+
+    contact_matrix = contact_matrix.tocoo()
+    arrays = {'row': contact_matrix.row, 'col': contact_matrix.col, 'data': contact_matrix.data}
+    arrays.update(contig_vectors(contig_df))
+
+    logger.info(f"Running batch normalization for {', '.join(methods)} on the compute pool.")
+    futures = SCHEDULER.submit_many(session, _run_method, [(method, params, contact_matrix.shape) for method in methods],
+                                    shared=arrays)
+    rows = []
+    for method, future in zip(methods, futures):
+        try:
+            rows.append(future.result())
+        except Exception as e:
+            logger.error(f"Batch normalization failed for {method}: {e}")
+            rows.append({'Method': method, 'Site': None, 'Length': None, 'Coverage': None,
+                         'Contacts': 0, 'Seconds': None})
+
+    comparison = pd.DataFrame(rows)
+    comparison[['Site', 'Length', 'Coverage']] = comparison[['Site', 'Length', 'Coverage']].astype(float).round(5)
+    return comparison
@@ -3,101 +3,198 @@ from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 from scipy.sparse import load_npz
+from flask import abort, request, send_file
 import dash_ag_grid as dag
 import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
 import pandas as pd
 import numpy as np
 import os
-import io
-import py7zr
-from scipy.stats import pearsonr
-
-def compute_product_values(data, row, col, restriction_sites, contig_length, contig_coverage):
-    product_sites = restriction_sites.iloc[row].values * restriction_sites.iloc[col].values
-    product_length = contig_length.iloc[row].values * contig_length.iloc[col].values
-    product_coverage = contig_coverage.iloc[row].values * contig_coverage.iloc[col].values
-    contacts = data
-    return pd.DataFrame({
-        'Product Sites': product_sites,
-        'Product Length': product_length,
-        'Product Coverage': product_coverage,
-        'Contacts': contacts,
-    })
+import hmac
+import json
+import shutil
+import tempfile
+from stages.kernels import (
+    contig_vectors,
+    iter_pair_features,
+    pair_correlations,
+    chunked_percentile,
+    CorrelationAccumulator
+)
+from stages.helper import save_to_redis, load_from_redis
+from stages.factorized import load_factorized, load_normalized_matrix, FACTORS_FILE, NORMALIZED_FILE, RAW_FILE
+from stages.archive import get_archive, artifact_version
+from stages.out_of_core import OUT_OF_CORE_DIR, needs_out_of_core, spill_npz, chunk_entries
 
-def compute_plot_data(data, row, col, restriction_sites, contig_length, contig_coverage):
-    product_sites = restriction_sites.iloc[row].values * restriction_sites.iloc[col].values
-    product_length = contig_length.iloc[row].values * contig_length.iloc[col].values
-    product_coverage = contig_coverage.iloc[row].values * contig_coverage.iloc[col].values
-    contacts = data
-    
-    # Create the DataFrame
-    plot_data = pd.DataFrame({
-        'Product Sites': np.log1p(product_sites),
-        'Product Length': np.log1p(product_length),
-        'Product Coverage': np.log1p(product_coverage),
-        'Contacts': contacts,
-    })
-    
-    # Filter out rows where Contacts exceeds the 99th percentile
-    threshold = plot_data['Contacts'].quantile(0.99)
-    plot_data = plot_data[(plot_data['Contacts'] > 0) & (plot_data['Contacts'] <= threshold)].reset_index(drop=True)
-    
-    return plot_data
-
-def calculate_pearson(df, factors, contacts_col="Contacts"):
-    correlations = {}
-    for factor in factors:
-        correlation, _ = pearsonr(df[contacts_col], df[factor])
-        correlations[factor] = abs(correlation)
-    return correlations
-
-def generate_plots(normalized_plot_data):
-    # Normalized Data Plots
-    plot_sites_norm = dcc.Graph(
-        id='plot-sites-norm-filtered',
-        figure=px.scatter(
-            normalized_plot_data,
-            x='Product Sites',
-            y='Contacts',
-            labels={'Product Sites': 'Product of Sites (log scale)', 'Contacts': 'Raw Hi-C Contacts'},
-            hover_data={}
-        ),
-        style={'width': '32%', 'display': 'inline-block'}
-    )
+# Bias plots switch from scatter points to a density grid above this many pairs
+POINT_PLOT_LIMIT = int(os.getenv("POINT_PLOT_LIMIT", 20000))
+DENSITY_GRID_BINS = (200, 150)
+# Correlation table columns of the bias factors
+FACTOR_NAMES = {'site': 'Site', 'length': 'Length', 'coverage': 'Coverage'}
 
-    plot_lengths_norm = dcc.Graph(
-        id='plot-lengths-norm-filtered',
-        figure=px.scatter(
-            normalized_plot_data,
-            x='Product Length',
-            y='Contacts',
-            labels={'Product Length': 'Product of Length (log scale)', 'Contacts': 'Raw Hi-C Contacts'},
-            hover_data={}
-        ),
-        style={'width': '32%', 'display': 'inline-block'}
-    )
+def iter_plot_data(matrix, contig_info, chunk_size=1000000):
+    # Bias plot rows of the matrix entries, chunk by chunk: log1p of the per-pair products
+    # a[row] * a[col] (pairs with a zero factor stay on the axis) and the contacts. Contacts
+    # above the 99th percentile are left out.
+    threshold = chunked_percentile(matrix.data, 99, chunk_size=chunk_size)
+    for start, stop, block in iter_pair_features(matrix.row, matrix.col, contig_vectors(contig_info),
+                                                 combine='product', chunk_size=chunk_size):
+        contacts = np.asarray(matrix.data[start:stop])
+        keep = (contacts > 0) & (contacts <= threshold)
+        features = np.log1p(block[keep])
+        yield pd.DataFrame({
+            'Product Sites': features[:, 0],
+            'Product Length': features[:, 1],
+            'Product Coverage': features[:, 2],
+            'Contacts': contacts[keep],
+        })
 
-    plot_coverage_norm = dcc.Graph(
-        id='plot-coverage-norm-filtered',
-        figure=px.scatter(
-            normalized_plot_data,
-            x='Product Coverage',
-            y='Contacts',
-            labels={'Product Coverage': 'Product of Coverage (log scale)', 'Contacts': 'Raw Hi-C Contacts'},
-            hover_data={}
-        ),
-        style={'width': '32%', 'display': 'inline-block'}
-    )
+def bias_correlations(raw_matrix, contig_info, factorized=None, normalized_matrix=None, chunk_size=1000000):
+    # Absolute Pearson correlations between contacts and the per-pair products of each bias
+    # factor, for the raw and the normalized matrix. Sums of (co)moments are accumulated chunk
+    # by chunk; a factorized normalization is scored in the same pass over the raw entries.
+    vectors = contig_vectors(contig_info)
+    raw = CorrelationAccumulator(len(vectors))
+    normalized = CorrelationAccumulator(len(vectors))
+    row, col, data = raw_matrix.row, raw_matrix.col, raw_matrix.data
+    for start, stop, block in iter_pair_features(row, col, vectors, combine='product', chunk_size=chunk_size):
+        raw.add(block, data[start:stop])
+        if factorized is not None:
+            mask, values = factorized.denoised(row[start:stop], col[start:stop], data[start:stop])
+            normalized.add(block[mask], values)
+
+    if factorized is None:
+        normalized_correlations = pair_correlations(normalized_matrix.row, normalized_matrix.col, normalized_matrix.data,
+                                                    vectors, chunk_size=chunk_size)
+    else:
+        normalized_correlations = dict(zip(vectors, normalized.correlations()))
+    raw_correlations = dict(zip(vectors, raw.correlations()))
+
+    return pd.DataFrame([
+        {"Metric": metric, **{FACTOR_NAMES[factor]: abs(value) for factor, value in correlations.items()}}
+        for metric, correlations in [("Raw", raw_correlations), ("Normalized", normalized_correlations)]
+    ]).round(5)
+
+def density_grid(x, y, bins=DENSITY_GRID_BINS, ranges=None):
+    # Pair counts on a fixed x/y grid; only the grid goes to the browser.
+    # With the same ranges, grids of separate chunks add up to the grid of all pairs.
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=ranges)
+    return counts.T, (x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2
+
+def bias_figure(plot_data, factor, label, mode, grid=None):
+    # grid: (counts, x_centers, y_centers) already accumulated for the density mode
+    labels = {factor: f'{label} (log scale)', 'Contacts': 'Raw Hi-C Contacts'}
+    if mode == 'points':
+        return px.scatter(plot_data, x=factor, y='Contacts', labels=labels, hover_data={})
+
+    if grid is None:
+        grid = density_grid(plot_data[factor].values, plot_data['Contacts'].values)
+    counts, x_centers, y_centers = grid
+    with np.errstate(divide='ignore'):
+        z = np.round(np.where(counts > 0, np.log10(counts), np.nan), 3)
+    figure = go.Figure(go.Heatmap(
+        x=x_centers, y=y_centers, z=z, customdata=counts.astype(int), colorscale='Viridis',
+        colorbar={'title': 'log10 pairs'},
+        hovertemplate=f"{labels[factor]}: %{{x:.2f}}<br>{labels['Contacts']}: %{{y:.1f}}<br>Pairs: %{{customdata}}<extra></extra>"
+    ))
+    figure.update_layout(xaxis_title=labels[factor], yaxis_title=labels['Contacts'], plot_bgcolor='white')
+    return figure
+
+# Graph ids and labels of the three bias panels
+BIAS_PANELS = [
+    ('plot-sites-norm-filtered', 'Product Sites', 'Product of Sites'),
+    ('plot-lengths-norm-filtered', 'Product Length', 'Product of Length'),
+    ('plot-coverage-norm-filtered', 'Product Coverage', 'Product of Coverage')
+]
+# Inputs of the results page; its cached output is only valid for the same versions of them
+RESULTS_INPUTS = ['contig_info_final.csv', RAW_FILE, NORMALIZED_FILE, FACTORS_FILE]
+
+def bias_figures(normalized_plot_data, mode=None):
+    # Scatter points only for small matrices; otherwise every panel is a server-side 2D histogram
+    if mode is None:
+        mode = 'points' if len(normalized_plot_data) <= POINT_PLOT_LIMIT else 'density'
+    return [bias_figure(normalized_plot_data, factor, label, mode) for _, factor, label in BIAS_PANELS]
+
+def streamed_bias_figures(matrix, contig_info, chunk_size=1000000):
+    # bias_figures of the matrix entries without building the whole plot table. The first pass
+    # counts the plotted pairs and their ranges, keeping them while they fit a scatter plot;
+    # larger tables are binned chunk by chunk on the grid those ranges define.
+    columns = [factor for _, factor, _ in BIAS_PANELS] + ['Contacts']
+    count, low, high, kept = 0, None, None, []
+    for chunk in iter_plot_data(matrix, contig_info, chunk_size):
+        if chunk.empty:
+            continue
+        count += len(chunk)
+        chunk_low, chunk_high = chunk[columns].min().values, chunk[columns].max().values
+        low = chunk_low if low is None else np.minimum(low, chunk_low)
+        high = chunk_high if high is None else np.maximum(high, chunk_high)
+        kept = kept + [chunk] if count <= POINT_PLOT_LIMIT else []
+
+    if count <= POINT_PLOT_LIMIT:
+        plot_data = pd.concat(kept, ignore_index=True) if kept else pd.DataFrame(columns=columns, dtype=float)
+        return bias_figures(plot_data, 'points')
+
+    grids = {}
+    for chunk in iter_plot_data(matrix, contig_info, chunk_size):
+        for j, factor in enumerate(columns[:-1]):
+            counts, x_centers, y_centers = density_grid(chunk[factor].values, chunk['Contacts'].values,
+                                                        ranges=[[low[j], high[j]], [low[-1], high[-1]]])
+            if factor in grids:
+                counts += grids[factor][0]
+            grids[factor] = counts, x_centers, y_centers
+    return [bias_figure(None, factor, label, 'density', grid=grids[factor]) for _, factor, label in BIAS_PANELS]
+
+def generate_plots(normalized_plot_data, mode=None, figures=None):
+    # figures: already computed (or serialized) figures of the three panels
+    if figures is None:
+        figures = bias_figures(normalized_plot_data, mode)
+
+    plots = [
+        dcc.Graph(
+            id=graph_id,
+            figure=figure,
+            style={'width': '32%', 'display': 'inline-block'}
+        )
+        for (graph_id, _, _), figure in zip(BIAS_PANELS, figures)
+    ]
 
     # Returning the combined HTML structure
     return html.Div([
-        html.Div([
-            plot_sites_norm,
-            plot_lengths_norm,
-            plot_coverage_norm
-        ], style={'display': 'flex', 'justify-content': 'space-between'})
+        html.Div(plots, style={'display': 'flex', 'justify-content': 'space-between'})
     ])
 
+def score_results(folder_path, contig_info, raw, read_normalized, chunk_size=1000000):
+    # Correlation rows and bias figures of a user folder. Factorized results are scored straight
+    # from the raw entries; otherwise read_normalized() supplies the stored normalized matrix.
+    factorized = load_factorized(folder_path, raw)
+    normalized = read_normalized() if factorized is None else None
+    correlation_results = bias_correlations(raw, contig_info, factorized, normalized, chunk_size)
+    return correlation_results.to_dict("records"), streamed_bias_figures(raw, contig_info, chunk_size)
+
+def load_results_cache(user_folder, version):
+    # Correlation rows and figure dicts computed for this version of the inputs, or None
+    try:
+        cached = load_from_redis(f'{user_folder}:results-page')
+    except KeyError:
+        return None
+    if not isinstance(cached, dict) or cached.get('version') != version:
+        return None
+    return cached['rows'], [json.loads(figure) for figure in cached['figures']]
+
+def save_results_cache(user_folder, version, rows, figures):
+    save_to_redis(f'{user_folder}:results-page', {
+        'version': version,
+        'rows': rows,
+        'figures': [pio.to_json(figure, validate=False) for figure in figures]
+    })
+
+def download_token(user_folder):
+    # Secret issued to the session when it was created; download links only work with it
+    from app import r
+    token = r.get(f'{user_folder}:download-token')
+    return '' if token is None else token.decode()
+
 def results_layout(user_folder):
     instructions = (
         "The Download button allows users to download the dataset they are currently working with.  \n\n"
@@ -123,14 +220,16 @@ def results_layout(user_folder):
                 html.H5("Section 1: Download User Folder", 
                         className="main-title my-4", 
                         style={'marginTop': '600px', 'textAlign': 'left'}),
-                dcc.Download(id="download"),
                 dbc.Card(
                     [
                         dbc.CardBody([ 
                             html.H6("Instructions:"),
                             dcc.Markdown(instructions, style={'fontSize': '0.9rem', 'color': '#555'})
                         ]),
-                        dbc.Button("Download Files", id="download-btn", color="primary", style={'marginTop': '10px'}),
+                        html.A(
+                            dbc.Button("Download Files", id="download-btn", color="primary", style={'marginTop': '10px'}),
+                            href=f"/download/{user_folder}?token={download_token(user_folder)}"
+                        ),
                     ],
                     body=True,
                     className="my-3"
@@ -143,7 +242,7 @@ def results_layout(user_folder):
                 ),
                 html.Div(id="plots"),
     
-                html.H5("Section 3: Pearson Correlation Coefficients (Absolute Value) Between Normalized Hi-C Contacts and the Product of Each of the Three Factors of Explicit Biases", 
+                html.H5("Section 3: Pearson Correlation Coefficients (Absolute Value) Between Raw and Normalized Hi-C Contacts and the Product of Each of the Three Factors of Explicit Biases", 
                         className="main-title my-4", 
                         style={'marginTop': '600px', 'textAlign': 'left'}),
                 html.Div([
@@ -158,7 +257,7 @@ def results_layout(user_folder):
                         rowData=[],
                         dashGridOptions={"rowHeight": 50},
                         defaultColDef={"resizable": True, "sortable": True, "filter": True},
-                        style={"height": "12vh", "width": "43vw", "margin": "auto"},
+                        style={"height": "17vh", "width": "43vw", "margin": "auto"},
                     ),
                 ]),
             ]
@@ -175,69 +274,49 @@ def register_results_callbacks(app):
     def normalization_visualization(user_folder, current_stage):
         if current_stage != 'Visualization':
             raise PreventUpdate
+
+        # Returning to the page reuses the output of the same normalization
+        folder_path = os.path.join('output', user_folder)
+        version = artifact_version(folder_path, RESULTS_INPUTS)
+        cached = load_results_cache(user_folder, version)
+        if cached is not None:
+            rows, figures = cached
+            return rows, generate_plots(None, figures=figures)
             
-        contig_info_path = os.path.join('output', user_folder, 'contig_info_final.csv')
-        normalized_matrix_path = os.path.join('output', user_folder, 'normalized_contig_matrix.npz')
-        unnormalized_matrix_path = os.path.join('output', user_folder, 'unnormalized_contig_matrix.npz')
-        
-        contig_info = pd.read_csv(contig_info_path)
-        norm_sparse_matrix = load_npz(normalized_matrix_path).tocoo()
-        unnorm_sparse_matrix = load_npz(unnormalized_matrix_path).tocoo()
+        contig_info = pd.read_csv(os.path.join(folder_path, 'contig_info_final.csv'))
+        raw_path = os.path.join(folder_path, RAW_FILE)
+        if needs_out_of_core(raw_path):
+            # Too large to load: score memory-mapped copies of the stored matrices in budget-sized chunks
+            chunk_size = chunk_entries(len(contig_info))
+            directory = tempfile.mkdtemp(prefix='results-', dir=OUT_OF_CORE_DIR)
+            try:
+                raw = spill_npz(raw_path, directory, chunk_size, name='raw')
+                rows, figures = score_results(
+                    folder_path, contig_info, raw,
+                    lambda: spill_npz(os.path.join(folder_path, NORMALIZED_FILE), directory, chunk_size, name='normalized'),
+                    chunk_size
+                )
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+        else:
+            rows, figures = score_results(folder_path, contig_info, load_npz(raw_path).tocoo(),
+                                          lambda: load_normalized_matrix(folder_path))
+        save_results_cache(user_folder, version, rows, figures)
         
-        # Extract relevant columns
-        restriction_sites = contig_info['The number of restriction sites']
-        contig_length = contig_info['Contig length']
-        contig_coverage = contig_info['Contig coverage']
-    
-        norm_data, norm_row, norm_col = norm_sparse_matrix.data, norm_sparse_matrix.row, norm_sparse_matrix.col
-        unnorm_data, unnorm_row, unnorm_col = unnorm_sparse_matrix.data, unnorm_sparse_matrix.row, unnorm_sparse_matrix.col
-    
-        normalized_product_values = compute_product_values(norm_data, norm_row, norm_col, restriction_sites, contig_length, contig_coverage)
-    
-        unnormalized_plot_data = compute_plot_data(unnorm_data, unnorm_row, unnorm_col, restriction_sites, contig_length, contig_coverage)
-    
-        factors = ["Product Sites", "Product Length", "Product Coverage"]
-        normalized_correlations = calculate_pearson(normalized_product_values, factors)
+        return rows, generate_plots(None, figures=figures)
     
-        correlation_results = pd.DataFrame({
-            "Metric": ["Normalized"],
-            "Site": [normalized_correlations["Product Sites"]],
-            "Length": [normalized_correlations["Product Length"]],
-            "Coverage": [normalized_correlations["Product Coverage"]],
-        })
-        correlation_results = correlation_results.round(5)
-    
-        plots = generate_plots(unnormalized_plot_data)
-        
-        return correlation_results.to_dict("records"), plots
-    
-    @app.callback(
-        Output("download", "data"),
-        [Input("download-btn", "n_clicks")],
-        [State("user-folder", "data")]
-    )
-    def download_user_folder(n_clicks, user_folder):
-        if not n_clicks:
-            raise PreventUpdate
-    
-        # Path to the user folder
-        folder_path = f"output/{user_folder}"
-    
-        # Create a 7z archive in memory
-        memory_file = io.BytesIO()
-        with py7zr.SevenZipFile(memory_file, 'w') as archive:
-            # Add files to the archive
-            for root, _, files in os.walk(folder_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    archive.write(file_path, arcname=os.path.relpath(file_path, folder_path))
-        memory_file.seek(0)
-    
-        # Return the 7z file to download
-        return dcc.send_bytes(
-            memory_file.getvalue(),
-            filename=f"{user_folder}.7z"
-        )
+    @app.server.route('/download/<user_folder>')
+    def download_user_folder(user_folder):
+        # Streamed from the archive cache, built only when the session files changed
+        folder_path = os.path.join('output', user_folder)
+        if user_folder.startswith('.') or os.path.basename(user_folder) != user_folder or not os.path.isdir(folder_path):
+            abort(404)
+        # Only the session owning the folder has its token, so other sessions cannot fetch it
+        token = download_token(user_folder)
+        if not token or not hmac.compare_digest(token.encode(), request.args.get('token', '').encode()):
+            abort(403)
+        return send_file(os.path.abspath(get_archive(folder_path)), mimetype='application/x-7z-compressed',
+                         as_attachment=True, download_name=f"{user_folder}.7z")
     
     @app.callback(
         Output('visualization-status', 'data'),
@@ -0,0 +1,131 @@
+import os
+import hashlib
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from scipy.sparse import issparse
+
+logger = logging.getLogger("app_logger")
+
+def nbytes(value, _seen=None):
+    # Approximate memory held by a cached value (arrays, sparse matrices, frames and containers).
+    # Arrays sharing one buffer (views, or a matrix and its factorized form) are counted once;
+    # other objects can describe their memory through a memory_parts() method.
+    seen = set() if _seen is None else _seen
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        owner = value
+        while isinstance(owner.base, np.ndarray):
+            owner = owner.base
+        if id(owner) in seen:
+            return 0
+        seen.add(id(owner))
+        return owner.nbytes
+    if issparse(value):
+        if hasattr(value, 'indptr'):
+            return sum(nbytes(part, seen) for part in (value.data, value.indices, value.indptr))
+        if hasattr(value, 'row'):
+            return sum(nbytes(part, seen) for part in (value.data, value.row, value.col))
+        return nbytes(value.data, seen)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sum(nbytes(item, seen) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item, seen) for item in value)
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if hasattr(value, 'memory_parts'):
+        return sum(nbytes(part, seen) for part in value.memory_parts())
+    return 64
+
+def digest_arrays(*arrays):
+    # Content hash of a sequence of arrays (shape and dtype included)
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(memoryview(array).cast('B'))
+    return h.hexdigest()
+
+def digest_matrix(matrix):
+    # Content hash of a sparse matrix, independent of its storage format
+    matrix = matrix.tocoo()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(matrix.shape).encode())
+    h.update(digest_arrays(matrix.row, matrix.col, matrix.data).encode())
+    return h.hexdigest()
+
+def digest_frame(df, columns=None):
+    # Content hash of (selected columns of) a DataFrame
+    df = df if columns is None else df[list(columns)]
+    return hashlib.blake2b(pd.util.hash_pandas_object(df, index=True).values.tobytes(), digest_size=16).hexdigest()
+
+def make_key(*parts):
+    return ':'.join(str(part) for part in parts)
+
+class LRUCache:
+    # Thread-safe in-process cache evicting the least recently used entries once the
+    # cached values exceed `max_bytes`. Values larger than the whole budget are not stored.
+    def __init__(self, max_bytes, name='cache'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, value, size=None):
+        # Returns True when the value was stored
+        size = nbytes(value) if size is None else size
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._sizes.pop(key)
+                del self._entries[key]
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)
+                self.size -= self._sizes.pop(evicted)
+                logger.info(f"Evicted {evicted} from the {self.name}.")
+            return True
+
+    def items(self):
+        # (key, value) pairs, least recently used first
+        with self._lock:
+            return list(self._entries.items())
+
+    def invalidate(self, prefix=''):
+        # Drop every entry whose key starts with `prefix`
+        with self._lock:
+            for key in [key for key in self._entries if str(key).startswith(prefix)]:
+                self.size -= self._sizes.pop(key)
+                del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+
+def cache_budget(variable, default_mb):
+    # Cache size in bytes from an environment variable given in megabytes
+    return int(float(os.getenv(variable, default_mb)) * 1024 * 1024)
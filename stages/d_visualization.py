@@ -14,11 +14,13 @@ import math
 from math import sqrt, sin, cos
 import logging
 import json
-from joblib import Parallel, delayed
-from itertools import combinations
 from stages.helper import (
-    get_indexes,
-    calculate_submatrix_sum,
+    AnnotationIndex,
+    annotation_index,
+    LAYOUTS,
+    cached_spring_layout,
+    annotation_contact_matrix,
+    load_annotation_matrix,
     save_to_redis,
     load_from_redis
 )
@@ -86,6 +88,40 @@ def nx_to_cyto_elements(G, pos, invisible_nodes=set(), invisible_edges=set()):
 
     return elements
 
+# Cytoscape elements of top-level nodes and hidden edges, straight from arrays
+def arrays_to_cyto_elements(names, coordinates, colors, sources, targets, size=20):
+    coordinates = coordinates * 100
+    elements = [
+        {
+            'data': {
+                'id': name,
+                'label': name,
+                'label_size': 20,
+                'size': size,
+                'color': color,
+                'parent': None,
+                'visible': 'element'
+            },
+            'position': {'x': x, 'y': y},
+            'style': {'text-margin-y': -5, 'font-style': 'italic'}
+        }
+        for name, color, (x, y) in zip(names, colors, coordinates.tolist())
+    ]
+    elements += [
+        {
+            'data': {
+                'source': names[i],
+                'target': names[j],
+                'width': 1,
+                'color': '#bbb',
+                'visible': 'none',
+                'selectable': False
+            }
+        }
+        for i, j in zip(sources.tolist(), targets.tolist())
+    ]
+    return elements
+
 def add_selection_styles(selected_nodes=None, selected_edges=None):
     cyto_stylesheet = base_stylesheet.copy()
 
@@ -268,10 +304,9 @@ def styling_information_table(information_data, id_colors, unique_annotations, t
             })
         return col_styles
 
-    # Parallelize numeric column styling
-    numeric_styles = Parallel(n_jobs=-1)(delayed(style_numeric_column)(col) for col in columns)
-    for col_style in numeric_styles:
-        styles.extend(col_style)
+    # A few columns of string formatting, cheaper inline than on the compute pool
+    for col in columns:
+        styles.extend(style_numeric_column(col))
         
     # Style annotation column
     for type_key, color in type_colors.items():
@@ -601,79 +636,75 @@ def taxonomy_visualization(bin_information, unique_annotations, contact_matrix,
     return fig, bar_fig
 
 #Function to visualize annotation relationship
-def annotation_visualization(bin_information, unique_annotations, contact_matrix, taxonomy_level, selected_node=None):
+def annotation_visualization(bin_information, unique_annotations, contact_matrix, taxonomy_level, selected_node=None, index=None,
+                             session='default', layouts=LAYOUTS):
     data_dict = {}
-    G = nx.Graph()
     
     if selected_node and len(selected_node) == 2:
         logger.warning(f"Selected node '{selected_node}' is not classified.")
         return [], create_bar_chart(data_dict), {}
+
+    if index is None:
+        index = AnnotationIndex(bin_information[taxonomy_level].values)
+    annotations = np.asarray(unique_annotations, dtype=object)
+    if not contact_matrix.index.equals(pd.Index(annotations)):
+        contact_matrix = contact_matrix.loc[annotations, annotations]
+    values = contact_matrix.values
     
     # Filter out nodes with names of length 2
-    filtered_unique_annotations = [annotation for annotation in unique_annotations if len(annotation) != 2]
+    classified = pd.Series(annotations).str.len().values != 2
     
     if selected_node:
-        connected_nodes = [selected_node]
-    
-        # Only iterate over nodes connected to the selected node (i == selected_index)
-        for annotation_j in filtered_unique_annotations:
-            if annotation_j != selected_node:  # Skip the selected node itself
-                weight = contact_matrix.at[selected_node, annotation_j]
-                if weight > 0:
-                    connected_nodes.append(annotation_j)
-
+        # The selected node first, then the nodes it has contacts with
+        selected = np.flatnonzero(annotations == selected_node)[0]
+        connected = classified & (values[selected] > 0)
+        connected[selected] = False
+        nodes = np.concatenate(([selected], np.flatnonzero(connected)))
     else:
-        connected_nodes = filtered_unique_annotations
-        
-    node_colors = {}
-    for annotation in connected_nodes:
-        bin_type = bin_information.loc[
-            bin_information[taxonomy_level] == annotation, 'Category'
-        ].values[0]
-        color = type_colors.get(bin_type, default_color)
-        node_colors[annotation] = color
-        G.add_node(annotation, size=20, color=color, parent=None)
-
-    # Collect all edge weights
-    edge_weights = []
-    invisible_edges = set()
-    
-    for i, annotation_i in enumerate(connected_nodes):
-        for j, annotation_j in enumerate(connected_nodes[i + 1:], start=i + 1):
-            weight = contact_matrix.at[annotation_i, annotation_j]
-            if weight > 0:
-                G.add_edge(annotation_i, annotation_j, weight=weight)
-                invisible_edges.add((annotation_i, annotation_j))
-                edge_weights.append(weight)
-
-    if edge_weights:
-        normalized_weights = generate_gradient_values(np.array(edge_weights), 1, 2)
-        for (i, (u, v)) in enumerate(G.edges()):
-            G[u][v]['weight'] = normalized_weights[i]
-
-    # Initial node positions using a force-directed layout with increased dispersion
+        nodes = np.flatnonzero(classified)
+    names = annotations[nodes].tolist()
+
+    # Node colors from the category of the first bin of every annotation
+    categories = index.first(bin_information['Category'].values)[index.annotations.get_indexer(names)]
+    colors = pd.Series(categories).map(type_colors).fillna(default_color).tolist()
+
+    # Edges from the nonzero upper triangle of the contacts between the shown nodes
+    node_contacts = values[np.ix_(nodes, nodes)]
+    sources, targets = np.nonzero(np.triu(node_contacts, 1) > 0)
+    edge_weights = node_contacts[sources, targets]
+
+    # The graph is only built for the force-directed layout
+    G = nx.Graph()
+    G.add_nodes_from(names)
+    if len(edge_weights):
+        normalized_weights = generate_gradient_values(edge_weights, 1, 2)
+        G.add_weighted_edges_from(zip([names[i] for i in sources], [names[j] for j in targets], normalized_weights))
+
+    # Node positions using a force-directed layout with increased dispersion, cached per view
     if selected_node:
-        pos = nx.spring_layout(G, dim=2, k=2, iterations=200, weight='weight', scale=10.0, fixed=[selected_node], pos={selected_node: (0, 0)})
+        pos = cached_spring_layout(G, session, taxonomy_level, f'annotation:{selected_node}', layouts, dim=2, k=2, iterations=200,
+                                   weight='weight', scale=10.0, fixed=[selected_node], pos={selected_node: (0, 0)})
     else:
-        pos = nx.spring_layout(G, dim=2, k=2, iterations=200, weight='weight', scale=10.0)
+        pos = cached_spring_layout(G, session, taxonomy_level, 'annotation', layouts, dim=2, k=2, iterations=200,
+                                   weight='weight', scale=10.0)
 
-    cyto_elements = nx_to_cyto_elements(G, pos, invisible_edges=invisible_edges)
+    coordinates = np.array([pos[name] for name in names]).reshape(-1, 2)
+    cyto_elements = arrays_to_cyto_elements(names, coordinates, colors, sources, targets)
     cyto_style = {
         'name': 'preset',
         'fit': False
     }
     
     if not selected_node:
-        inter_annotation_contact_sum = contact_matrix.sum(axis=1) - np.diag(contact_matrix.values)
+        inter_annotation_contact_sum = values.sum(axis=1) - np.diag(values)
+        bar_colors = np.full(len(annotations), 'rgba(0,128,0,0.8)', dtype=object)
+        bar_colors[nodes] = colors
         
         # For 'Across Taxonomy Hi-C Contacts' DataFrame
-        df_contacts = pd.DataFrame({'name': unique_annotations, 
+        df_contacts = pd.DataFrame({'name': annotations, 
                                     'value': inter_annotation_contact_sum, 
-                                    'color': [node_colors.get(annotation, 'rgba(0,128,0,0.8)') for annotation in unique_annotations]
-                                   }).query('value != 0')
-        
-        # Filter out rows where 'name' length is 2
-        df_contacts = df_contacts[df_contacts['name'].str.len() != 2]
+                                    'color': bar_colors
+                                   })[classified & (inter_annotation_contact_sum != 0)]
         
         if not df_contacts.empty:
             data_dict['Across Taxonomy Hi-C Contacts'] = df_contacts
@@ -682,23 +713,18 @@ def annotation_visualization(bin_information, unique_annotations, contact_matrix
         return cyto_elements, bar_fig, cyto_style
     
     else:
-        selected_node_contacts = []
-        for annotation in connected_nodes:
-            if annotation != selected_node:
-                weight = contact_matrix.at[selected_node, annotation]
-                if weight > 0:
-                    selected_node_contacts.append({'name': annotation, 'value': weight, 
-                                                   'color': node_colors.get(annotation, 'rgba(0,128,0,0.8)')})
-        
-        if selected_node_contacts:
-            df_selected_contacts = pd.DataFrame(selected_node_contacts)
+        if len(nodes) > 1:
+            df_selected_contacts = pd.DataFrame({'name': names[1:], 'value': values[selected, nodes[1:]], 'color': colors[1:]})
             data_dict[f'Hi-C Contacts between {selected_node} and other nodes in the network'] = df_selected_contacts
             
         return cyto_elements, create_bar_chart(data_dict) , cyto_style
 
 # Function to visualize bin relationships
-def bin_visualization(bin_information, unique_annotations, bin_dense_matrix, taxonomy_level, selected_bin):
+def bin_visualization(bin_information, unique_annotations, bin_dense_matrix, taxonomy_level, selected_bin, index=None,
+                      session='default'):
     data_dict = {}
+    if index is None:
+        index = AnnotationIndex(bin_information[taxonomy_level].values)
     
     selected_bin_index = bin_information[bin_information['Bin index'] == selected_bin].index[0]
     selected_annotation = bin_information.loc[selected_bin_index, taxonomy_level]
@@ -728,10 +754,19 @@ def bin_visualization(bin_information, unique_annotations, bin_dense_matrix, tax
         contacts_annotation = pd.concat([original_contacts_annotation, pd.Series(selected_annotation)])
     else:
         contacts_annotation = original_contacts_annotation
+
+    # Category and summed contacts of every annotation, looked up through the index
+    unique_contacts = contacts_annotation.unique()
+    annotation_codes = index.annotations.get_indexer(unique_contacts)
+    annotation_types = index.first(bin_information['Category'].values)[annotation_codes]
+    selected_row = np.asarray(bin_dense_matrix[selected_bin_index]).ravel()
+    n_bins = min(len(index.codes), len(selected_row))
+    indexed = index.codes[:n_bins] >= 0
+    annotation_contacts = np.bincount(index.codes[:n_bins][indexed], weights=selected_row[:n_bins][indexed],
+                                      minlength=len(index))
         
     # Add annotation nodes
-    for annotation in contacts_annotation.unique():
-        annotation_type = bin_information.loc[bin_information[taxonomy_level] == annotation, 'Category'].values[0]
+    for annotation, annotation_type in zip(unique_contacts, annotation_types):
         color_scale = color_scale_mapping.get(annotation_type, [default_color])  
         color = color_scale[color_index % len(color_scale)]
         color_index += 1
@@ -740,10 +775,8 @@ def bin_visualization(bin_information, unique_annotations, bin_dense_matrix, tax
     # Collect all contact values between selected_annotation and other annotations
     contact_values = []
     
-    for annotation in contacts_annotation.unique():
-        annotation_bins = bin_information[bin_information[taxonomy_level] == annotation].index
-        annotation_bins = annotation_bins[annotation_bins < bin_dense_matrix.shape[1]]
-        contact_value = bin_dense_matrix[selected_bin_index, annotation_bins].sum()
+    for annotation, code in zip(unique_contacts, annotation_codes):
+        contact_value = annotation_contacts[code]
         
         if contact_value > 0:
             contact_values.append(contact_value)
@@ -753,12 +786,13 @@ def bin_visualization(bin_information, unique_annotations, bin_dense_matrix, tax
             contact_values.append(0)
                 
     filtered_contact_values = list(filter(None, contact_values))
-    scaled_weights = generate_gradient_values(filtered_contact_values, 1, 2) if contact_values else [1] * len(contacts_annotation.unique())
+    scaled_weights = generate_gradient_values(filtered_contact_values, 1, 2) if contact_values else [1] * len(unique_contacts)
     for i, (u, v) in enumerate(G.edges()):
         G[u][v]['weight'] = scaled_weights[i]
         
     fixed_positions = {selected_annotation: (0, 0)}
-    pos = nx.spring_layout(G, iterations=200, k=2, fixed=[selected_annotation], pos=fixed_positions, weight='weight')
+    pos = cached_spring_layout(G, session, taxonomy_level, f'bin:{selected_bin}', iterations=200, k=2,
+                               fixed=[selected_annotation], pos=fixed_positions, weight='weight')
     
     # Remove the edges after positioning
     G.remove_edges_from(list(G.edges()))
@@ -790,7 +824,7 @@ def bin_visualization(bin_information, unique_annotations, bin_dense_matrix, tax
         'name': contacts_bins, 
         'value': bin_contact_values, 
         'color': [G.nodes[bin]['color'] for bin in contacts_bins],
-        'hover': [f"({bin_information.loc[bin_information['Bin index'] == bin, taxonomy_level].values[0]}, {value})" for bin, value in zip(contacts_bins, bin_contact_values)]
+        'hover': [f"({annotation}, {value})" for annotation, value in zip(original_contacts_annotation, bin_contact_values)]
     }).query('value != 0')
     if not bin_data.empty:
         data_dict[f'Hi-C Contacts between {selected_bin} and other nodes in the network'] = bin_data
@@ -1159,24 +1193,20 @@ def register_visualization_callbacks(app):
         contact_matrix_key = f'{user_folder}:contact-matrix'
     
         bin_information = load_from_redis(bin_info_key)
-        bin_dense_matrix = load_from_redis(bin_matrix_key)
-                
-        unique_annotations = bin_information[taxonomy_level].unique()
-        
-        contact_matrix = pd.DataFrame(0.0, index=unique_annotations, columns=unique_annotations)
-        bin_indexes_dict = get_indexes(unique_annotations, bin_information, taxonomy_level)
+        index = annotation_index(bin_information, taxonomy_level, user_folder)
+        unique_annotations = index.annotations.values
 
-        non_self_pairs = list(combinations(unique_annotations, 2))
-        self_pairs = [(x, x) for x in unique_annotations]
-        all_pairs = non_self_pairs + self_pairs
-        
-        results = Parallel(n_jobs=-1)(
-            delayed(calculate_submatrix_sum)(pair, bin_indexes_dict, bin_dense_matrix) for pair in all_pairs
-        )
-        
-        for annotation_i, annotation_j, value in results:
-            contact_matrix.at[annotation_i, annotation_j] = value
-            contact_matrix.at[annotation_j, annotation_i] = value
+        # Tables of every level are precomputed after normalization; compute on a miss
+        precomputed = load_annotation_matrix(user_folder, taxonomy_level)
+        if precomputed is not None and pd.Index(precomputed[0]).equals(pd.Index(unique_annotations)):
+            values = precomputed[1]
+        else:
+            logger.info(f"No precomputed contact matrix for {taxonomy_level}, computing it now.")
+            # Kept sparse, the table is aggregated as P^T B P
+            bin_matrix = load_from_redis(bin_matrix_key, dense=False)
+            unique_annotations, values = annotation_contact_matrix(bin_information, bin_matrix, taxonomy_level, index)
+
+        contact_matrix = pd.DataFrame(values, index=unique_annotations, columns=unique_annotations)
     
         column_defs = [
             {"headerName": "Index", "field": "index", "pinned": "left", "width": 120,
@@ -1518,19 +1548,15 @@ def register_visualization_callbacks(app):
             selected_nodes.append(selected_annotation)
     
             if selected_annotation:
-                annotation_index = unique_annotations.tolist().index(selected_annotation)
-                for i, contact_value in enumerate(contact_matrix.iloc[annotation_index]):
-                    if contact_value > 0:
-                        connected_annotation = unique_annotations[i]
-                        selected_edges.append((selected_annotation, connected_annotation))
-    
-                cyto_elements, bar_fig, layout = annotation_visualization(
-                    bin_information, unique_annotations, contact_matrix, taxonomy_level, selected_node=selected_annotation
-                )
-            else:
-                cyto_elements, bar_fig, layout = annotation_visualization(
-                    bin_information, unique_annotations, contact_matrix, taxonomy_level
-                )
+                selected_position = unique_annotations.tolist().index(selected_annotation)
+                connected = np.flatnonzero(contact_matrix.values[selected_position] > 0)
+                selected_edges.extend((selected_annotation, unique_annotations[i]) for i in connected)
+    
+            index = annotation_index(bin_information, taxonomy_level, user_folder)
+            cyto_elements, bar_fig, layout = annotation_visualization(
+                bin_information, unique_annotations, contact_matrix, taxonomy_level,
+                selected_node=selected_annotation or None, index=index, session=user_folder
+            )
             treemap_fig = go.Figure()
             treemap_style = {'height': '0vh', 'width': '0vw', 'display': 'none'}
             cyto_style = {'height': '80vh', 'width': '48vw', 'display': 'inline-block'}
@@ -1547,7 +1573,9 @@ def register_visualization_callbacks(app):
     
             logger.info(f"Displaying bin Interaction for selected bin: {selected_bin}.")
             selected_nodes.append(selected_bin)
-            cyto_elements, bar_fig = bin_visualization(bin_information, unique_annotations, bin_dense_matrix, taxonomy_level, selected_bin)
+            index = annotation_index(bin_information, taxonomy_level, user_folder)
+            cyto_elements, bar_fig = bin_visualization(bin_information, unique_annotations, bin_dense_matrix, taxonomy_level,
+                                                       selected_bin, index, session=user_folder)
             treemap_fig = go.Figure()
             treemap_style = {'height': '0vh', 'width': '0vw', 'display': 'none'}
             cyto_style = {'height': '80vh', 'width': '48vw', 'display': 'inline-block'}
@@ -0,0 +1,114 @@
+import os
+import numpy as np
+from scipy.sparse import coo_matrix, issparse, load_npz
+from stages.cache import nbytes
+
+# Per-contig factors saved next to the raw matrix instead of a normalized copy
+FACTORS_FILE = 'normalization_factors.npz'
+NORMALIZED_FILE = 'normalized_contig_matrix.npz'
+RAW_FILE = 'unnormalized_contig_matrix.npz'
+
+class FactorizedMatrix:
+    # Normalized contig matrix kept as the raw counts plus per-contig vectors.
+    # Raw, normCC, MetaTOR and bin3C all scale raw[i, j] by a product of per-contig terms,
+    # so the normalized (and denoised) values are computed on demand from the raw matrix:
+    #   Raw     : raw[i, j]
+    #   normCC  : scal * raw[i, j] / sqrt(e[i] * e[j]), diagonal set to zero
+    #   MetaTOR : raw[i, j] / sqrt(s[i] * s[j])
+    #   bin3C   : x[i] * (raw[i, j] / (n[i] * n[j]) * x[j])
+    # The denoise cut (threshold value and divisor) completes the representation.
+    # `raw` may also be a memory-mapped SpilledCOO, which is used as it is.
+    def __init__(self, raw, method, vectors=None, scalar=1.0, zero_diagonal=False, threshold_value=None, divisor=None):
+        self.raw = raw.tocoo() if issparse(raw) else raw
+        self.method = method
+        self.vectors = vectors or {}
+        self.scalar = scalar
+        self.zero_diagonal = zero_diagonal
+        self.threshold_value = threshold_value
+        self.divisor = divisor
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def nbytes(self):
+        return nbytes(self)
+
+    def memory_parts(self):
+        # What the cache size accounting counts: the raw counts and the per-contig vectors
+        return [self.raw, self.vectors]
+
+    def scale(self, row, col, data):
+        # Normalized values of the given raw entries
+        v = self.vectors
+        if self.method == 'normCC':
+            return self.scalar * data / np.sqrt(v['expected'][row] * v['expected'][col])
+        if self.method == 'MetaTOR':
+            return data / np.sqrt(v['signal'][row] * v['signal'][col])
+        if self.method == 'bin3C':
+            return v['scale'][row] * (data / (v['sites'][row] * v['sites'][col]) * v['scale'][col])
+        return data
+
+    def normalized(self):
+        # Pre-denoise normalized matrix
+        raw = self.raw
+        if not self.zero_diagonal:
+            return coo_matrix((self.scale(raw.row, raw.col, raw.data), (raw.row, raw.col)), shape=raw.shape)
+        # Same layout as setdiag(0): off-diagonal entries plus an explicit zero per diagonal position
+        keep = raw.row != raw.col
+        row, col = raw.row[keep], raw.col[keep]
+        diagonal = np.arange(min(raw.shape), dtype=row.dtype)
+        return coo_matrix((np.concatenate([self.scale(row, col, raw.data[keep]), np.zeros(len(diagonal))]),
+                           (np.concatenate([row, diagonal]), np.concatenate([col, diagonal]))), shape=raw.shape)
+
+    def with_cut(self, threshold_value, divisor):
+        return FactorizedMatrix(self.raw, self.method, self.vectors, self.scalar, self.zero_diagonal,
+                                threshold_value, divisor)
+
+    def denoised(self, row, col, data):
+        # Which of the given raw entries survive denoising, and their final values
+        if self.threshold_value is None:
+            raise ValueError("The denoise threshold has not been set for this factorized matrix.")
+        values = self.scale(row, col, data)
+        mask = values > self.threshold_value
+        if self.zero_diagonal:
+            mask &= row != col
+        values = values[mask].astype(np.float64)
+        np.divide(values, self.divisor, out=values)
+        np.ceil(values, out=values)
+        return mask, values.astype(int)
+
+    def materialize(self):
+        # Denoised normalized matrix, identical to what denoise() returns for these values
+        raw = self.raw
+        keep = raw.row != raw.col if self.zero_diagonal else slice(None)
+        row, col = raw.row[keep], raw.col[keep]
+        mask, data = self.denoised(row, col, raw.data[keep])
+        return coo_matrix((data, (row[mask], col[mask])), shape=raw.shape)
+
+    def save(self, path):
+        np.savez(path, method=self.method, scalar=self.scalar, zero_diagonal=self.zero_diagonal,
+                 threshold_value=self.threshold_value, divisor=self.divisor,
+                 **{f'vector_{name}': vector for name, vector in self.vectors.items()})
+
+    @classmethod
+    def load(cls, path, raw):
+        with np.load(path) as stored:
+            vectors = {name[len('vector_'):]: stored[name] for name in stored.files if name.startswith('vector_')}
+            return cls(raw, str(stored['method']), vectors, float(stored['scalar']), bool(stored['zero_diagonal']),
+                       float(stored['threshold_value']), float(stored['divisor']))
+
+def load_factorized(folder, raw=None):
+    # The factorized normalization of a user folder, or None when it was saved as a matrix
+    factors_path = os.path.join(folder, FACTORS_FILE)
+    if not os.path.exists(factors_path):
+        return None
+    return FactorizedMatrix.load(factors_path, load_npz(os.path.join(folder, RAW_FILE)) if raw is None else raw)
+
+def load_normalized_matrix(folder):
+    # The normalized contig matrix of a user folder, from its factors when it was saved factorized
+    factorized = load_factorized(folder)
+    if factorized is not None:
+        return factorized.materialize()
+    return load_npz(os.path.join(folder, NORMALIZED_FILE)).tocoo()
@@ -0,0 +1,246 @@
+import os
+import logging
+import numpy as np
+import statsmodels.api as sm
+
+logger = logging.getLogger("app_logger")
+
+GLM_FIT_MODES = ('exact', 'subsample', 'grouped')
+# RMS difference in log expected contacts two subsample fits may show before one is accepted,
+# override with GLM_SUBSAMPLE_TOLERANCE
+SUBSAMPLE_TOLERANCE = float(os.getenv("GLM_SUBSAMPLE_TOLERANCE", 0.02))
+# Upper limit of the grouped fit's bins per covariate; cell codes stay well inside int64
+MAX_GRID_BINS = 1024
+
+def clamp_grid_bins(grid_bins):
+    return int(min(max(int(grid_bins), 2), MAX_GRID_BINS))
+
+def nb_glm_params(exog, endog, alpha=1, freq_weights=None):
+    # Fit the negative binomial GLM used by normCC and HiCzin and return its coefficients
+    glm_nb = sm.GLM(endog, exog, family=sm.families.NegativeBinomial(alpha=alpha), freq_weights=freq_weights)
+    res = glm_nb.fit()
+    return np.asarray(res.params)
+
+def cell_codes(exog, low, high, n_bins=64):
+    # Grid cell of every row, given the covariate ranges (constant covariates are skipped)
+    codes = np.zeros(exog.shape[0], dtype=np.int64)
+    for j in range(exog.shape[1]):
+        if high[j] == low[j]:
+            continue  # Intercept or degenerate covariate
+        bins = ((exog[:, j] - low[j]) / (high[j] - low[j]) * n_bins).astype(np.int64)
+        np.minimum(bins, n_bins - 1, out=bins)
+        codes *= n_bins
+        codes += bins
+    return codes
+
+def quantize_covariates(exog, n_bins=64):
+    # Assign every row to a cell of a regular grid over the non-constant covariates
+    codes = cell_codes(exog, exog.min(axis=0), exog.max(axis=0), n_bins)
+    _, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+    return inverse, counts
+
+def group_sufficient_statistics(exog, endog, n_bins=64):
+    # Compress the regression table to one row per occupied grid cell.
+    # With a log link the NB score equations only depend on sum(y) within rows that share
+    # a covariate vector, so fitting the cell means with frequency weights reproduces the
+    # exact fit up to the quantization of the covariates.
+    inverse, counts = quantize_covariates(exog, n_bins)
+    cell_exog = np.column_stack([np.bincount(inverse, weights=exog[:, j], minlength=len(counts))
+                                 for j in range(exog.shape[1])]) / counts[:, None]
+    cell_endog = np.bincount(inverse, weights=endog, minlength=len(counts)) / counts
+    return cell_exog, cell_endog, counts
+
+class StreamingGroupedFit:
+    # Grouped sufficient statistics accumulated chunk by chunk, for regression tables that
+    # never fit in memory at once. The covariate ranges must be known up front (one extra
+    # pass); the occupied cells are then fitted exactly like grouped_nb_glm_params does.
+    # Only occupied cells are stored (sorted cell codes), never the full n_bins ** k grid.
+    def __init__(self, low, high, n_bins=64):
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.n_bins = clamp_grid_bins(n_bins)
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0)
+        self.endog_sums = np.zeros(0)
+        self.exog_sums = np.zeros((0, len(self.low)))
+        self.n_rows = 0
+
+    def add(self, exog, endog):
+        codes = cell_codes(exog, self.low, self.high, self.n_bins)
+        chunk_cells, inverse = np.unique(codes, return_inverse=True)
+        size = len(chunk_cells)
+
+        # Merge the chunk's cells into the sorted occupied cells
+        cells = np.union1d(self.cells, chunk_cells)
+        previous, current = np.searchsorted(cells, self.cells), np.searchsorted(cells, chunk_cells)
+        counts, endog_sums = np.zeros(len(cells)), np.zeros(len(cells))
+        exog_sums = np.zeros((len(cells), exog.shape[1]))
+        counts[previous], endog_sums[previous], exog_sums[previous] = self.counts, self.endog_sums, self.exog_sums
+
+        counts[current] += np.bincount(inverse, minlength=size)
+        endog_sums[current] += np.bincount(inverse, weights=endog, minlength=size)
+        for j in range(exog.shape[1]):
+            exog_sums[current, j] += np.bincount(inverse, weights=exog[:, j], minlength=size)
+
+        self.cells, self.counts, self.endog_sums, self.exog_sums = cells, counts, endog_sums, exog_sums
+        self.n_rows += len(endog)
+        return self
+
+    def params(self):
+        counts = self.counts
+        logger.info(f"Grouped GLM fit on {len(counts)} covariate cells instead of {self.n_rows} rows.")
+        return nb_glm_params(self.exog_sums / counts[:, None], self.endog_sums / counts, freq_weights=counts)
+
+class StreamingNBGLM:
+    # The exact negative binomial GLM fit of nb_glm_params for regression tables that never
+    # fit in memory at once. `chunks()` must return a fresh iterator of (exog, endog) chunks
+    # on every call. Runs the same IRLS as statsmodels (starting values, weights and deviance
+    # convergence), with one pass over the chunks per iteration; each weighted least squares
+    # step is accumulated as a QR factorization of the stacked chunks (TSQR).
+    def __init__(self, chunks, alpha=1, maxiter=100, tol=1e-8):
+        self.chunks = chunks
+        self.family = sm.families.NegativeBinomial(alpha=alpha)
+        self.maxiter = maxiter
+        self.tol = tol
+        self.n_iter = 0
+
+    def _pass(self, params=None, mean=None):
+        # Deviance at the current fit and the next IRLS coefficients, in one pass
+        family = self.family
+        deviance, r, qtb = 0.0, None, None
+        for exog, endog in self.chunks():
+            if params is None:
+                mu = (endog + mean) / 2  # family.starting_mu with the mean over every chunk
+                lin_pred = family.predict(mu)
+            else:
+                lin_pred = exog @ params
+                mu = family.fitted(lin_pred)
+            deviance += family.deviance(endog, mu)
+
+            root_weights = np.sqrt(family.weights(mu))
+            wlsendog = lin_pred + family.link.deriv(mu) * (endog - mu)
+            stacked_exog = root_weights[:, None] * exog
+            stacked_endog = root_weights * wlsendog
+            if r is not None:
+                stacked_exog = np.vstack([r, stacked_exog])
+                stacked_endog = np.concatenate([qtb, stacked_endog])
+            q, r = np.linalg.qr(stacked_exog)
+            qtb = q.T @ stacked_endog
+        return deviance, np.linalg.lstsq(r, qtb, rcond=None)[0]
+
+    def params(self):
+        total, n_rows = 0.0, 0
+        for _, endog in self.chunks():
+            total += endog.sum()
+            n_rows += len(endog)
+        if n_rows == 0:
+            raise ValueError("No rows to fit the GLM on.")
+
+        previous, params = self._pass(mean=total / n_rows)
+        self.n_iter = 1
+        while self.n_iter < self.maxiter:
+            deviance, next_params = self._pass(params)
+            if np.allclose(previous, deviance, atol=self.tol, rtol=0):
+                break
+            previous, params = deviance, next_params
+            self.n_iter += 1
+        logger.info(f"Streamed exact GLM fit on {n_rows} rows in {self.n_iter} iterations.")
+        return params
+
+def grouped_nb_glm_params(exog, endog, n_bins=64):
+    cell_exog, cell_endog, counts = group_sufficient_statistics(exog, endog, n_bins)
+    logger.info(f"Grouped GLM fit on {len(counts)} covariate cells instead of {len(endog)} rows.")
+    return nb_glm_params(cell_exog, cell_endog, freq_weights=counts)
+
+def compare_with_exact(exog, endog, params, exact_params=None):
+    # Report how far an approximate fit is from the exact fit on every row
+    if exact_params is None:
+        exact_params = nb_glm_params(exog, endog)
+    scale = np.maximum(np.abs(exact_params), 1e-12)
+    return {
+        'exact_params': exact_params,
+        'params': params,
+        'max_abs_difference': float(np.max(np.abs(params - exact_params))),
+        'max_relative_difference': float(np.max(np.abs(params - exact_params) / scale)),
+        'rms_log_expectation_difference': prediction_difference(exog, params, exact_params)
+    }
+
+def stratified_sample(endog, sample_size, rng, n_strata=10, exclude=None):
+    # Draw a sample that keeps the proportion of every contact-count stratum.
+    # Strata are quantiles of log1p(counts), so the heavy tail is always represented.
+    n = len(endog)
+    candidates = np.arange(n)
+    if exclude is not None:
+        candidates = candidates[~exclude]
+    if sample_size >= len(candidates):
+        return candidates
+
+    values = np.log1p(endog[candidates])
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, n_strata + 1)[1:-1]))
+    strata = np.searchsorted(edges, values, side='right')
+    counts = np.bincount(strata)
+
+    fraction = sample_size / len(candidates)
+    picked = []
+    for stratum, count in enumerate(counts):
+        if count == 0:
+            continue
+        members = candidates[strata == stratum]
+        take = min(count, max(1, int(round(count * fraction))))
+        picked.append(rng.choice(members, size=take, replace=False))
+    return np.sort(np.concatenate(picked))
+
+def prediction_difference(exog, params_a, params_b):
+    # RMS difference of the two fits on the log expected-contact scale.
+    # Site and length covariates are strongly collinear, so individual coefficients can
+    # trade off against each other while the fitted expectations barely move.
+    return float(np.sqrt(np.mean((exog @ (params_a - params_b)) ** 2)))
+
+def fit_nb_glm(exog, endog, fit_mode='exact', sample_size=200000, n_strata=10,
+               tolerance=SUBSAMPLE_TOLERANCE, max_rounds=4, seed=0, grid_bins=64):
+    # Estimate the bias model coefficients.
+    #   'exact'     : fit on every row (original behaviour)
+    #   'subsample' : fit on a stratified subsample and confirm the estimate on a second,
+    #                 disjoint subsample; the sample grows until both fits predict the same
+    #                 log expected contacts to within `tolerance` (RMS)
+    #   'grouped'   : quantize the covariates into a grid and fit the per-cell sufficient
+    #                 statistics with frequency weights, O(cells) instead of O(rows)
+    if fit_mode not in GLM_FIT_MODES:
+        raise ValueError(f"Unsupported GLM fitting mode: {fit_mode}")
+
+    exog = np.asarray(exog, dtype=np.float64)
+    endog = np.asarray(endog, dtype=np.float64)
+    n = len(endog)
+
+    if fit_mode == 'grouped':
+        return grouped_nb_glm_params(exog, endog, clamp_grid_bins(grid_bins))
+
+    if fit_mode == 'exact' or sample_size is None or 2 * sample_size >= n:
+        return nb_glm_params(exog, endog)
+
+    rng = np.random.default_rng(seed)
+    size = int(sample_size)
+    for _ in range(max_rounds):
+        first = stratified_sample(endog, size, rng, n_strata)
+        used = np.zeros(n, dtype=bool)
+        used[first] = True
+        second = stratified_sample(endog, size, rng, n_strata, exclude=used)
+
+        params_first = nb_glm_params(exog[first], endog[first])
+        params_second = nb_glm_params(exog[second], endog[second])
+        checked = np.concatenate([first, second])
+        difference = prediction_difference(exog[checked], params_first, params_second)
+        logger.info(f"Subsampled GLM fit on {len(first)} + {len(second)} of {n} rows, "
+                    f"RMS log-expectation difference {difference:.4f}.")
+
+        if difference <= tolerance:
+            logger.info(f"Subsampled GLM fit accepted at RMS difference {difference:.4f} (tolerance {tolerance}).")
+            return (params_first + params_second) / 2
+
+        size *= 2
+        if 2 * size >= n:
+            break
+
+    logger.warning(f"Subsampled GLM fit did not stabilise (last RMS difference {difference:.4f}, "
+                   f"tolerance {tolerance}), fitting on all rows.")
+    return nb_glm_params(exog, endog)
@@ -1,17 +1,24 @@
 import os
 import io
+import threading
 import numpy as np
 import base64
 import pandas as pd
 import logging
-from scipy.sparse import save_npz, load_npz, isspmatrix_coo
-from joblib import Parallel, delayed
+from scipy.sparse import save_npz, load_npz, isspmatrix_coo, csr_matrix
 from io import StringIO
 import pickle
 import json
+import networkx as nx
+from stages.cache import LRUCache, cache_budget, digest_arrays, digest_frame, digest_matrix, make_key
 
 logger = logging.getLogger("app_logger")
 
+ANNOTATION_INDEXES = LRUCache(cache_budget("ANNOTATION_INDEX_CACHE_MB", 256), name='annotation index cache')
+LAYOUTS = LRUCache(cache_budget("LAYOUT_CACHE_MB", 64), name='layout cache')
+# Fixed so a view gets the same layout whether it was precomputed or computed on demand
+LAYOUT_SEED = 0
+
 def save_file_to_user_folder(contents, filename, user_folder, folder_name='output'):
     # Ensure the user folder exists
     user_folder_path = os.path.join(folder_name, user_folder)
@@ -57,37 +64,191 @@ def save_file_to_user_folder(contents, filename, user_folder, folder_name='outpu
     return file_path
 
 
-def get_indexes(annotations, information_table, column):
-    # Ensure annotations is a list
-    if isinstance(annotations, str):
-        annotations = [annotations]
+class AnnotationIndex:
+    # Inverted index of a label column: the rows carrying annotations[k] are
+    # positions[offsets[k]:offsets[k + 1]], in row order. Built in one pass (codes, a stable
+    # argsort and a bincount) instead of one boolean mask over the table per annotation.
+    # Annotations default to the labels' unique values; rows with other labels are left out.
+    def __init__(self, labels, annotations=None):
+        labels = pd.Series(labels)
+        self.annotations = pd.Index(labels.unique() if annotations is None else annotations)
+        self.codes = self.annotations.get_indexer(labels)
+        rows = np.flatnonzero(self.codes >= 0)
+        order = np.argsort(self.codes[rows], kind='stable')
+        counts = np.bincount(self.codes[rows], minlength=len(self.annotations))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.positions = rows[order]
 
-    # Parallel computation using joblib
-    def fetch_indexes(annotation):
-        try:
-            indexes = information_table[information_table[column] == annotation].index.tolist()
-            return annotation, indexes
-        except Exception as e:
-            print(f'Error fetching contig indexes for annotation: {annotation}, error: {e}')
-            return annotation, []
+    def __len__(self):
+        return len(self.annotations)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.offsets.nbytes + self.positions.nbytes + int(self.annotations.memory_usage(deep=True))
+
+    def positions_of(self, annotation):
+        # Row positions of one annotation, empty when it is not indexed
+        k = self.annotations.get_indexer([annotation])[0]
+        if k < 0:
+            return self.positions[:0]
+        return self.positions[self.offsets[k]:self.offsets[k + 1]]
+
+    def first(self, values):
+        # values at the first row of every annotation; annotations must all have rows
+        return np.asarray(values)[self.positions[self.offsets[:-1]]]
+
+    def indicator(self):
+        # Sparse row-by-annotation indicator P with P[i, k] = 1 when row i carries annotations[k]
+        rows = np.flatnonzero(self.codes >= 0)
+        return csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, self.codes[rows])),
+                          shape=(len(self.codes), len(self.annotations)))
+
+def annotation_index(information_table, column, session='default'):
+    # Index of one column, built once per session and content of the column
+    key = make_key(session, column, digest_frame(information_table, [column]))
+    index = ANNOTATION_INDEXES.get(key)
+    if index is None:
+        index = AnnotationIndex(information_table[column].values)
+        ANNOTATION_INDEXES.put(key, index, size=index.nbytes)
+    return index
 
-    # Execute in parallel
-    results = Parallel(n_jobs=-1)(
-        delayed(fetch_indexes)(annotation) for annotation in annotations
-    )
+def aggregate_contacts(matrix, indicator):
+    # Annotation-level contact sums P^T A P in one sparse product, instead of one dense
+    # sub-matrix sum per annotation pair
+    indicator = indicator.astype(matrix.dtype)
+    aggregated = indicator.T.tocsr() @ matrix.tocsr() @ indicator
+    aggregated.sum_duplicates()
+    return aggregated
 
-    # Aggregate results
-    contig_indexes = {annotation: indexes for annotation, indexes in results}
+def annotation_contact_matrix(bin_information, bin_matrix, taxonomy_level, index=None):
+    # Annotation-by-annotation contact table of one taxonomy level, from the bin matrix.
+    # Same values as summing the sub-matrix of every (annotation_i, annotation_j) pair listed
+    # by combinations() plus the self pairs, with the upper triangle mirrored
+    if index is None:
+        index = AnnotationIndex(bin_information[taxonomy_level].values)
+    unique_annotations = index.annotations.values
+    summed = aggregate_contacts(csr_matrix(bin_matrix), index.indicator()).toarray()
+    values = (np.triu(summed) + np.triu(summed, 1).T).astype(float)
 
-    return contig_indexes
+    # Missing annotations never match a bin, so their rows and columns stay zero
+    missing = pd.isna(unique_annotations)
+    values[missing, :] = 0.0
+    values[:, missing] = 0.0
+    return unique_annotations, values
 
-def calculate_submatrix_sum(pair, contig_indexes_dict, matrix):
-    annotation_i, annotation_j = pair
+def annotation_matrix_version(bin_information, bin_matrix, taxonomy_levels):
+    # Content version of the precomputed tables: they only change with the bin matrix
+    # and the taxonomy columns of the bin table
+    return make_key(digest_matrix(bin_matrix), digest_frame(bin_information, taxonomy_levels))
+
+def annotation_version_key(user_folder):
+    return f'{user_folder}:annotation-matrix-version'
+
+def annotation_matrix_keys(user_folder, taxonomy_level, version):
+    return (f'{user_folder}:unique-annotations:{taxonomy_level}:{version}',
+            f'{user_folder}:contact-matrix:{taxonomy_level}:{version}')
+
+def current_annotation_version(user_folder):
+    # Version of the bin matrix the session's tables are precomputed for, None when there is none
+    try:
+        return load_from_redis(annotation_version_key(user_folder))['version']
+    except KeyError:
+        return None
+
+def load_annotation_matrix(user_folder, taxonomy_level):
+    # Precomputed (annotations, values) of a taxonomy level for the current bin matrix,
+    # or None when not (yet) stored
+    version = current_annotation_version(user_folder)
+    if version is None:
+        return None
+    annotations_key, values_key = annotation_matrix_keys(user_folder, taxonomy_level, version)
+    try:
+        return load_from_redis(annotations_key), load_from_redis(values_key)
+    except KeyError:
+        return None
+
+def cached_spring_layout(G, session, taxonomy_level, focus, layouts=LAYOUTS, **params):
+    # spring_layout positions of G, computed once per session, taxonomy level and focus node.
+    # The key also covers the nodes and weighted edges, so a changed matrix gets a new layout.
+    nodes = list(G.nodes)
+    edges = list(G.edges(data='weight', default=1))
+    graph_digest = digest_arrays(np.array([str(node) for node in nodes], dtype=str),
+                                 np.array([f'{u}\t{v}' for u, v, _ in edges], dtype=str),
+                                 np.array([weight for _, _, weight in edges], dtype=float))
+    key = make_key(session, taxonomy_level, focus, graph_digest)
+
+    positions = layouts.get(key)
+    if positions is None:
+        pos = nx.spring_layout(G, seed=LAYOUT_SEED, **params)
+        positions = np.array([pos[node] for node in nodes]).reshape(-1, 2)
+        layouts.put(key, positions)
+    return dict(zip(nodes, positions))
+
+def precompute_annotation_level(taxonomy_level, bin_information, session, shape, row, col, data):
+    # Runs on the compute pool: contact table and default (unfocused) network layout of one
+    # taxonomy level. The layouts are returned as (key, positions) for the server's LAYOUTS.
+    from stages.d_visualization import annotation_visualization
+    bin_matrix = csr_matrix((data, (row, col)), shape=shape)
+    index = AnnotationIndex(bin_information[taxonomy_level].values)
+    unique_annotations, values = annotation_contact_matrix(bin_information, bin_matrix, taxonomy_level, index)
+
+    layouts = LRUCache(LAYOUTS.max_bytes, name='precomputed layouts')
+    contact_matrix = pd.DataFrame(values, index=unique_annotations, columns=unique_annotations)
+    annotation_visualization(bin_information, unique_annotations, contact_matrix, taxonomy_level,
+                             index=index, session=session, layouts=layouts)
+    return unique_annotations, values, layouts.items()
+
+def _store_annotation_level(future, user_folder, taxonomy_level, version):
+    # Saves a finished level unless a newer bin matrix replaced the one it was computed from
+    if future.cancelled():
+        return
+    try:
+        unique_annotations, values, layouts = future.result()
+        if current_annotation_version(user_folder) != version:
+            logger.info(f"Dropping the contact matrix of {taxonomy_level} precomputed for a replaced bin matrix.")
+            return
+        annotations_key, values_key = annotation_matrix_keys(user_folder, taxonomy_level, version)
+        save_to_redis(annotations_key, unique_annotations)
+        save_to_redis(values_key, values)
+        for key, positions in layouts:
+            LAYOUTS.put(key, positions)
+        logger.info(f"Precomputed the contact matrix and network layout of {taxonomy_level}.")
+    except Exception as e:
+        logger.error(f"Precomputing the {taxonomy_level} contact matrix failed: {e}")
+
+_PRECOMPUTES = {}
+_PRECOMPUTES_LOCK = threading.Lock()
+
+def start_annotation_precompute(user_folder, bin_information, bin_matrix, taxonomy_levels):
+    # Contact tables and default layouts of every taxonomy level, computed on the compute pool
+    # in the session's queue. Tables are stored under the version of the bin matrix, so a
+    # late result of a previous matrix is never read; its queued levels are cancelled.
+    from stages.scheduler import SCHEDULER, SchedulerBusy
+    bin_matrix = csr_matrix(bin_matrix).tocoo()
+    version = annotation_matrix_version(bin_information, bin_matrix, taxonomy_levels)
+    save_to_redis(annotation_version_key(user_folder), {'version': version})
+    LAYOUTS.invalidate(f'{user_folder}:')
+
+    with _PRECOMPUTES_LOCK:
+        for future in _PRECOMPUTES.pop(user_folder, []):
+            future.cancel()
+
+    arrays = {'row': bin_matrix.row, 'col': bin_matrix.col, 'data': bin_matrix.data}
+    try:
+        futures = SCHEDULER.submit_many(user_folder, precompute_annotation_level,
+                                        [(taxonomy_level, bin_information, user_folder, bin_matrix.shape)
+                                         for taxonomy_level in taxonomy_levels], shared=arrays)
+    except SchedulerBusy as e:
+        # The visualization stage computes the tables it does not find
+        logger.warning(f"Skipping the contact matrix precompute: {e}")
+        return []
 
-    indexes_i = contig_indexes_dict[annotation_i]
-    indexes_j = contig_indexes_dict[annotation_j]
-    sub_matrix = matrix[np.ix_(indexes_i, indexes_j)]
-    return annotation_i, annotation_j, sub_matrix.sum()
+    with _PRECOMPUTES_LOCK:
+        _PRECOMPUTES[user_folder] = futures
+    for taxonomy_level, future in zip(taxonomy_levels, futures):
+        future.add_done_callback(lambda future, taxonomy_level=taxonomy_level:
+                                 _store_annotation_level(future, user_folder, taxonomy_level, version))
+    return futures
 
 def save_to_redis(key, data):  # ttl is set to 600 seconds (10 minutes) by default
     from app import r
@@ -113,7 +274,8 @@ def save_to_redis(key, data):  # ttl is set to 600 seconds (10 minutes) by defau
         # Raise an error for unsupported types
         raise ValueError(f"Unsupported data type: {type(data)}")
         
-def load_from_redis(key):
+def load_from_redis(key, dense=True):
+    # dense=False returns stored sparse matrices as they are
     from app import r
     data = r.get(key)
 
@@ -124,7 +286,7 @@ def load_from_redis(key):
     try:
         obj = pickle.loads(data)
         # If the object is a COO matrix, convert it to a dense array
-        if isspmatrix_coo(obj):
+        if isspmatrix_coo(obj) and dense:
             return obj.toarray()  # Convert COO matrix to dense array
         return obj  # Return as-is for other pickled objects
     except (pickle.UnpicklingError, TypeError):
@@ -0,0 +1,241 @@
+import numpy as np
+
+# Explicit bias factors shared by the normalization models and the results page
+BIAS_COLUMNS = {
+    'site': 'The number of restriction sites',
+    'length': 'Contig length',
+    'coverage': 'Contig coverage'
+}
+
+def contig_vectors(contig_df, factors=('site', 'length', 'coverage')):
+    # Per-contig factor values as contiguous float64 arrays, read from the table once
+    return {factor: np.ascontiguousarray(contig_df[BIAS_COLUMNS[factor]].values, dtype=np.float64)
+            for factor in factors}
+
+def contig_log_vectors(contig_df, factors=('site', 'length', 'coverage'), epsilon=1):
+    # Per-contig log vectors; zero values are replaced by epsilon before taking the log
+    vectors = contig_vectors(contig_df, factors)
+    return {factor: np.log(np.where(values > 0, values, epsilon)) for factor, values in vectors.items()}
+
+def pair_features(row, col, vectors, combine='sum', out=None, chunk_size=None):
+    # Per-pair features vectors[f][row] (+ or *) vectors[f][col] for every factor f.
+    # Each feature is written straight into a column of `out` (Fortran order, so columns
+    # are contiguous); only a chunk-sized gather buffer is allocated on the side.
+    factors = list(vectors)
+    n = len(row)
+    if out is None:
+        out = np.empty((n, len(factors)), dtype=np.float64, order='F')
+    chunk_size = n if not chunk_size else chunk_size
+    gather = np.empty(min(chunk_size, n), dtype=np.float64)
+    operation = np.add if combine == 'sum' else np.multiply
+
+    for start in range(0, n, max(chunk_size, 1)):
+        stop = min(start + chunk_size, n)
+        block_row, block_col = row[start:stop], col[start:stop]
+        block_gather = gather[:stop - start]
+        for j, factor in enumerate(factors):
+            target = out[start:stop, j]
+            np.take(vectors[factor], block_row, out=target)
+            np.take(vectors[factor], block_col, out=block_gather)
+            operation(target, block_gather, out=target)
+    return out
+
+def iter_pair_features(row, col, vectors, combine='sum', chunk_size=1000000):
+    # Stream the per-pair features in chunks through one reused buffer.
+    # Yields (start, stop, block); the block is overwritten by the next chunk.
+    n = len(row)
+    buffer = np.empty((min(chunk_size, n), len(vectors)), dtype=np.float64, order='F')
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        block = buffer[:stop - start]
+        pair_features(row[start:stop], col[start:stop], vectors, combine=combine, out=block)
+        yield start, stop, block
+
+class CorrelationAccumulator:
+    # Pearson correlations between contacts and every feature column, accumulated chunk by
+    # chunk. Each chunk contributes its count, means and centred (co)moments, merged with the
+    # pairwise update of Chan et al., so memory is constant and large products do not cancel.
+    def __init__(self, n_features):
+        self.n = 0
+        self.mean_x = np.zeros(n_features)
+        self.mean_y = 0.0
+        self.m2_x = np.zeros(n_features)
+        self.m2_y = 0.0
+        self.c_xy = np.zeros(n_features)
+
+    def add(self, features, contacts):
+        n_b = len(contacts)
+        if n_b == 0:
+            return
+        contacts = np.asarray(contacts, dtype=np.float64)
+        mean_x, mean_y = features.mean(axis=0), contacts.mean()
+        dy = contacts - mean_y
+        dx = features - mean_x
+        m2_x, m2_y, c_xy = np.einsum('ij,ij->j', dx, dx), dy @ dy, dy @ dx
+
+        n_a, n = self.n, self.n + n_b
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        weight = n_a * n_b / n
+        self.m2_x += m2_x + delta_x ** 2 * weight
+        self.m2_y += m2_y + delta_y ** 2 * weight
+        self.c_xy += c_xy + delta_x * delta_y * weight
+        self.mean_x += delta_x * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.n = n
+
+    def correlations(self):
+        # NaN for features (or contacts) without variance, like pearsonr
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.c_xy / np.sqrt(self.m2_x * self.m2_y)
+
+def pair_correlations(row, col, data, vectors, combine='product', chunk_size=1000000):
+    # Correlations between the contacts and the per-pair features of every factor, streamed
+    accumulator = CorrelationAccumulator(len(vectors))
+    for start, stop, block in iter_pair_features(row, col, vectors, combine=combine, chunk_size=chunk_size):
+        accumulator.add(block, data[start:stop])
+    return dict(zip(vectors, accumulator.correlations()))
+
+def standardize_columns(features, skip=0):
+    # Standardize feature columns in place (columns before `skip` are left untouched)
+    for j in range(skip, features.shape[1]):
+        column = features[:, j]
+        std = np.std(column)
+        if std == 0:
+            column.fill(0)
+        else:
+            column -= np.mean(column)
+            column /= std
+    return features
+
+def _percentile_ranks(n, q):
+    # Bracketing ranks and interpolation weight, computed exactly like np.percentile's
+    # default 'linear' method so thresholds match bit for bit
+    position = (n - 1) * (q / 100)
+    lower = int(np.floor(position))
+    lower = min(max(lower, 0), n - 1)
+    upper = min(lower + 1, n - 1)
+    return lower, upper, position - lower
+
+def _lerp(low_value, high_value, t):
+    diff = high_value - low_value
+    return low_value + diff * t if t < 0.5 else high_value - diff * (1 - t)
+
+def select_percentile(values, q):
+    # np.percentile(values, q) found with an O(n) partition around the two bracketing ranks
+    lower, upper, t = _percentile_ranks(len(values), q)
+    part = np.partition(values, [lower, upper])
+    return _lerp(part[lower], part[upper], t)
+
+class QuantileSketch:
+    # Mergeable log-bucket quantile sketch (DDSketch style) for streamed contact values.
+    # Every positive value x falls in bucket ceil(log_gamma(x)), so any quantile estimate
+    # is within `relative_accuracy` of the true value while memory only grows with the
+    # dynamic range of the data. Zeros and negative values are counted separately.
+    def __init__(self, relative_accuracy=0.005):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.negative = []
+        self.count = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > 0]
+        self.zero_count += int(np.count_nonzero(values == 0))
+        negative = values[values < 0]
+        if negative.size:
+            self.negative.append(np.sort(negative))
+        if positive.size:
+            keys, counts = np.unique(self.bucket_keys(positive), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += len(values)
+        return self
+
+    def bucket_keys(self, positive):
+        return np.ceil(np.log(positive) / self._log_gamma).astype(np.int64)
+
+    def merge(self, other):
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.negative.extend(other.negative)
+        self.count += other.count
+        return self
+
+    def _locate(self, rank):
+        # Return ('negative', value) / ('zero', 0) / ('bucket', key) for the given 0-based rank
+        negative = np.sort(np.concatenate(self.negative)) if self.negative else np.empty(0)
+        if rank < len(negative):
+            return 'negative', negative[rank]
+        rank -= len(negative)
+        if rank < self.zero_count:
+            return 'zero', 0.0
+        rank -= self.zero_count
+        keys = sorted(self.buckets)
+        cumulative = np.cumsum([self.buckets[key] for key in keys])
+        return 'bucket', keys[int(np.searchsorted(cumulative, rank, side='right'))]
+
+    def quantile(self, q):
+        # Approximate q-quantile (0 <= q <= 1) of everything added so far
+        if self.count == 0:
+            raise ValueError("Quantile of an empty sketch.")
+        kind, value = self._locate(int(round(q * (self.count - 1))))
+        if kind != 'bucket':
+            return value
+        return 2 * self.gamma ** value / (self.gamma + 1)
+
+    def locate(self, rank):
+        # Where the given 0-based rank lives: ('negative', exact value), ('zero', 0.0) or
+        # ('bucket', key), used to refine a sketch estimate into an exact order statistic
+        return self._locate(rank)
+
+def chunked_percentile(data, q, chunk_size=5000000, relative_accuracy=0.005):
+    # Exact np.percentile-compatible percentile of a (possibly memory-mapped) array in two
+    # streaming passes with bounded memory: a QuantileSketch locates the buckets holding the
+    # two bracketing ranks, then only the values inside those buckets are selected exactly.
+    n = len(data)
+    if n == 0:
+        raise ValueError("Percentile of an empty array.")
+    sketch = QuantileSketch(relative_accuracy)
+    for start in range(0, n, chunk_size):
+        sketch.add(data[start:start + chunk_size])
+
+    lower, upper, t = _percentile_ranks(n, q)
+
+    def exact_rank(rank):
+        kind, key = sketch.locate(rank)
+        if kind != 'bucket':
+            return key
+        # Second pass: count everything in lower buckets and keep only this bucket's distinct
+        # values with their counts, so heavily repeated values (integer counts) stay small
+        below = 0
+        values, counts = [], []
+        for start in range(0, n, chunk_size):
+            block = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+            below += int(np.count_nonzero(block <= 0))
+            positive = block[block > 0]
+            keys = sketch.bucket_keys(positive)
+            below += int(np.count_nonzero(keys < key))
+            block_values, block_counts = np.unique(positive[keys == key], return_counts=True)
+            values.append(block_values)
+            counts.append(block_counts)
+        values, inverse = np.unique(np.concatenate(values), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(counts))
+        return values[int(np.searchsorted(np.cumsum(counts), rank - below, side='right'))]
+
+    low_value = exact_rank(lower)
+    high_value = low_value if upper == lower else exact_rank(upper)
+    return _lerp(low_value, high_value, t)
+
+def compact_in_place(mask, *arrays):
+    # Keep the masked entries of every array, reusing the arrays' own storage
+    keep = np.flatnonzero(mask)
+    compacted = []
+    for array in arrays:
+        kept = array[:len(keep)]
+        kept[...] = array[keep]
+        compacted.append(kept)
+    return compacted
@@ -0,0 +1,382 @@
+import os
+import shutil
+import logging
+import tempfile
+import zipfile
+import numpy as np
+from numpy.lib.format import open_memmap, read_magic, read_array_header_1_0, read_array_header_2_0, write_array
+from stages.balancing import KnightRuizBalancer, BlockedSpMV
+from stages.glm_fitting import StreamingGroupedFit, StreamingNBGLM, fit_nb_glm
+from stages.kernels import contig_log_vectors, pair_features, chunked_percentile
+from stages.cache import cache_budget
+
+logger = logging.getLogger("app_logger")
+
+# Peak memory allowed for out-of-core normalization, set with OUT_OF_CORE_BUDGET_MB
+OUT_OF_CORE_BUDGET = cache_budget("OUT_OF_CORE_BUDGET_MB", 4096)
+# Scratch space for the memory-mapped matrices, defaults to the system temp folder
+OUT_OF_CORE_DIR = os.getenv("OUT_OF_CORE_DIR", tempfile.gettempdir())
+# Bytes held per nonzero while a chunk is processed (indices, values, pair features and
+# masks of the heaviest method) and rough peak per nonzero of the in-memory methods
+CHUNK_BYTES_PER_ENTRY = 160
+IN_MEMORY_BYTES_PER_ENTRY = 200
+# Per-contig vectors kept in memory (bias factors, GLM expectations, balancing buffers)
+CONTIG_BYTES = 8 * 24
+
+class SpilledCOO:
+    # COO components stored as .npy memory maps, processed in chunks of entries
+    def __init__(self, directory, name, shape, nnz, data_dtype=np.float64):
+        self.shape = tuple(int(size) for size in shape)
+        self.nnz = int(nnz)
+        index_dtype = np.int32 if max(self.shape) < 2 ** 31 else np.int64
+        length = max(self.nnz, 1)  # Memory maps cannot be empty
+        self.row = open_memmap(os.path.join(directory, f'{name}_row.npy'), mode='w+', dtype=index_dtype, shape=(length,))[:self.nnz]
+        self.col = open_memmap(os.path.join(directory, f'{name}_col.npy'), mode='w+', dtype=index_dtype, shape=(length,))[:self.nnz]
+        self.data = open_memmap(os.path.join(directory, f'{name}_data.npy'), mode='w+', dtype=data_dtype, shape=(length,))[:self.nnz]
+
+    def chunks(self, chunk_size):
+        for start in range(0, self.nnz, chunk_size):
+            yield start, min(start + chunk_size, self.nnz)
+
+    def block(self, start, stop):
+        return np.asarray(self.row[start:stop]), np.asarray(self.col[start:stop]), np.asarray(self.data[start:stop])
+
+def chunk_entries(n_contigs, budget=None):
+    # Entries per chunk so that the chunk temporaries and per-contig vectors fit the budget
+    budget = OUT_OF_CORE_BUDGET if budget is None else budget
+    available = budget - n_contigs * CONTIG_BYTES
+    if available <= 0:
+        raise MemoryError(f"Out-of-core budget of {budget / 2**20:.0f} MB is too small for {n_contigs} contigs.")
+    return max(1024, int(available // CHUNK_BYTES_PER_ENTRY))
+
+def _open_member(archive, name):
+    # Open a .npy member of an .npz archive as a stream and read its header
+    stream = archive.open(name)
+    version = read_magic(stream)
+    read_header = read_array_header_1_0 if version == (1, 0) else read_array_header_2_0
+    shape, _, dtype = read_header(stream)
+    return stream, shape, dtype
+
+def _iter_member(archive, name, chunk_size):
+    # Stream a 1-d .npy member of an .npz archive in chunks without loading it whole
+    stream, shape, dtype = _open_member(archive, name)
+    with stream:
+        remaining = int(np.prod(shape))
+        while remaining:
+            count = min(chunk_size, remaining)
+            yield np.frombuffer(stream.read(count * dtype.itemsize), dtype=dtype)
+            remaining -= count
+
+def npz_info(path):
+    # Sparse format, shape and number of stored entries of a save_npz file, from the headers only
+    with zipfile.ZipFile(path) as archive:
+        with archive.open('format.npy') as stream:
+            sparse_format = np.load(stream).item()
+        with archive.open('shape.npy') as stream:
+            shape = tuple(int(size) for size in np.load(stream))
+        stream, data_shape, _ = _open_member(archive, 'data.npy')
+        stream.close()
+    if not isinstance(sparse_format, str):
+        sparse_format = sparse_format.decode('ascii')
+    return sparse_format, shape, int(np.prod(data_shape))
+
+def needs_out_of_core(path, budget=None):
+    # Whether the in-memory normalization of this matrix would exceed the memory budget
+    budget = OUT_OF_CORE_BUDGET if budget is None else budget
+    _, _, nnz = npz_info(path)
+    return nnz * IN_MEMORY_BYTES_PER_ENTRY > budget
+
+def spill_npz(path, directory, chunk_size, name='input'):
+    # Copy a save_npz matrix (COO, CSR or CSC) into memory-mapped COO components, chunk by chunk
+    sparse_format, shape, nnz = npz_info(path)
+    spilled = SpilledCOO(directory, name, shape, nnz)
+    with zipfile.ZipFile(path) as archive:
+        start = 0
+        for values in _iter_member(archive, 'data.npy', chunk_size):
+            spilled.data[start:start + len(values)] = values
+            start += len(values)
+
+        if sparse_format == 'coo':
+            for field in ['row', 'col']:
+                target, start = getattr(spilled, field), 0
+                for values in _iter_member(archive, f'{field}.npy', chunk_size):
+                    target[start:start + len(values)] = values
+                    start += len(values)
+        elif sparse_format in ('csr', 'csc'):
+            with archive.open('indptr.npy') as stream:
+                indptr = np.load(stream)
+            major, minor = (spilled.row, spilled.col) if sparse_format == 'csr' else (spilled.col, spilled.row)
+            start = 0
+            for values in _iter_member(archive, 'indices.npy', chunk_size):
+                stop = start + len(values)
+                minor[start:stop] = values
+                major[start:stop] = np.searchsorted(indptr, np.arange(start, stop), side='right') - 1
+                start = stop
+        else:
+            raise ValueError(f"Unsupported sparse format for out-of-core normalization: {sparse_format}")
+    return spilled
+
+def iter_npz_entries(path, chunk_size):
+    # (row, col, data) chunks of a save_npz matrix (COO, CSR or CSC), streamed from the archive
+    sparse_format, _, _ = npz_info(path)
+    with zipfile.ZipFile(path) as archive:
+        data_chunks = _iter_member(archive, 'data.npy', chunk_size)
+        if sparse_format == 'coo':
+            yield from zip(_iter_member(archive, 'row.npy', chunk_size), _iter_member(archive, 'col.npy', chunk_size),
+                           data_chunks)
+        elif sparse_format in ('csr', 'csc'):
+            with archive.open('indptr.npy') as stream:
+                indptr = np.load(stream)
+            start = 0
+            for minor, data in zip(_iter_member(archive, 'indices.npy', chunk_size), data_chunks):
+                stop = start + len(minor)
+                major = np.searchsorted(indptr, np.arange(start, stop), side='right') - 1
+                yield (major, minor, data) if sparse_format == 'csr' else (minor, major, data)
+                start = stop
+        else:
+            raise ValueError(f"Unsupported sparse format for out-of-core processing: {sparse_format}")
+
+def save_spilled_npz(spilled, path):
+    # Write memory-mapped COO components as a save_npz compatible archive, streaming each array
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for name, array in [('row', spilled.row), ('col', spilled.col), ('data', spilled.data),
+                            ('format', np.array(b'coo')), ('shape', np.array(spilled.shape))]:
+            with archive.open(f'{name}.npy', 'w', force_zip64=True) as stream:
+                write_array(stream, np.asanyarray(array), allow_pickle=False)
+
+def denoise_spilled(spilled, threshold, directory, chunk_size):
+    # Out-of-core denoise: same result as denoise() in three streaming passes
+    threshold_value = chunked_percentile(spilled.data, threshold, chunk_size=chunk_size)
+
+    kept, min_non_zero = 0, np.inf
+    for start, stop in spilled.chunks(chunk_size):
+        data = np.asarray(spilled.data[start:stop])
+        data = data[data > threshold_value]
+        kept += len(data)
+        if np.any(data > 0):
+            min_non_zero = min(min_non_zero, data[data > 0].min())
+
+    result = SpilledCOO(directory, 'denoised', spilled.shape, kept, data_dtype=int)
+    offset = 0
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        mask = data > threshold_value
+        count = int(np.count_nonzero(mask))
+        result.row[offset:offset + count] = row[mask]
+        result.col[offset:offset + count] = col[mask]
+        result.data[offset:offset + count] = np.ceil(data[mask] / min_non_zero)
+        offset += count
+    return result
+
+def _row_reduce(spilled, chunk_size, n, diagonal=False):
+    # Per-row maximum of the stored values (or per-row sum of the diagonal entries)
+    result = np.zeros(n)
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        if diagonal:
+            mask = row == col
+            np.add.at(result, row[mask], data[mask])
+        else:
+            np.maximum.at(result, row, data)
+    return result
+
+def _count(spilled, chunk_size, predicate):
+    return sum(int(np.count_nonzero(predicate(*spilled.block(start, stop)[:2])))
+               for start, stop in spilled.chunks(chunk_size))
+
+def _normcc(spilled, contig_df, directory, chunk_size, epsilon, fit_mode, sample_size, grid_bins):
+    n = spilled.shape[0]
+    signal = _row_reduce(spilled, chunk_size, n)
+
+    exog = np.column_stack([
+        np.ones(n),
+        np.log(contig_df['The number of restriction sites'].values + epsilon),
+        np.log(contig_df['Contig length'].values),
+        np.log(contig_df['Contig coverage'].values + epsilon)
+    ])
+    # One row per contig, so the model itself always fits in memory
+    params = fit_nb_glm(exog, signal, fit_mode=fit_mode, sample_size=sample_size, grid_bins=grid_bins)
+    expected_signal = np.exp(exog @ params)
+    scal = np.max(expected_signal)
+
+    # Off-diagonal entries are rescaled; the diagonal becomes explicit zeros (as setdiag(0))
+    off_diagonal = _count(spilled, chunk_size, lambda row, col: row != col)
+    result = SpilledCOO(directory, 'normalized', spilled.shape, off_diagonal + n)
+    offset = 0
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        mask = row != col
+        row, col, data = row[mask], col[mask], data[mask]
+        count = len(data)
+        result.row[offset:offset + count] = row
+        result.col[offset:offset + count] = col
+        result.data[offset:offset + count] = scal * data / np.sqrt(expected_signal[row] * expected_signal[col])
+        offset += count
+    result.row[offset:] = np.arange(n)
+    result.col[offset:] = np.arange(n)
+    result.data[offset:] = 0
+    return result
+
+def _metator(spilled, directory, chunk_size, epsilon):
+    n = spilled.shape[0]
+    signal = _row_reduce(spilled, chunk_size, n, diagonal=True) + epsilon
+    result = SpilledCOO(directory, 'normalized', spilled.shape, spilled.nnz)
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        result.row[start:stop] = row
+        result.col[start:stop] = col
+        result.data[start:stop] = data / np.sqrt(signal[row] * signal[col])
+    return result
+
+def _hiczin(spilled, contig_df, directory, chunk_size, epsilon, fit_mode, sample_size, grid_bins, seed=0):
+    log_vectors = contig_log_vectors(contig_df, epsilon=epsilon)
+    k = len(log_vectors)
+
+    def upper_chunks():
+        # Strictly upper-triangular pairs with their log-product features, chunk by chunk
+        for start, stop in spilled.chunks(chunk_size):
+            row, col, data = spilled.block(start, stop)
+            mask = row < col
+            row, col, data = row[mask], col[mask], data[mask]
+            yield row, col, data, pair_features(row, col, log_vectors)
+
+    # Streaming moments of the features for the standardization (two passes, like np.std)
+    count, sums = 0, np.zeros(k)
+    low, high = np.full(k, np.inf), np.full(k, -np.inf)
+    for _, _, data, features in upper_chunks():
+        count += len(data)
+        sums += features.sum(axis=0)
+        if len(data):
+            low = np.minimum(low, features.min(axis=0))
+            high = np.maximum(high, features.max(axis=0))
+    if count == 0:
+        raise ValueError("The contact matrix has no off-diagonal contacts.")
+    mean = sums / count
+    squares = np.zeros(k)
+    for _, _, _, features in upper_chunks():
+        squares += ((features - mean) ** 2).sum(axis=0)
+    std = np.sqrt(squares / count)
+    std_safe = np.where(std == 0, 1, std)
+
+    def design(features):
+        exog = np.empty((len(features), k + 1), order='F')
+        exog[:, 0] = 1
+        exog[:, 1:] = np.where(std == 0, 0, (features - mean) / std_safe)
+        return exog
+
+    if fit_mode == 'grouped':
+        grid = StreamingGroupedFit(np.concatenate(([1], np.where(std == 0, 0, (low - mean) / std_safe))),
+                                   np.concatenate(([1], np.where(std == 0, 0, (high - mean) / std_safe))), grid_bins)
+        for _, _, data, features in upper_chunks():
+            grid.add(design(features), data)
+        params = grid.params()
+    elif fit_mode == 'subsample' and 2 * sample_size < count:
+        # Uniform pre-sample, large enough for the stratified subsample fit
+        rng = np.random.default_rng(seed)
+        rate = min(1.0, 4 * sample_size / count)
+        sample_exog, sample_endog = [], []
+        for _, _, data, features in upper_chunks():
+            picked = rng.random(len(data)) < rate
+            sample_exog.append(design(features[picked]))
+            sample_endog.append(data[picked])
+        params = fit_nb_glm(np.vstack(sample_exog), np.concatenate(sample_endog), fit_mode='subsample',
+                            sample_size=sample_size, seed=seed)
+    elif fit_mode in ('exact', 'subsample'):
+        # The exact fit on every pair, as in memory: the same IRLS, one pass over the chunks per iteration
+        params = StreamingNBGLM(lambda: ((design(features), data) for _, _, data, features in upper_chunks())).params()
+    else:
+        raise ValueError(f"Unsupported GLM fitting mode: {fit_mode}")
+
+    # Each upper pair and its mirror image, as normalized + normalized.T in memory
+    result = SpilledCOO(directory, 'normalized', spilled.shape, 2 * count)
+    offset = 0
+    for row, col, data, features in upper_chunks():
+        normalized = data / np.exp(design(features) @ params)
+        size = len(data)
+        result.row[offset:offset + size], result.col[offset:offset + size] = row, col
+        result.row[offset + size:offset + 2 * size], result.col[offset + size:offset + 2 * size] = col, row
+        result.data[offset:offset + size] = normalized
+        result.data[offset + size:offset + 2 * size] = normalized
+        offset += 2 * size
+    return result
+
+def _bin3c(spilled, contig_df, directory, chunk_size, epsilon, max_iter, tolerance, warm_start):
+    n = spilled.shape[0]
+    num_sites = contig_df['The number of restriction sites'].values + epsilon
+
+    # Diagonal of the site-scaled matrix, to patch zero diagonals as patch_zero_diagonal does
+    diagonal = np.zeros(n)
+    counts = np.zeros(n, dtype=np.int64)
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        counts += np.bincount(row, minlength=n)
+        mask = row == col
+        np.add.at(diagonal, row[mask], data[mask] / (num_sites[row[mask]] * num_sites[col[mask]]))
+    zero_diagonal = diagonal == 0
+    counts += zero_diagonal
+
+    # Counting sort of the entries into memory-mapped CSR arrays
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    nnz = int(indptr[-1])
+    indices = open_memmap(os.path.join(directory, 'csr_indices.npy'), mode='w+', dtype=np.int64, shape=(max(nnz, 1),))
+    values = open_memmap(os.path.join(directory, 'csr_data.npy'), mode='w+', dtype=np.float64, shape=(max(nnz, 1),))
+    cursor = indptr[:-1].copy()
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        order = np.argsort(row, kind='stable')
+        row, col, data = row[order], col[order], data[order]
+        run_start = np.searchsorted(row, row, side='left')
+        position = cursor[row] + (np.arange(len(row)) - run_start)
+        indices[position] = col
+        values[position] = data / (num_sites[row] * num_sites[col])
+        cursor += np.bincount(row, minlength=n)
+    patched = np.flatnonzero(zero_diagonal)
+    indices[cursor[patched]] = patched
+    values[cursor[patched]] = 1
+
+    balancer = KnightRuizBalancer(max_iter=max_iter, tol=tolerance)
+    kernel = BlockedSpMV(indptr, indices, values, (n, n), block_nnz=chunk_size)
+    scale = balancer.balance_operator(kernel, n, x0=warm_start)
+    logger.info(f"Out-of-core Knight-Ruiz balancing finished after {balancer.n_iter} iterations "
+                f"({balancer.elapsed:.2f}s).")
+
+    # Balanced values x_i * (v_ij * x_j) of the unpatched entries
+    result = SpilledCOO(directory, 'normalized', spilled.shape, spilled.nnz)
+    for start, stop in spilled.chunks(chunk_size):
+        row, col, data = spilled.block(start, stop)
+        result.row[start:stop] = row
+        result.col[start:stop] = col
+        result.data[start:stop] = scale[row] * (data / (num_sites[row] * num_sites[col]) * scale[col])
+    return result
+
+def run_out_of_core_normalization(method, contig_df, matrix_path, output_path, epsilon=1, threshold=5,
+                                  max_iter=1000, tolerance=0.000001, warm_start=None, fit_mode='exact',
+                                  sample_size=200000, grid_bins=64, budget=None):
+    # Normalize and denoise a contact matrix stored in `matrix_path` without ever loading it.
+    # The COO components are spilled to memory-mapped files and every method streams over
+    # them in chunks sized from the memory budget; the denoised matrix is written to
+    # `output_path` in save_npz format. Returns the number of stored entries.
+    directory = tempfile.mkdtemp(prefix='normalization-', dir=OUT_OF_CORE_DIR)
+    try:
+        chunk_size = chunk_entries(len(contig_df), budget)
+        logger.info(f"Running out-of-core {method} normalization in chunks of {chunk_size} entries.")
+        spilled = spill_npz(matrix_path, directory, chunk_size)
+
+        if method == 'Raw':
+            normalized = spilled
+        elif method == 'normCC':
+            normalized = _normcc(spilled, contig_df, directory, chunk_size, epsilon, fit_mode, sample_size, grid_bins)
+        elif method == 'HiCzin':
+            normalized = _hiczin(spilled, contig_df, directory, chunk_size, epsilon, fit_mode, sample_size, grid_bins)
+        elif method == 'bin3C':
+            normalized = _bin3c(spilled, contig_df, directory, chunk_size, epsilon, max_iter, tolerance, warm_start)
+        elif method == 'MetaTOR':
+            normalized = _metator(spilled, directory, chunk_size, epsilon)
+        else:
+            raise ValueError(f"Unsupported normalization method: {method}")
+
+        denoised = denoise_spilled(normalized, threshold, directory, chunk_size)
+        save_spilled_npz(denoised, output_path)
+        return denoised.nnz
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
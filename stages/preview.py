@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from stages.kernels import _percentile_ranks, _lerp
+
+class ThresholdPreview:
+    # Index over the pre-denoise normalized values that answers "what would denoise keep
+    # at this percentile" without rerunning anything. The values are sorted once; every
+    # entry also gets its global rank, stored per row in rank order, so the retained degree
+    # of every contig at any cut is one vectorized binary search over the rows.
+    def __init__(self, matrix, bin_index=None):
+        matrix = matrix.tocoo()
+        n = matrix.nnz
+        self.n = n
+        self.shape = matrix.shape
+
+        order = np.argsort(matrix.data, kind='stable')
+        self.sorted_values = matrix.data[order]
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+
+        # Row-major (row, rank) keys, sorted, with the start offset of every row
+        rows = matrix.row.astype(np.int64)
+        self.row_keys = np.sort(rows * n + rank)
+        counts = np.bincount(rows, minlength=self.shape[0])
+        self.row_start = np.concatenate(([0], np.cumsum(counts)))
+        self._row_base = np.arange(self.shape[0], dtype=np.int64) * n
+
+        # Contig to bin codes for the per-bin summary
+        self.bin_codes = None
+        if bin_index is not None:
+            codes, self.bin_labels = pd.factorize(pd.Series(bin_index), sort=True)
+            self.bin_codes = codes
+
+    def threshold_value(self, threshold):
+        # Same value np.percentile(values, threshold) gives in denoise
+        lower, upper, t = _percentile_ranks(self.n, threshold)
+        return _lerp(self.sorted_values[lower], self.sorted_values[upper], t)
+
+    def cut(self, threshold):
+        # Number of entries denoise drops (values <= threshold value)
+        return int(np.searchsorted(self.sorted_values, self.threshold_value(threshold), side='right'))
+
+    def degrees(self, threshold):
+        # Retained entries per row for the given percentile
+        cut = self.cut(threshold)
+        first_kept = np.searchsorted(self.row_keys, self._row_base + cut, side='left')
+        return self.row_start[1:] - first_kept
+
+    def summary(self, threshold, n_bins=12):
+        degree = self.degrees(threshold)
+        retained = int(degree.sum())
+        result = {
+            'threshold_value': float(self.threshold_value(threshold)),
+            'retained_nnz': retained,
+            'removed_nnz': self.n - retained,
+            'connected_contigs': int(np.count_nonzero(degree))
+        }
+
+        if self.bin_codes is not None:
+            valid = self.bin_codes >= 0
+            edges_per_bin = np.bincount(self.bin_codes[valid], weights=degree[valid], minlength=len(self.bin_labels))
+            result['mean_edges_per_bin'] = float(edges_per_bin.mean()) if len(edges_per_bin) else 0.0
+            result['median_edges_per_bin'] = float(np.median(edges_per_bin)) if len(edges_per_bin) else 0.0
+
+        # Miniature degree distribution over power-of-two degree classes
+        upper = max(1, int(degree.max()) if len(degree) else 1)
+        edges = np.unique(np.concatenate(([0, 1], 2 ** np.arange(1, int(np.ceil(np.log2(upper))) + 2))))
+        edges = edges[:n_bins + 1]
+        edges[-1] = max(edges[-1], upper + 1)
+        counts, _ = np.histogram(degree, bins=edges)
+        result['degree_distribution'] = pd.DataFrame({
+            'Degree': [f"{low}" if high - low == 1 else f"{low}-{high - 1}" for low, high in zip(edges[:-1], edges[1:])],
+            'Contigs': counts
+        })
+        return result
@@ -0,0 +1,219 @@
+import os
+import logging
+import threading
+import multiprocessing
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+logger = logging.getLogger("app_logger")
+
+# Worker processes shared by every session, override with COMPUTE_WORKERS
+COMPUTE_WORKERS = int(os.getenv("COMPUTE_WORKERS", os.cpu_count() or 1))
+# Tasks allowed to wait for a worker, across all sessions and per session
+COMPUTE_QUEUE_LIMIT = int(os.getenv("COMPUTE_QUEUE_LIMIT", 256))
+SESSION_QUEUE_LIMIT = int(os.getenv("SESSION_QUEUE_LIMIT", 64))
+
+class SchedulerBusy(RuntimeError):
+    # Raised when a submission would exceed the queue limits
+    pass
+
+def share_arrays(arrays):
+    # Copy every array into its own shared memory block once.
+    # Returns the blocks (kept alive and unlinked by the caller) and picklable specs.
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def attach_arrays(specs):
+    # Read-only views on the shared blocks; the blocks are returned so they stay mapped
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        arrays[name] = array
+    return blocks, arrays
+
+def _call(fn, specs, args, kwargs):
+    # Runs in a worker: shared arrays are passed to fn as keyword arguments.
+    # Results must not be views on them, the blocks are closed once fn returns.
+    blocks, arrays = attach_arrays(specs)
+    try:
+        return fn(*args, **arrays, **kwargs)
+    finally:
+        del arrays
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                pass
+
+class _SharedSet:
+    # Shared blocks of one submission, unlinked when its last task finishes
+    def __init__(self, arrays, n_tasks):
+        self.blocks, self.specs = share_arrays(arrays) if arrays else ([], {})
+        self.remaining = n_tasks
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def release_all(self):
+        self.remaining = 1
+        self.release()
+
+class ComputeScheduler:
+    # One bounded process pool for the whole server. Every session queues its tasks
+    # separately and the sessions take turns for free workers, so one large request
+    # cannot starve the others. Arrays are placed in shared memory once per submission
+    # and mapped read-only by the workers instead of being pickled into every task.
+    # Submissions beyond the queue limits raise SchedulerBusy.
+    def __init__(self, max_workers=COMPUTE_WORKERS, max_queued=COMPUTE_QUEUE_LIMIT,
+                 max_queued_per_session=SESSION_QUEUE_LIMIT):
+        self.max_workers = max(1, int(max_workers))
+        self.max_queued = max_queued
+        self.max_queued_per_session = max_queued_per_session
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Spawned workers do not inherit the server's threads, locks or Redis connections
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _drop_executor(self, executor):
+        # A worker died (killed, out of memory) and the pool refuses new work:
+        # forget it so the next task starts a fresh pool
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        logger.warning("The compute pool broke, starting a new one.")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, shared_set, args, kwargs):
+        executor = self._get_executor()
+        try:
+            return executor, executor.submit(_call, fn, shared_set.specs, args, kwargs)
+        except BrokenProcessPool:
+            # The task never reached the broken pool, so it is sent to a new one
+            self._drop_executor(executor)
+            executor = self._get_executor()
+            return executor, executor.submit(_call, fn, shared_set.specs, args, kwargs)
+
+    def _admit(self, session, n_tasks):
+        queued = len(self._queues.get(session, ()))
+        if self._queued + n_tasks > self.max_queued or queued + n_tasks > self.max_queued_per_session:
+            raise SchedulerBusy(f"The server is busy ({self._running} running, {self._queued} queued tasks). "
+                                "Please try again shortly.")
+
+    def map(self, session, fn, items, shared=None, **kwargs):
+        # fn(item, **shared, **kwargs) for every item, results in input order
+        items = list(items)
+        if not items:
+            return []
+        futures = self.submit_many(session, fn, [(item,) for item in items], shared=shared, **kwargs)
+        return [future.result() for future in futures]
+
+    def submit(self, session, fn, *args, shared=None, **kwargs):
+        return self.submit_many(session, fn, [args], shared=shared, **kwargs)[0]
+
+    def submit_many(self, session, fn, args_list, shared=None, **kwargs):
+        # Queue fn(*args, **shared, **kwargs) for every args tuple; returns one future each
+        with self._lock:
+            self._admit(session, len(args_list))
+        shared_set = _SharedSet(shared, len(args_list))
+        futures = []
+        try:
+            with self._lock:
+                # Checked again, the lock was released while the arrays were copied
+                self._admit(session, len(args_list))
+                queue = self._queues.setdefault(session, deque())
+                for args in args_list:
+                    future = Future()
+                    queue.append((future, fn, args, kwargs, shared_set))
+                    futures.append(future)
+                self._queued += len(args_list)
+        except SchedulerBusy:
+            shared_set.release_all()
+            raise
+        self._dispatch()
+        return futures
+
+    def _next_task(self):
+        # Round robin over the sessions with queued tasks
+        session, queue = next(iter(self._queues.items()))
+        task = queue.popleft()
+        del self._queues[session]
+        if queue:
+            self._queues[session] = queue
+        self._queued -= 1
+        return task
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self._running >= self.max_workers or not self._queues:
+                    return
+                future, fn, args, kwargs, shared_set = self._next_task()
+                if not future.set_running_or_notify_cancel():
+                    shared_set.release()
+                    continue
+                self._running += 1
+            try:
+                executor, inner = self._submit(fn, shared_set, args, kwargs)
+            except Exception as e:
+                self._finish(future, shared_set, error=e)
+                continue
+            inner.add_done_callback(lambda inner, future=future, shared_set=shared_set, executor=executor:
+                                    self._finish(future, shared_set, inner=inner, executor=executor))
+
+    def _finish(self, future, shared_set, inner=None, error=None, executor=None):
+        with self._lock:
+            self._running -= 1
+        shared_set.release()
+        if inner is not None:
+            error = inner.exception()
+            # The task that was running when the pool broke fails, the queued ones get a new pool
+            if isinstance(error, BrokenProcessPool):
+                self._drop_executor(executor)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(inner.result())
+        self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.max_workers, 'running': self._running, 'queued': self._queued,
+                    'sessions': {session: len(queue) for session, queue in self._queues.items()}}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+# The scheduler every stage submits its parallel work to
+SCHEDULER = ComputeScheduler()
@@ -0,0 +1,77 @@
+import sys
+import time
+import types
+import numpy as np
+import pandas as pd
+import pytest
+from concurrent.futures import wait
+from scipy.sparse import coo_matrix, triu
+from stages.helper import (LAYOUTS, annotation_contact_matrix, load_annotation_matrix,
+                           start_annotation_precompute)
+from stages.scheduler import SCHEDULER
+
+LEVELS = ['Family', 'Genus']
+
+class MemoryRedis:
+    # The part of the Redis client the session store uses
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+@pytest.fixture(autouse=True)
+def session_store(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'app', types.SimpleNamespace(r=MemoryRedis(), SESSION_TTL=600))
+    yield
+    SCHEDULER.shutdown()
+
+def bin_data(seed, n_bins=300):
+    rng = np.random.default_rng(seed)
+    bin_information = pd.DataFrame({
+        'Bin index': [f'bin{i}' for i in range(n_bins)],
+        'Category': rng.choice(['chromosome', 'virus', 'plasmid'], n_bins),
+        'Family': rng.choice(['f_a', 'f_b', 'f_c', 'f_'], n_bins),
+        'Genus': rng.choice([f'g_{i}' for i in range(12)] + ['g_'], n_bins)
+    })
+    upper = triu(coo_matrix((rng.integers(1, 50, 2000), (rng.integers(0, n_bins, 2000), rng.integers(0, n_bins, 2000))),
+                            shape=(n_bins, n_bins)), 1)
+    return bin_information, (upper + upper.T).tocoo()
+
+def stored_tables(session, timeout=60):
+    # The tables are saved by the futures' callbacks, shortly after the futures finish
+    deadline = time.monotonic() + timeout
+    while True:
+        tables = {level: load_annotation_matrix(session, level) for level in LEVELS}
+        if all(table is not None for table in tables.values()) or time.monotonic() > deadline:
+            return tables
+        time.sleep(0.05)
+
+def test_precompute_stores_tables_and_layouts():
+    bin_information, bin_matrix = bin_data(0)
+    wait(start_annotation_precompute('session', bin_information, bin_matrix, LEVELS), timeout=120)
+
+    for level, table in stored_tables('session').items():
+        expected_annotations, expected_values = annotation_contact_matrix(bin_information, bin_matrix, level)
+        assert list(table[0]) == list(expected_annotations)
+        assert np.array_equal(table[1], expected_values)
+        assert any(str(key).startswith(f'session:{level}:annotation:') for key, _ in LAYOUTS.items())
+
+def test_replaced_bin_matrix_never_reads_stale_tables():
+    old_information, old_matrix = bin_data(1)
+    new_information, new_matrix = bin_data(2)
+    old_futures = start_annotation_precompute('session', old_information, old_matrix, LEVELS)
+    new_futures = start_annotation_precompute('session', new_information, new_matrix, LEVELS)
+    wait(old_futures + new_futures, timeout=120)
+
+    for level, table in stored_tables('session').items():
+        expected_annotations, expected_values = annotation_contact_matrix(new_information, new_matrix, level)
+        assert list(table[0]) == list(expected_annotations)
+        assert np.array_equal(table[1], expected_values)
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+from stages.balancing import KnightRuizBalancer
+
+def reference_bisto(dense, max_iter=1000, tol=1e-6):
+    # Dense copy of the original _bisto_seq, delta=0.1, Delta=3, g=0.9, etamax=0.1
+    m = dense.copy()
+    zero_diagonal = np.diagonal(m) == 0
+    m[zero_diagonal, zero_diagonal] = 1
+    n = m.shape[0]
+    e = np.ones(n)
+    x = e.copy()
+    delta, Delta, g, etamax = 0.1, 3, 0.9, 0.1
+    eta = etamax
+    stop_tol = tol * 0.5
+    rt = tol ** 2
+    v = x * m.dot(x)
+    rk = 1 - v
+    rho_km1 = rk.dot(rk)
+    rho_km2 = rho_km1
+    rout = rold = rho_km1
+    n_iter = 0
+    y = np.empty_like(e)
+    while rout > rt and n_iter < max_iter:
+        k = 0
+        y[:] = e
+        inner_tol = max(rout * eta ** 2, rt)
+        while rho_km1 > inner_tol:
+            k += 1
+            if k == 1:
+                Z = rk / v
+                p = Z
+                rho_km1 = rk.dot(Z)
+            else:
+                p = Z + rho_km1 / rho_km2 * p
+            w = x * m.dot(x * p) + v * p
+            alpha = rho_km1 / p.dot(w)
+            ap = alpha * p
+            ynew = y + ap
+            if np.amin(ynew) <= delta:
+                ind = ap < 0
+                y += np.amin((delta - y[ind]) / ap[ind]) * ap
+                break
+            if np.amax(ynew) >= Delta:
+                ind = ynew > Delta
+                y += np.amin((Delta - y[ind]) / ap[ind]) * ap
+                break
+            y = ynew
+            rk = rk - alpha * w
+            rho_km2 = rho_km1
+            Z = rk / v
+            rho_km1 = rk.dot(Z)
+        x *= y
+        v = x * m.dot(x)
+        rk = 1 - v
+        rho_km1 = rk.dot(rk)
+        rout = rho_km1
+        n_iter += k + 1
+        rat = rout / rold
+        rold = rout
+        eta = max(min(g * rat, etamax), stop_tol / np.sqrt(rout))
+    return x
+
+@pytest.fixture(scope='module')
+def contacts():
+    # Symmetric contact matrix with a few empty diagonal entries
+    upper = sparse_random(300, 300, density=0.05, format='csr', random_state=3)
+    upper.data = np.ceil(upper.data * 50)
+    m = (upper + upper.T).tocsr()
+    m.setdiag(np.where(np.arange(300) % 7 == 0, 0, m.diagonal() + 1))
+    m.eliminate_zeros()
+    return m
+
+def test_scale_matches_dense_reference(contacts):
+    matrix, scale = KnightRuizBalancer().balance(contacts)
+    np.testing.assert_allclose(scale, reference_bisto(contacts.toarray()), rtol=1e-8)
+    np.testing.assert_allclose(matrix.toarray(), scale[:, None] * contacts.toarray() * scale[None, :], rtol=1e-12)
+
+def test_warm_start_converges_to_the_same_scale(contacts):
+    cold = KnightRuizBalancer(tol=1e-4)
+    _, start = cold.balance(contacts)
+    warm = KnightRuizBalancer()
+    _, scale = warm.balance(contacts, x0=start)
+    full = KnightRuizBalancer()
+    _, reference = full.balance(contacts)
+    np.testing.assert_allclose(scale, reference, rtol=1e-5)
+    assert warm.converged
+    assert warm.n_iter < full.n_iter
+
+def test_invalid_warm_start_is_ignored(contacts):
+    balancer = KnightRuizBalancer()
+    _, scale = balancer.balance(contacts, x0=np.zeros(contacts.shape[0]))
+    np.testing.assert_allclose(scale, reference_bisto(contacts.toarray()), rtol=1e-8)
+
+def test_buffers_are_reused_between_runs(contacts):
+    balancer = KnightRuizBalancer()
+    balancer.balance(contacts)
+    buffers = balancer._x, balancer._v
+    _, scale = balancer.balance(contacts)
+    assert balancer._x is buffers[0] and balancer._v is buffers[1]
+    np.testing.assert_allclose(scale, reference_bisto(contacts.toarray()), rtol=1e-8)
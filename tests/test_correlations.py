@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from scipy.stats import pearsonr
+from stages.kernels import CorrelationAccumulator, pair_correlations
+
+@pytest.fixture(scope='module')
+def pairs():
+    # Contacts between random contig pairs with per-contig factors on very different scales
+    rng = np.random.default_rng(4)
+    n_contigs, n_pairs = 500, 30000
+    vectors = {
+        'site': rng.integers(0, 80, n_contigs).astype(float),
+        'length': rng.uniform(1e3, 1e6, n_contigs),
+        'coverage': rng.lognormal(2, 1, n_contigs),
+    }
+    row, col = rng.integers(0, n_contigs, size=(2, n_pairs))
+    data = rng.poisson(1 + vectors['site'][row] * vectors['site'][col] / 500).astype(float)
+    return row, col, data, vectors
+
+@pytest.mark.parametrize('chunk_size', [1, 997, 30000, 100000])
+def test_pair_correlations_match_pearsonr(pairs, chunk_size):
+    row, col, data, vectors = pairs
+    if chunk_size == 1:
+        row, col, data = row[:2000], col[:2000], data[:2000]
+    correlations = pair_correlations(row, col, data, vectors, chunk_size=chunk_size)
+    for factor, values in vectors.items():
+        expected = pearsonr(values[row] * values[col], data)[0]
+        assert correlations[factor] == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+def test_accumulator_matches_corrcoef_with_large_offsets():
+    # Means far from zero are where single-pass sums lose precision
+    rng = np.random.default_rng(8)
+    features = rng.normal(size=(50000, 2)) + [1e8, -1e6]
+    contacts = 3 * features[:, 0] - 1e8 * 3 + rng.normal(size=50000)
+    accumulator = CorrelationAccumulator(2)
+    for start in range(0, 50000, 4096):
+        accumulator.add(features[start:start + 4096], contacts[start:start + 4096])
+    expected = [np.corrcoef(features[:, j], contacts)[0, 1] for j in range(2)]
+    np.testing.assert_allclose(accumulator.correlations(), expected, rtol=1e-8, atol=1e-9)
+
+def test_constant_features_give_nan():
+    accumulator = CorrelationAccumulator(2)
+    features = np.column_stack([np.full(100, 3.0), np.arange(100.0)])
+    accumulator.add(features, np.arange(100.0) ** 2)
+    correlations = accumulator.correlations()
+    assert np.isnan(correlations[0])
+    assert correlations[1] == pytest.approx(np.corrcoef(np.arange(100.0), np.arange(100.0) ** 2)[0, 1])
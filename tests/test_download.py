@@ -0,0 +1,42 @@
+import sys
+import types
+import dash
+import pytest
+from stages.c_results import register_results_callbacks
+
+class MemoryRedis:
+    # The part of the Redis client the download route uses
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode() if isinstance(value, str) else value
+
+    def get(self, key):
+        return self.values.get(key)
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    store = MemoryRedis()
+    monkeypatch.setitem(sys.modules, 'app', types.SimpleNamespace(r=store, SESSION_TTL=600))
+    monkeypatch.chdir(tmp_path)
+    for session, token in [('session-a', 'token-a'), ('session-b', 'token-b')]:
+        (tmp_path / 'output' / session).mkdir(parents=True)
+        (tmp_path / 'output' / session / 'contig_info_final.csv').write_text(f'{session}\n')
+        store.set(f'{session}:download-token', token)
+    app = dash.Dash(__name__, suppress_callback_exceptions=True)
+    app.layout = dash.html.Div()
+    register_results_callbacks(app)
+    return app.server.test_client()
+
+def test_owner_downloads_its_archive(client):
+    response = client.get('/download/session-a?token=token-a')
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'].endswith('session-a.7z')
+
+@pytest.mark.parametrize('query', ['', '?token=', '?token=token-b', '?token=t%C3%B6ken'])
+def test_other_sessions_are_refused(client, query):
+    assert client.get(f'/download/session-a{query}').status_code == 403
+
+def test_unknown_folders_are_not_found(client):
+    assert client.get('/download/session-c?token=token-a').status_code == 404
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import coo_matrix, random as sparse_random, save_npz
+from stages.factorized import FactorizedMatrix, FACTORS_FILE, RAW_FILE, load_normalized_matrix
+from stages.b_normalization import run_normalization
+from stages.cache import nbytes
+
+@pytest.fixture(scope='module')
+def contigs():
+    # Small symmetric raw contact matrix with its contig table
+    rng = np.random.default_rng(9)
+    n = 200
+    upper = sparse_random(n, n, density=0.05, format='coo', random_state=9)
+    upper.data = np.ceil(upper.data * 40)
+    raw = (upper + upper.T).tocoo()
+    contig_df = pd.DataFrame({
+        'The number of restriction sites': rng.integers(0, 60, n),
+        'Contig length': rng.integers(1000, 50000, n),
+        'Contig coverage': rng.uniform(1, 30, n),
+    })
+    return contig_df, raw
+
+def sorted_entries(matrix):
+    matrix = matrix.tocoo()
+    order = np.lexsort((matrix.col, matrix.row))
+    return matrix.row[order], matrix.col[order], matrix.data[order]
+
+def dense_normalized(method, contig_df, raw, model):
+    # Pre-denoise normalized matrix computed densely from the original formulas
+    dense = raw.toarray().astype(float)
+    if method == 'MetaTOR':
+        signal = np.diagonal(dense) + 1
+        return dense / np.sqrt(np.outer(signal, signal))
+    if method == 'normCC':
+        log_site = np.log(contig_df['The number of restriction sites'].values + 1)
+        log_len = np.log(contig_df['Contig length'].values)
+        log_coverage = np.log(contig_df['Contig coverage'].values + 1)
+        exog = np.column_stack([np.ones(len(contig_df)), log_site, log_len, log_coverage])
+        expected = np.exp(exog @ model['params'])
+        normalized = np.max(expected) * dense / np.sqrt(np.outer(expected, expected))
+        np.fill_diagonal(normalized, 0)
+        return normalized
+    if method == 'bin3C':
+        sites = contig_df['The number of restriction sites'].values + 1
+        return np.outer(model['scale'], model['scale']) * dense / np.outer(sites, sites)
+    return dense
+
+@pytest.mark.parametrize('method', ['Raw', 'normCC', 'MetaTOR', 'bin3C'])
+def test_factors_reproduce_the_dense_normalization(contigs, method):
+    contig_df, raw = contigs
+    normalized, model = run_normalization(method, contig_df, raw, use_cache=False, return_model=True)
+    factorized = model['factorized']
+    np.testing.assert_allclose(factorized.normalized().toarray(), dense_normalized(method, contig_df, raw, model),
+                               rtol=1e-12)
+
+    # Denoise the dense result the original way: percentile cut, divide by the smallest kept value, ceil
+    dense = factorized.normalized().tocoo()
+    threshold_value = np.percentile(dense.data, 5)
+    kept = dense.data[dense.data > threshold_value]
+    assert factorized.threshold_value == threshold_value
+    assert factorized.divisor == np.min(kept[kept > 0])
+
+    for matrix in (normalized, factorized.materialize()):
+        row, col, data = sorted_entries(matrix)
+        expected_row, expected_col, expected_data = sorted_entries(dense)
+        mask = expected_data > threshold_value
+        np.testing.assert_array_equal(row, expected_row[mask])
+        np.testing.assert_array_equal(col, expected_col[mask])
+        np.testing.assert_array_equal(data, np.ceil(expected_data[mask] / factorized.divisor).astype(int))
+
+@pytest.mark.parametrize('method', ['normCC', 'bin3C'])
+def test_saved_factors_load_back(contigs, method, tmp_path):
+    contig_df, raw = contigs
+    normalized, model = run_normalization(method, contig_df, raw, use_cache=False, return_model=True)
+    model['factorized'].save(str(tmp_path / FACTORS_FILE))
+    save_npz(str(tmp_path / RAW_FILE), raw.tocsr())
+
+    loaded = FactorizedMatrix.load(str(tmp_path / FACTORS_FILE), raw)
+    assert loaded.method == method
+    assert loaded.threshold_value == model['factorized'].threshold_value
+    for name, vector in model['factorized'].vectors.items():
+        np.testing.assert_array_equal(loaded.vectors[name], vector)
+
+    for matrix in (loaded.materialize(), load_normalized_matrix(str(tmp_path))):
+        for got, expected in zip(sorted_entries(matrix), sorted_entries(normalized)):
+            np.testing.assert_array_equal(got, expected)
+
+def test_materialize_needs_a_cut(contigs):
+    _, raw = contigs
+    with pytest.raises(ValueError):
+        FactorizedMatrix(coo_matrix(raw), 'Raw').materialize()
+
+def test_cache_size_counts_the_raw_counts_once(contigs):
+    contig_df, raw = contigs
+    _, model = run_normalization('MetaTOR', contig_df, raw, use_cache=False, return_model=True)
+    factorized = model['factorized']
+    entries = sum(array.nbytes for array in (raw.row, raw.col, raw.data))
+    assert factorized.nbytes == entries + factorized.vectors['signal'].nbytes
+    # The pre-denoise matrix shares its indices with the raw counts
+    assert nbytes([model['matrix'], factorized]) == factorized.nbytes + model['matrix'].data.nbytes
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import statsmodels.api as sm
+from stages.glm_fitting import (
+    fit_nb_glm, group_sufficient_statistics, grouped_nb_glm_params, prediction_difference
+)
+
+def simulate(exog, seed):
+    rng = np.random.default_rng(seed)
+    mean = np.exp(exog @ np.array([1.0, 0.4, -0.25, 0.15]))
+    return rng.negative_binomial(1, 1 / (1 + mean)).astype(float)
+
+@pytest.fixture(scope='module')
+def discrete():
+    # Covariates with a handful of values each, so every grid cell holds one covariate vector
+    rng = np.random.default_rng(11)
+    n = 20000
+    exog = np.column_stack([np.ones(n), rng.integers(0, 5, size=(n, 3))]).astype(float)
+    return exog, simulate(exog, 11)
+
+@pytest.fixture(scope='module')
+def continuous():
+    rng = np.random.default_rng(12)
+    n = 20000
+    exog = np.column_stack([np.ones(n), rng.normal(size=(n, 3))])
+    return exog, simulate(exog, 12)
+
+def dense_fit(exog, endog):
+    return sm.GLM(endog, exog, family=sm.families.NegativeBinomial(alpha=1)).fit().params
+
+def test_grouped_fit_is_exact_for_discrete_covariates(discrete):
+    exog, endog = discrete
+    np.testing.assert_allclose(grouped_nb_glm_params(exog, endog), dense_fit(exog, endog), rtol=1e-6, atol=1e-8)
+
+def test_grouped_fit_is_close_for_continuous_covariates(continuous):
+    exog, endog = continuous
+    params = fit_nb_glm(exog, endog, fit_mode='grouped', grid_bins=64)
+    assert prediction_difference(exog, params, dense_fit(exog, endog)) < 0.02
+
+def test_fit_mode_grouped_uses_the_grouped_fit(continuous):
+    exog, endog = continuous
+    np.testing.assert_array_equal(fit_nb_glm(exog, endog, fit_mode='grouped', grid_bins=16),
+                                  grouped_nb_glm_params(exog, endog, 16))
+
+def test_sufficient_statistics_preserve_the_totals(continuous):
+    exog, endog = continuous
+    cell_exog, cell_endog, counts = group_sufficient_statistics(exog, endog, 16)
+    assert counts.sum() == len(endog)
+    np.testing.assert_allclose((cell_endog * counts).sum(), endog.sum())
+    np.testing.assert_allclose((cell_exog * counts[:, None]).sum(axis=0), exog.sum(axis=0))
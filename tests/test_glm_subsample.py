@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import statsmodels.api as sm
+from stages.glm_fitting import fit_nb_glm, stratified_sample, prediction_difference
+
+@pytest.fixture(scope='module')
+def counts():
+    # Negative binomial counts driven by an intercept and three standardized covariates
+    rng = np.random.default_rng(7)
+    n = 20000
+    exog = np.column_stack([np.ones(n), rng.normal(size=(n, 3))])
+    mean = np.exp(exog @ np.array([1.5, 0.6, -0.3, 0.2]))
+    endog = rng.negative_binomial(1, 1 / (1 + mean)).astype(float)
+    return exog, endog
+
+def dense_fit(exog, endog):
+    return sm.GLM(endog, exog, family=sm.families.NegativeBinomial(alpha=1)).fit().params
+
+def test_exact_mode_matches_statsmodels(counts):
+    exog, endog = counts
+    np.testing.assert_allclose(fit_nb_glm(exog, endog), dense_fit(exog, endog), rtol=1e-10)
+
+def test_small_tables_are_fitted_exactly(counts):
+    exog, endog = counts
+    params = fit_nb_glm(exog, endog, fit_mode='subsample', sample_size=len(endog))
+    np.testing.assert_allclose(params, dense_fit(exog, endog), rtol=1e-10)
+
+def test_subsample_stays_close_to_the_exact_fit(counts):
+    exog, endog = counts
+    params = fit_nb_glm(exog, endog, fit_mode='subsample', sample_size=3000)
+    assert prediction_difference(exog, params, dense_fit(exog, endog)) < 0.1
+
+def test_unstable_subsample_falls_back_to_the_exact_fit(counts):
+    exog, endog = counts
+    params = fit_nb_glm(exog, endog, fit_mode='subsample', sample_size=1000, tolerance=0)
+    np.testing.assert_allclose(params, dense_fit(exog, endog), rtol=1e-10)
+
+def test_stratified_samples_are_disjoint(counts):
+    _, endog = counts
+    rng = np.random.default_rng(0)
+    first = stratified_sample(endog, 2000, rng)
+    used = np.zeros(len(endog), dtype=bool)
+    used[first] = True
+    second = stratified_sample(endog, 2000, rng, exclude=used)
+    assert len(np.unique(first)) == len(first) and len(np.unique(second)) == len(second)
+    assert not np.intersect1d(first, second).size
+    assert abs(len(first) - 2000) < 20
+
+def test_accepted_fit_is_within_the_tolerance(counts, caplog):
+    exog, endog = counts
+    with caplog.at_level('INFO', logger='app_logger'):
+        params = fit_nb_glm(exog, endog, fit_mode='subsample', sample_size=2000, tolerance=0.05)
+    accepted = [record.getMessage() for record in caplog.records if 'accepted at RMS difference' in record.getMessage()]
+    assert accepted
+    assert float(accepted[0].split('difference ')[1].split(' ')[0]) <= 0.05
+    assert prediction_difference(exog, params, dense_fit(exog, endog)) < 0.05
@@ -0,0 +1,78 @@
+import tracemalloc
+import numpy as np
+import pytest
+from scipy.sparse import load_npz
+from benchmarks.synthetic import generate
+from benchmarks.bench_normalization import prepared_inputs
+from stages.out_of_core import needs_out_of_core, run_out_of_core_normalization, spill_npz, chunk_entries
+from stages.b_normalization import generating_bin_information, generating_bin_information_out_of_core
+from stages.c_results import score_results
+
+# Far below what the in-memory path needs for the generated matrix (about 200 bytes per entry)
+BUDGET = 64 * 2 ** 20
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('synthetic')
+    generate(str(folder), n_contigs=40000, n_bins=2000, contacts_per_contig=200, seed=1)
+    contig_info, _ = prepared_inputs(str(folder))
+    return contig_info, folder / 'raw_contact_matrix.npz', folder / 'normalized_contig_matrix.npz'
+
+def traced_peak(fn, *args, **kwargs):
+    # Result of fn and the peak of the memory it allocated (memory maps are not counted)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        result = fn(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+@pytest.mark.parametrize('method', ['Raw', 'MetaTOR'])
+def test_out_of_core_path_stays_within_budget(dataset, method):
+    contig_info, raw_path, normalized_path = dataset
+    assert needs_out_of_core(str(raw_path), BUDGET)
+
+    kept, normalization_peak = traced_peak(run_out_of_core_normalization, method, contig_info, str(raw_path),
+                                           str(normalized_path), budget=BUDGET)
+    assert kept > 0
+    assert normalization_peak < BUDGET
+
+    for remove_unclassified, remove_host_host in [(False, False), (True, True)]:
+        _, aggregation_peak = traced_peak(generating_bin_information_out_of_core, contig_info, str(normalized_path),
+                                          remove_unclassified, remove_host_host, budget=BUDGET)
+        assert aggregation_peak < BUDGET
+
+def test_out_of_core_aggregation_matches_in_memory(dataset):
+    contig_info, raw_path, normalized_path = dataset
+    run_out_of_core_normalization('Raw', contig_info, str(raw_path), str(normalized_path), budget=BUDGET)
+    normalized_matrix = load_npz(str(normalized_path))
+
+    for remove_unclassified, remove_host_host in [(False, False), (True, False), (True, True)]:
+        (expected_info, expected_matrix), in_memory_peak = traced_peak(generating_bin_information, contig_info,
+                                                                       normalized_matrix, remove_unclassified,
+                                                                       remove_host_host)
+        # The dataset is large enough that the in-memory aggregation alone exceeds the budget
+        assert in_memory_peak > BUDGET
+        bin_info, bin_matrix = generating_bin_information_out_of_core(contig_info, str(normalized_path),
+                                                                      remove_unclassified, remove_host_host,
+                                                                      budget=BUDGET)
+        assert bin_info.equals(expected_info)
+        assert (bin_matrix.tocsr() != expected_matrix.tocsr()).nnz == 0
+        assert np.array_equal(bin_matrix.getnnz(axis=1), expected_matrix.getnnz(axis=1))
+
+def test_out_of_core_results_page_stays_within_budget(dataset, tmp_path):
+    contig_info, raw_path, normalized_path = dataset
+    run_out_of_core_normalization('MetaTOR', contig_info, str(raw_path), str(normalized_path), budget=BUDGET)
+    chunk_size = chunk_entries(len(contig_info), BUDGET)
+
+    def score():
+        raw = spill_npz(str(raw_path), str(tmp_path), chunk_size, name='raw')
+        return score_results(str(raw_path.parent), contig_info, raw,
+                             lambda: spill_npz(str(normalized_path), str(tmp_path), chunk_size, name='normalized'),
+                             chunk_size)
+
+    (rows, figures), peak = traced_peak(score)
+    assert peak < BUDGET
+    assert [row['Metric'] for row in rows] == ['Raw', 'Normalized']
+    assert [figure.data[0].type for figure in figures] == ['heatmap'] * 3
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy.sparse import load_npz, save_npz
+from stages.out_of_core import needs_out_of_core, run_out_of_core_normalization
+from stages.b_normalization import preprocess_normalization, run_normalization
+
+@pytest.fixture(scope='module')
+def example(tmp_path_factory):
+    # The bundled example output, stored once as COO and once as CSR
+    contig_info, contact_matrix = preprocess_normalization('output', assets_folder='assets/examples')
+    folder = tmp_path_factory.mktemp('example')
+    save_npz(str(folder / 'coo.npz'), contact_matrix.tocoo())
+    save_npz(str(folder / 'csr.npz'), contact_matrix.tocsr())
+    # Room for the per-contig vectors plus a few chunks of entries, far below the matrix itself
+    budget = 8 * 2 ** 20 + len(contig_info) * 8 * 24
+    return contig_info, contact_matrix, folder, budget
+
+def sorted_entries(matrix):
+    matrix = matrix.tocoo()
+    order = np.lexsort((matrix.col, matrix.row))
+    return matrix.row[order], matrix.col[order], matrix.data[order]
+
+@pytest.mark.parametrize('method, fit_mode', [
+    ('Raw', 'exact'), ('normCC', 'exact'), ('HiCzin', 'exact'), ('HiCzin', 'grouped'),
+    ('bin3C', 'exact'), ('MetaTOR', 'exact')
+])
+@pytest.mark.parametrize('layout', ['coo', 'csr'])
+def test_out_of_core_matches_in_memory(example, method, fit_mode, layout):
+    contig_info, contact_matrix, folder, budget = example
+    matrix_path = str(folder / f'{layout}.npz')
+    output_path = str(folder / f'{method}-{fit_mode}-{layout}.npz')
+    assert needs_out_of_core(matrix_path, budget)
+
+    expected = run_normalization(method, contig_info, contact_matrix, fit_mode=fit_mode, use_cache=False)
+    kept = run_out_of_core_normalization(method, contig_info, matrix_path, output_path,
+                                         fit_mode=fit_mode, budget=budget)
+    result = load_npz(output_path)
+    assert kept == result.nnz == expected.nnz
+    for got, wanted in zip(sorted_entries(result), sorted_entries(expected)):
+        np.testing.assert_array_equal(got, wanted)
+
+def test_unknown_fit_mode_is_rejected(example):
+    contig_info, _, folder, budget = example
+    with pytest.raises(ValueError):
+        run_out_of_core_normalization('HiCzin', contig_info, str(folder / 'coo.npz'), str(folder / 'rejected.npz'),
+                                      fit_mode='approximate', budget=budget)
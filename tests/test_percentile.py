@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+from stages.kernels import QuantileSketch, select_percentile, chunked_percentile
+from stages.b_normalization import denoise
+
+@pytest.fixture(scope='module')
+def values():
+    # Heavy-tailed contact values with ties, as in a normalized contact matrix
+    rng = np.random.default_rng(5)
+    return np.concatenate([rng.lognormal(0, 2, 50000), np.ceil(rng.pareto(1.5, 20000)), np.zeros(100)])
+
+@pytest.mark.parametrize('q', [0, 5, 37.5, 50, 99.9, 100])
+def test_select_percentile_matches_numpy(values, q):
+    assert select_percentile(values, q) == np.percentile(values, q)
+
+@pytest.mark.parametrize('q', [0, 5, 37.5, 50, 99.9, 100])
+def test_chunked_percentile_matches_numpy(values, q):
+    assert chunked_percentile(values, q, chunk_size=7000) == np.percentile(values, q)
+
+def test_sketch_quantiles_are_within_the_relative_accuracy(values):
+    sketch = QuantileSketch(0.01)
+    for start in range(0, len(values), 9000):
+        sketch.add(values[start:start + 9000])
+    for q in [0.1, 0.5, 0.9, 0.99]:
+        exact = np.sort(values)[int(round(q * (len(values) - 1)))]
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+
+def test_merged_sketches_match_a_single_sketch(values):
+    whole = QuantileSketch().add(values)
+    merged = QuantileSketch().add(values[:30000]).merge(QuantileSketch().add(values[30000:]))
+    assert merged.buckets == whole.buckets and merged.count == whole.count
+    assert merged.quantile(0.5) == whole.quantile(0.5)
+
+def reference_denoise(matrix, threshold):
+    # The original sort-based denoise
+    threshold_value = np.percentile(matrix.data, threshold)
+    mask = matrix.data > threshold_value
+    data = matrix.data[mask]
+    data = np.ceil(data / np.min(data[data > 0])).astype(int)
+    return coo_matrix((data, (matrix.row[mask], matrix.col[mask])), shape=matrix.shape)
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_denoise_matches_the_sort_based_reference(values, streaming):
+    rng = np.random.default_rng(6)
+    row, col = rng.integers(0, 1000, size=(2, len(values)))
+    matrix = coo_matrix((values, (row, col)), shape=(1000, 1000))
+    expected = reference_denoise(matrix, 5)
+    result = denoise(matrix, 5, streaming=streaming, chunk_size=7000)
+    np.testing.assert_array_equal(result.data, expected.data)
+    np.testing.assert_array_equal(result.row, expected.row)
+    np.testing.assert_array_equal(result.col, expected.col)
@@ -0,0 +1,25 @@
+import os
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+from stages.scheduler import ComputeScheduler
+
+def square(value):
+    return value * value
+
+def crash(value):
+    os._exit(1)
+
+@pytest.fixture
+def scheduler():
+    scheduler = ComputeScheduler(max_workers=2)
+    yield scheduler
+    scheduler.shutdown()
+
+def test_map_keeps_input_order(scheduler):
+    assert scheduler.map('session', square, range(10)) == [value * value for value in range(10)]
+
+def test_broken_pool_is_replaced(scheduler):
+    with pytest.raises(BrokenProcessPool):
+        scheduler.submit('session', crash, 0).result(timeout=60)
+    assert scheduler.map('session', square, range(4)) == [0, 1, 4, 9]
+    assert scheduler.stats()['running'] == 0
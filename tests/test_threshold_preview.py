@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from stages.b_normalization import (
+    normalization_cache_key, normalization_inputs_digest, threshold_preview_key
+)
+
+def inputs():
+    contig_df = pd.DataFrame({
+        'The number of restriction sites': [3, 5, 8],
+        'Contig length': [1000, 2000, 3000],
+        'Contig coverage': [1.5, 2.0, 4.0],
+    })
+    matrix = coo_matrix((np.array([4.0, 2.0, 7.0]), (np.array([0, 1, 2]), np.array([1, 2, 0]))), shape=(3, 3))
+    return contig_df, matrix
+
+def test_preview_key_follows_the_model_cache_key():
+    contig_df, matrix = inputs()
+    digest = normalization_inputs_digest(contig_df, matrix)
+    key = threshold_preview_key('session', 'HiCzin', digest, 1000, 1e-6, 'grouped', 200000, 32)
+    assert key == f"session:{normalization_cache_key('HiCzin', contig_df, matrix, fit_mode='grouped', grid_bins=32)}"
+
+def test_preview_key_changes_with_the_model_parameters_and_inputs():
+    contig_df, matrix = inputs()
+    digest = normalization_inputs_digest(contig_df, matrix)
+    keys = {
+        threshold_preview_key('session', 'HiCzin', digest, 1000, 1e-6, 'exact', 200000, 64),
+        threshold_preview_key('session', 'HiCzin', digest, 1000, 1e-6, 'grouped', 200000, 64),
+        threshold_preview_key('session', 'HiCzin', digest, 1000, 1e-6, 'grouped', 200000, 32),
+        threshold_preview_key('session', 'bin3C', digest, 1000, 1e-6, 'exact', 200000, 64),
+        threshold_preview_key('session', 'bin3C', digest, 50, 1e-6, 'exact', 200000, 64),
+        threshold_preview_key('session', 'HiCzin', normalization_inputs_digest(contig_df, matrix * 2), 1000, 1e-6,
+                              'exact', 200000, 64),
+    }
+    assert len(keys) == 6
+    # Parameters a method does not use leave its key alone
+    assert (threshold_preview_key('session', 'MetaTOR', digest, 1000, 1e-6, 'exact', 200000, 64) ==
+            threshold_preview_key('session', 'MetaTOR', digest, 50, 1e-3, 'grouped', 10, 8))